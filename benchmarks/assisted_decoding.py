@@ -0,0 +1,116 @@
+"""
+Benchmark of the assisted decoding modes of ChatGemma2 against plain decoding.
+
+The same conversation is played with every mode, greedy so the responses
+can be compared: assisted decoding must give exactly the responses of
+plain decoding. For every mode the tokens per second, the forward passes
+and the share of the drafted tokens the model accepted are reported. Run
+from the root of the repository:
+
+    python -m benchmarks.assisted_decoding
+    python -m benchmarks.assisted_decoding --real --draft-model <model name>
+
+By default the deterministic stub model is used, as draft model too with
+other weights. It writes nonsense that repeats a lot, which the prompt
+lookup guesses well, so only the real model tells the speedup to expect.
+"""
+import argparse
+import json
+import os
+import sys
+from typing import Dict, List, Any, Optional
+
+from benchmarks.stub_model import load_stub_model, build_stub_model
+from src.llm.assisted_decoding import ASSISTED_DECODING_MODES
+from src.llm.chat_gemma2 import ChatGemma2
+
+
+PROMPTS = [
+    "Hi Monika! How are you doing today?",
+    "Do you like poetry? What kind of poems do you write?",
+    "Can you tell me more about the poems you write?",
+    "What should I write about for the festival?",
+    "See you tomorrow at the club!",
+]
+
+
+def run_conversation(
+        mode: Optional[str],
+        real: bool,
+        draft_model_name: Optional[str],
+        max_new_tokens: int
+) -> Dict[str, Any]:
+    character_path = "resources/images/character/monika/"
+    emotions = sorted(f for f in os.listdir(character_path) if os.path.isdir(os.path.join(character_path, f)))
+    llm = ChatGemma2("Monika", "Akriel", emotions, mood_detector="lexicon")
+    llm.assisted_decoding.set_mode(mode)
+
+    if real:
+        llm.run_self_check = False
+        llm.draft_model_name = draft_model_name
+        llm.post_init()
+        llm.generate_response_kwargs = {"max_new_tokens": max_new_tokens, "do_sample": False}
+    else:
+        load_stub_model(llm, max_new_tokens=max_new_tokens)
+        if mode == "draft":
+            llm.assisted_decoding.set_draft_model(build_stub_model(seed=1)[0])
+
+    responses = []
+    reports = []
+    for prompt in PROMPTS:
+        responses.append(llm.generate_answer(prompt)["response"])
+        reports.append(llm.last_decoding_report)
+
+    new_tokens = sum(report["new_tokens"] for report in reports)
+    seconds = sum(report["seconds"] for report in reports)
+    return {
+        "responses": responses,
+        "tokens_per_second": new_tokens / seconds if seconds > 0 else 0.0,
+        "forward_passes": sum(report["forward_passes"] for report in reports),
+        "acceptance_rate": llm.assisted_decoding.get_stats()["acceptance_rate"],
+        "fallback_reason": llm.assisted_decoding.fallback_reason,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=list(ASSISTED_DECODING_MODES), choices=ASSISTED_DECODING_MODES)
+    parser.add_argument("--real", action="store_true", help="Load Gemma 2 instead of the stub model")
+    parser.add_argument("--draft-model", help="The draft model to load with --real, skipped without it")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    modes: List[Optional[str]] = [None] + [
+        mode for mode in args.modes if mode != "draft" or not args.real or args.draft_model
+    ]
+    results = {}
+    for mode in modes:
+        results[mode or "plain"] = run_conversation(mode, args.real, args.draft_model, args.max_new_tokens)
+
+    plain = results["plain"]
+    mismatches = []
+    for name, result in results.items():
+        result["same_responses"] = result["responses"] == plain["responses"]
+        if not result["same_responses"]:
+            mismatches.append(name)
+
+        acceptance = "n/a" if result["acceptance_rate"] is None else f"{result['acceptance_rate']:.0%}"
+        speedup = result["tokens_per_second"] / plain["tokens_per_second"]
+        print(
+            f"{name:<14} {result['tokens_per_second']:>8.1f} tokens/s ({speedup:.2f}x)"
+            f"  {result['forward_passes']:>5} forward passes  {acceptance:>4} accepted"
+            f"  same responses: {result['same_responses']}"
+        )
+        if result["fallback_reason"] is not None:
+            print(f"{'':<14} fell back: {result['fallback_reason']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+Headless benchmark suite of the render and chat pipeline, compared with a stored baseline.
+
+The game runs on the SDL dummy video and audio drivers, so no display, GPU
+or sound card is needed. For every screen resolution it measures:
+
+    set_text               laying out a new response in the ChatBox
+    draw_text_with_outline drawing one outlined line, rendered and cached
+    render_full            a frame that redraws the whole screen
+    render_typing          a frame of the typewriter, only the dirty rects
+    render_idle            a frame where nothing changed
+    set_mood               switching the character sprite
+
+then the SentenceSplitter on the sample responses and, unless --skip-llm
+is given, whole ChatGemma2 turns with a deterministic stub model. Times
+are the fastest of the repeats in milliseconds. Run from the root of the
+repository:
+
+    python -m benchmarks.headless --output results.json
+    python -m benchmarks.headless --update-baseline
+
+Every metric is compared with the baseline when there is one, the exit
+code is 1 when a metric is slower than the baseline by more than the
+tolerance. The baseline is machine specific, update it on the machine
+that runs the comparison.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Any, Optional
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+from src.game import Game
+from src.sprites.sprite import ScreenSize
+from src.text_utils.sentence_split import SentenceSplitter
+
+
+DEFAULT_BASELINE = "benchmarks/baselines/headless.json"
+RESOLUTIONS = ["800x600", "1280x720", "1920x1080"]
+
+RESPONSES = [
+    "Ahaha, I'm so happy you came to the club today! We're going to have so much fun together. "
+    "I was thinking we could start by sharing the poems we wrote last night, if you don't mind.",
+    "Hmm, I'm not sure I understand what you mean. Could you explain it again? "
+    "Sometimes I get lost in my own thoughts, you know... Especially when it's this quiet.",
+    "Of course! I'd be glad to help you write your first poem. Don't worry about making it perfect. "
+    "Just write about something you care about, and the words will come. That's what Dr. Seuss said, more or less.",
+    "\"Are you okay? You look a bit tired...\" Please take care of yourself, alright? "
+    "I don't want you to stay up until 3.30 a.m. again just because of the festival.",
+]
+PROMPTS = ["Hi Monika!", "Do you like poetry?", "What should I write about?", "See you tomorrow."]
+
+
+def timed(function: Callable[[], Any], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    # The fastest run is the least disturbed by the rest of the machine
+    return 1000 * min(times)
+
+
+def parse_resolution(resolution: str) -> ScreenSize:
+    width, height = resolution.lower().split("x")
+    return int(width), int(height)
+
+
+def benchmark_render(resolution: ScreenSize, repeat: int) -> Dict[str, float]:
+    game = Game(screen_size=resolution)
+    chat_box = game.chat_box
+    # The prefetch would compete for the CPU with the measurements
+    game.assets.close()
+    results = {}
+
+    responses = iter(range(sys.maxsize))
+
+    def set_text():
+        # A text the layout cache has not seen, as every new response is
+        index = next(responses)
+        chat_box.set_text(f"{RESPONSES[index % len(RESPONSES)]} ({index})")
+
+    results["set_text_ms"] = timed(set_text, repeat)
+
+    chat_box.set_text(RESPONSES[0])
+    line = chat_box._chat_lines()[0]
+    for cache in (False, True):
+        name = "draw_text_with_outline_cached_ms" if cache else "draw_text_with_outline_ms"
+        results[name] = timed(lambda: chat_box._draw_text_with_outline(
+            line.text, line.pos, game.screen, chat_box.chat_font, chat_box.text_outline_size,
+            chat_box.chat_text_inner_color, chat_box.chat_text_outer_color, cache=cache,
+        ), repeat)
+
+    def render_full():
+        game.request_full_redraw()
+        game.render()
+
+    results["render_full_ms"] = timed(render_full, repeat)
+
+    # The typewriter at 60 frames per second, a new response whenever the chunk is typed
+    ticks = iter(range(0, sys.maxsize, 16))
+    chat_box.set_text(RESPONSES[1])
+    chat_box.update(next(ticks))
+    game.render()
+
+    def render_typing():
+        if chat_box.is_chunk_finished():
+            set_text()
+        chat_box.update(next(ticks))
+        game.render()
+
+    results["render_typing_ms"] = timed(render_typing, repeat)
+
+    chat_box.finish_text()
+    game.render()
+    results["render_idle_ms"] = timed(game.render, repeat)
+
+    # Every variant is in memory, as after the prefetch, and picked in the same order on every run
+    random.seed(0)
+    character = game.character
+    for image_paths in character.emotions.values():
+        for image_path in image_paths:
+            game.assets.load(image_path, character.image_size)
+    moods = iter(range(sys.maxsize))
+    emotions = character.available_emotions
+    results["set_mood_ms"] = timed(lambda: character.set_mood(emotions[next(moods) % len(emotions)]), repeat)
+
+    game.inference_worker.stop(timeout=1.0)
+    return results
+
+
+def benchmark_sentence_splitter(repeat: int) -> Dict[str, float]:
+    splitter = SentenceSplitter()
+    text = " ".join(RESPONSES) * 50
+    return {
+        "responses_ms": timed(lambda: splitter.split_batch(RESPONSES), repeat),
+        "long_text_ms": timed(lambda: splitter(text), repeat),
+    }
+
+
+def benchmark_llm(turns: int, max_new_tokens: int) -> Dict[str, float]:
+    from benchmarks.stub_model import load_stub_model
+    from src.llm.chat_gemma2 import ChatGemma2
+
+    character_path = "resources/images/character/monika/"
+    emotions = sorted(f for f in os.listdir(character_path) if os.path.isdir(os.path.join(character_path, f)))
+    llm = ChatGemma2("Monika", "Akriel", emotions)
+    load_stub_model(llm, max_new_tokens=max_new_tokens)
+
+    turn_times = []
+    first_text_times = []
+    characters = 0
+    for turn in range(turns):
+        start = time.perf_counter()
+        first_text = []
+
+        def on_response_text(text: str):
+            if not first_text:
+                first_text.append(time.perf_counter() - start)
+
+        answer = llm.generate_answer(PROMPTS[turn % len(PROMPTS)], on_response_text=on_response_text)
+        turn_times.append(time.perf_counter() - start)
+        first_text_times.append(first_text[0] if first_text else turn_times[-1])
+        characters += len(answer["response"])
+
+    return {
+        "turn_ms": 1000 * statistics.median(turn_times),
+        "first_text_ms": 1000 * statistics.median(first_text_times),
+        "characters_per_second": characters / sum(turn_times),
+    }
+
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    metrics = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            metrics.update(flatten(value, f"{prefix}{name}/"))
+        else:
+            metrics[f"{prefix}{name}"] = value
+    return metrics
+
+
+def compare_with_baseline(
+        metrics: Dict[str, float],
+        baseline: Dict[str, float],
+        tolerance: float,
+        min_difference_ms: float = 0.1
+) -> List[Dict[str, Any]]:
+    """
+    Compare every metric with the baseline, a time is worse when higher and a speed when lower.
+
+    Times of a few microseconds are mostly noise, a time only regresses
+    when it is also slower by more than `min_difference_ms`.
+
+    Returns
+    -------
+    list[dict[str, Any]]
+        The metrics found in both, with their "ratio" to the baseline and
+        whether they "regressed" by more than the tolerance.
+    """
+
+    comparisons = []
+    for name, value in metrics.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+
+        ratio = value / reference
+        if name.endswith("_ms"):
+            regressed = ratio > 1 + tolerance and value - reference > min_difference_ms
+        else:
+            regressed = ratio < 1 / (1 + tolerance)
+        comparisons.append({
+            "metric": name,
+            "value": value,
+            "baseline": reference,
+            "ratio": ratio,
+            "regressed": regressed,
+        })
+    return comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolutions", nargs="+", default=RESOLUTIONS)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--skip-llm", action="store_true", help="Do not run the chat with the stub model")
+    parser.add_argument("--llm-turns", type=int, default=4)
+    parser.add_argument("--max-new-tokens", type=int, default=48)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="The results to compare with")
+    parser.add_argument("--update-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="How much slower than the baseline a metric may be, 0.5 is 50%%")
+    parser.add_argument("--min-difference-ms", type=float, default=0.1,
+                        help="Smaller differences of a time are noise, never a regression")
+    args = parser.parse_args()
+
+    results: Dict[str, Any] = {"render": {}}
+    for resolution in args.resolutions:
+        results["render"][resolution] = benchmark_render(parse_resolution(resolution), args.repeat)
+    results["sentence_splitter"] = benchmark_sentence_splitter(args.repeat)
+    if not args.skip_llm:
+        results["llm_stub"] = benchmark_llm(args.llm_turns, args.max_new_tokens)
+    pygame.quit()
+
+    metrics = {name: round(value, 4) for name, value in flatten(results).items()}
+    for name, value in metrics.items():
+        print(f"{name:<56} {value:>10.3f}")
+
+    report: Dict[str, Any] = {
+        "environment": {
+            "python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+        },
+        "metrics": metrics,
+    }
+
+    baseline: Optional[Dict[str, float]] = None
+    if not args.update_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["metrics"]
+
+    regressions = []
+    if baseline is not None:
+        report["comparison"] = compare_with_baseline(
+            metrics, baseline, args.tolerance, args.min_difference_ms
+        )
+        regressions = [comparison for comparison in report["comparison"] if comparison["regressed"]]
+        print(f"Compared with {args.baseline}: {len(report['comparison'])} metrics, {len(regressions)} regressed")
+        for comparison in regressions:
+            print(f"  {comparison['metric']}: {comparison['value']:.3f}, "
+                  f"baseline {comparison['baseline']:.3f} ({comparison['ratio']:.2f}x)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
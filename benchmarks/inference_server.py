@@ -0,0 +1,170 @@
+"""
+Load test of the inference server: throughput and latency as the number of sessions grows.
+
+For every number of sessions, that many clients open a session and play
+the same number of turns at the same time, each waiting for its answer
+before sending the next message. It reports the answers per second, the
+generated tokens per second, the p50 and p99 latency of a turn and of its
+first streamed text, and how many sessions the server decoded per forward
+pass on average. Run from the root of the repository:
+
+    python -m benchmarks.inference_server
+    python -m benchmarks.inference_server --sessions 1 2 4 8 16 --max-batch-size 8
+    python -m benchmarks.inference_server --url http://127.0.0.1:8765
+
+By default a server with the deterministic stub model is started in this
+process, --url tests a running server instead, e.g. with the real model.
+"""
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+from typing import List, Dict, Any
+
+from src.llm.remote_chat import RemoteChatGemma2
+
+
+PROMPTS = [
+    "Hi Monika! How are you doing today?",
+    "Do you like poetry? What kind of poems do you write?",
+    "What should I write about for the festival?",
+    "See you tomorrow at the club!",
+]
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(fraction * len(values)) - 1))
+    return values[index]
+
+
+def start_stub_server(max_batch_size: int, max_new_tokens: int):
+    from benchmarks.stub_model import load_stub_model
+    from src.llm.chat_gemma2 import ChatGemma2
+    from src.llm.inference_server import InferenceServer
+
+    llm = ChatGemma2("Monika", "Player", ["happy"], mood_detector="lexicon")
+    load_stub_model(llm, max_new_tokens=max_new_tokens)
+    server = InferenceServer(llm, port=0, max_batch_size=max_batch_size)
+    server.start()
+    server.load()
+    return server
+
+
+def server_stats(client: RemoteChatGemma2) -> Dict[str, Any]:
+    return client._request("GET", "/stats")["generator"]
+
+
+def run_load(url: str, sessions: int, turns: int, emotions: List[str], mood_detector: str) -> Dict[str, Any]:
+    clients = [
+        RemoteChatGemma2("Monika", f"Player {index}", emotions, mood_detector, url=url)
+        for index in range(sessions)
+    ]
+    for client in clients:
+        client.post_init()
+
+    turn_latencies = []
+    first_text_latencies = []
+    errors = []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(sessions)
+
+    def play(client: RemoteChatGemma2):
+        start_barrier.wait()
+        for turn in range(turns):
+            start = time.perf_counter()
+            first_text = []
+
+            def on_response_text(text: str):
+                if not first_text:
+                    first_text.append(time.perf_counter() - start)
+
+            try:
+                client.generate_answer(PROMPTS[turn % len(PROMPTS)], on_response_text=on_response_text)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+
+            latency = time.perf_counter() - start
+            with lock:
+                turn_latencies.append(latency)
+                first_text_latencies.append(first_text[0] if first_text else latency)
+
+    before = server_stats(clients[0])
+    threads = [threading.Thread(target=play, args=(client,)) for client in clients]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    after = server_stats(clients[0])
+
+    for client in clients:
+        client.close()
+
+    decoded_tokens = after["decoded_tokens"] - before["decoded_tokens"]
+    decode_steps = after["decode_steps"] - before["decode_steps"]
+    return {
+        "sessions": sessions,
+        "answers": len(turn_latencies),
+        "errors": errors,
+        "seconds": seconds,
+        "answers_per_second": len(turn_latencies) / seconds,
+        "tokens_per_second": decoded_tokens / seconds,
+        "mean_batch_size": decoded_tokens / decode_steps if decode_steps else 0.0,
+        "turn_p50_ms": 1000 * statistics.median(turn_latencies) if turn_latencies else None,
+        "turn_p99_ms": 1000 * percentile(turn_latencies, 0.99) if turn_latencies else None,
+        "first_text_p50_ms": 1000 * statistics.median(first_text_latencies) if first_text_latencies else None,
+        "first_text_p99_ms": 1000 * percentile(first_text_latencies, 0.99) if first_text_latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="A running inference server, by default one with the stub model is started")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--turns", type=int, default=4, help="Turns played by every session")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Of the stub server")
+    parser.add_argument("--max-new-tokens", type=int, default=48, help="Of the stub server")
+    parser.add_argument("--mood-detector", default="llm", choices=["llm", "lexicon"])
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server = start_stub_server(args.max_batch_size, args.max_new_tokens)
+        url = server.url
+
+    character_path = "resources/images/character/monika/"
+    emotions = sorted(f for f in os.listdir(character_path) if os.path.isdir(os.path.join(character_path, f)))
+
+    results = []
+    print(f"{'sessions':>8} {'answers/s':>10} {'tokens/s':>10} {'batch':>6} "
+          f"{'p50 ms':>9} {'p99 ms':>9} {'first p50':>10} {'first p99':>10}")
+    try:
+        for sessions in args.sessions:
+            result = run_load(url, sessions, args.turns, emotions, args.mood_detector)
+            results.append(result)
+            print(
+                f"{sessions:>8} {result['answers_per_second']:>10.2f} {result['tokens_per_second']:>10.1f} "
+                f"{result['mean_batch_size']:>6.2f} {result['turn_p50_ms']:>9.1f} {result['turn_p99_ms']:>9.1f} "
+                f"{result['first_text_p50_ms']:>10.1f} {result['first_text_p99_ms']:>10.1f}"
+            )
+            for error in result["errors"]:
+                print(f"  error: {error}")
+    finally:
+        if server is not None:
+            server.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
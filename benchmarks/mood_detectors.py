@@ -0,0 +1,107 @@
+"""
+Compare the mood detectors on agreement and latency.
+
+The LLM detector is the reference, every other detector is scored by how
+often it picks the same emotion. Run from the root of the repository:
+
+    python -m benchmarks.mood_detectors --detectors llm lexicon
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from typing import List, Dict
+
+from src.llm.chat_gemma2 import ChatGemma2
+
+
+SAMPLE_RESPONSES = [
+    "Ahaha, I'm so happy you came to the club today! We're going to have so much fun together.",
+    "I love that poem! Thank you for sharing it with me, it really made me smile.",
+    "Ugh, that is so annoying. I really hate it when people don't take the club seriously.",
+    "Are you okay? You look a bit tired... Please take care of yourself, alright?",
+    "Hmm, I'm not sure I understand what you mean. Could you explain it again?",
+    "W-well, I didn't expect you to say something so sweet... You're making me blush!",
+    "Sometimes I feel like this whole world is just code... Like the files could be deleted at any moment.",
+    "It's a nice day. I think I'll read for a bit before the others arrive.",
+    "I miss talking to everyone. It gets pretty lonely when the club room is empty.",
+    "Listen, this is important. You have to promise me that you'll be honest with me.",
+    "What?! No way, that's horrible! I can't believe that actually happened!",
+    "Oh, wow! I really didn't expect that. What a surprise!",
+    "Of course! I'd be glad to help you write your first poem.",
+    "I'm sorry, I didn't mean to hurt your feelings. I wish I could take it back.",
+    "Honestly, I think we should talk about the festival. We need a plan.",
+    "Huh? Why would you ask something like that? That's a strange question.",
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q * (len(values) - 1))))
+    return values[index]
+
+
+def benchmark_detector(llm: ChatGemma2, texts: List[str], repeat: int) -> Dict[str, object]:
+    moods = []
+    latencies = []
+    for text in texts:
+        for i in range(repeat):
+            start = time.perf_counter()
+            mood = llm._identify_mood(text)
+            latencies.append((time.perf_counter() - start) * 1000)
+        moods.append(mood)
+
+    return {
+        "moods": moods,
+        "latency_ms": {
+            "mean": statistics.mean(latencies),
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--detectors", nargs="+", default=["llm", "lexicon"])
+    parser.add_argument("--texts", help="A text file with one response per line, instead of the built-in samples")
+    parser.add_argument("--repeat", type=int, default=3, help="How many times every text is scored")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    texts = SAMPLE_RESPONSES
+    if args.texts:
+        with open(args.texts) as f:
+            texts = [line.strip() for line in f if line.strip()]
+
+    character_path = "resources/images/character/monika/"
+    emotions = sorted(f for f in os.listdir(character_path) if os.path.isdir(os.path.join(character_path, f)))
+    llm = ChatGemma2("Monika", "Akriel", emotions)
+
+    results = {}
+    for detector in args.detectors:
+        llm.set_mood_detector(detector)
+        if llm.mood_detector.uses_model and not llm.is_model_loaded:
+            llm.post_init()
+        results[detector] = benchmark_detector(llm, texts, args.repeat)
+
+    reference = results.get("llm")
+    print(f"{'detector':<10} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'agreement':>10}")
+    for detector, result in results.items():
+        agreement = float("nan")
+        if reference is not None:
+            matches = sum(a == b for a, b in zip(result["moods"], reference["moods"]))
+            agreement = matches / len(texts)
+        result["agreement"] = agreement
+
+        latency = result["latency_ms"]
+        print(f"{detector:<10} {latency['mean']:>9.3f} {latency['p50']:>9.3f} {latency['p95']:>9.3f} {agreement:>10.2%}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"texts": texts, "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of the outlined text renderer against the old re-render loop.
+
+Every line is rendered with both methods, the largest alpha and color
+differences between the surfaces are reported with the time per line. Run from the root of the
+repository:
+
+    python -m benchmarks.outlined_text
+"""
+import argparse
+import os
+import time
+from typing import Tuple
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import numpy as np
+import pygame
+from pygame import Surface
+
+from src.sprites.outlined_text import render_outlined_text
+
+
+LINES = [
+    "\"Hi, I'm Monika, the president of the Literature Club! ",
+    "You must be Akriel? I am so happy to meet you!\" ",
+    "Do you like poetry? I think it's a wonderful way to ",
+    "Monika",
+    "Akriel",
+]
+
+
+def render_outlined_text_legacy(
+        text: str,
+        font: pygame.font.Font,
+        outline_size: int,
+        inner_color: Tuple[int, int, int],
+        outer_color: Tuple[int, int, int],
+) -> Surface:
+    # The renderer ChatBox used before, one render and blit for every outline offset
+    text_surface = font.render(text, True, inner_color)
+    outline_surface = pygame.Surface(
+        (text_surface.get_width() + outline_size * 2, text_surface.get_height() + outline_size * 2), pygame.SRCALPHA)
+    for dx in range(-outline_size, outline_size + 1):
+        for dy in range(-outline_size, outline_size + 1):
+            outline_surface.blit(font.render(text, True, outer_color), (dx + outline_size, dy + outline_size))
+    outline_surface.blit(text_surface, (outline_size, outline_size))
+    return outline_surface
+
+
+def max_difference(a: np.ndarray, b: np.ndarray) -> int:
+    return int(np.abs(a.astype(np.int32) - b.astype(np.int32)).max())
+
+
+def time_per_line(render, font: pygame.font.Font, outline_size: int, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in LINES:
+            render(line, font, outline_size, (250, 250, 250), (92, 56, 73))
+    return (time.perf_counter() - start) / (repeat * len(LINES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+
+    fonts = [
+        ("chat", pygame.font.Font("resources/fonts/Aller_Rg.ttf", 30), 2),
+        ("name", pygame.font.Font("resources/fonts/RifficFree-Bold.ttf", 36), 3),
+    ]
+    for name, font, outline_size in fonts:
+        alpha_difference = color_difference = 0
+        for line in LINES:
+            legacy = render_outlined_text_legacy(line, font, outline_size, (250, 250, 250), (92, 56, 73))
+            current = render_outlined_text(line, font, outline_size, (250, 250, 250), (92, 56, 73))
+            assert legacy.get_size() == current.get_size()
+            alpha_difference = max(alpha_difference, max_difference(
+                pygame.surfarray.array_alpha(legacy), pygame.surfarray.array_alpha(current)))
+            color_difference = max(color_difference, max_difference(
+                pygame.surfarray.array3d(legacy), pygame.surfarray.array3d(current)))
+
+        legacy_time = time_per_line(render_outlined_text_legacy, font, outline_size, args.repeat)
+        current_time = time_per_line(render_outlined_text, font, outline_size, args.repeat)
+        print(
+            f"{name} (outline {outline_size}): legacy {legacy_time * 1000:.3f} ms/line, "
+            f"current {current_time * 1000:.3f} ms/line, {legacy_time / current_time:.1f}x faster, "
+            f"max alpha difference {alpha_difference}, max color difference {color_difference}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Replays recorded conversations through ChatGemma2.generate_answer and reports the latency of every stage.
+
+Record traces by playing with the TRACE_PATH environment variable set,
+then replay them with every build to compare, from the root of the
+repository:
+
+    TRACE_PATH=traces/evening.jsonl python main.py
+    python -m benchmarks.replay traces/*.jsonl --output build-a.json
+    python -m benchmarks.replay traces/*.jsonl --baseline build-a.json
+
+Every recorded session is replayed in its own chat session, turn after
+turn without the pauses of the player. Only the answered turns are sent,
+the others never made it into the history. The deterministic stub model
+is used by default, --real loads Gemma 2 and seeds every turn with
+--seed, so two builds sample the same answers. For every stage the mean,
+p50, p90, p99 and max are reported:
+
+    end_to_end              the generate_answer call
+    first_text              until the first streamed text
+    tokenize                rendering and tokenizing the prompt
+    time_to_first_token     prefill and first token
+    generate                the whole generation
+    mood                    identifying the mood
+    decode_tokens_per_second
+
+With --baseline, the exit code is 1 when a metric is slower than the
+baseline by more than the tolerance.
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+from typing import List, Dict, Any, Optional
+
+from benchmarks.headless import compare_with_baseline
+from benchmarks.inference_server import percentile
+from src.llm.conversation_trace import load_traces
+
+
+STAGES = ["end_to_end_ms", "first_text_ms", "tokenize_ms", "time_to_first_token_ms", "generate_ms", "mood_ms"]
+SPEEDS = ["decode_tokens_per_second"]
+
+
+def load_backend(real: bool, max_new_tokens: Optional[int]):
+    from src.llm.chat_gemma2 import ChatGemma2
+
+    # Only holds the model, every recorded session gets its own `new_session`
+    llm = ChatGemma2("Monika", "Player", ["happy"], mood_detector="lexicon")
+    if real:
+        llm.post_init()
+    else:
+        from benchmarks.stub_model import load_stub_model
+        load_stub_model(llm)
+    if max_new_tokens is not None:
+        llm.generate_response_kwargs["max_new_tokens"] = max_new_tokens
+    return llm
+
+
+def replay_session(
+        llm,
+        session: Dict[str, Any],
+        seed: int,
+        mood_detector: Optional[str],
+        max_turns: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    from transformers import set_seed
+
+    chat = llm.new_session(
+        session["character_name"], session["player_name"], session["emotion_list"],
+        mood_detector or session["mood_detector"],
+    )
+    turns = [turn for turn in session["turns"] if turn["status"] == "done"][:max_turns]
+
+    results = []
+    for index, turn in enumerate(turns):
+        set_seed(seed + index)
+        first_text = []
+        start = time.perf_counter()
+
+        def on_response_text(text: str):
+            if not first_text:
+                first_text.append(time.perf_counter() - start)
+
+        answer = chat.generate_answer(turn["prompt"], on_response_text=on_response_text)
+        end_to_end = time.perf_counter() - start
+
+        stats = chat.last_turn_stats
+        results.append({
+            "prompt": turn["prompt"],
+            "response": answer["response"],
+            "same_response": answer["response"] == turn["response"],
+            "end_to_end_ms": 1000 * end_to_end,
+            "first_text_ms": 1000 * (first_text[0] if first_text else end_to_end),
+            **{name: stats.get(name) for name in STAGES[2:] + SPEEDS + ["prompt_tokens", "new_tokens"]},
+        })
+    return results
+
+
+def summarize(turns: List[Dict[str, Any]]) -> Dict[str, float]:
+    metrics = {}
+    for name in STAGES + SPEEDS:
+        values = [turn[name] for turn in turns if turn[name] is not None]
+        if not values:
+            continue
+        # Times end with _ms so the comparison with the baseline knows lower is better
+        prefix, suffix = (name[:-len("_ms")], "_ms") if name.endswith("_ms") else (name, "")
+        metrics[f"{prefix}_mean{suffix}"] = statistics.fmean(values)
+        for fraction in (0.5, 0.9, 0.99):
+            metrics[f"{prefix}_p{round(100 * fraction)}{suffix}"] = percentile(values, fraction)
+        metrics[f"{prefix}_max{suffix}"] = max(values)
+    return {name: round(value, 4) for name, value in metrics.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("traces", nargs="+", help="Trace files recorded by the game")
+    parser.add_argument("--real", action="store_true", help="Load Gemma 2 instead of the stub model")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first turn of every session")
+    parser.add_argument("--max-new-tokens", type=int, help="Overrides the setting of the model")
+    parser.add_argument("--max-turns", type=int, help="Replay at most this many turns of every session")
+    parser.add_argument("--mood-detector", choices=["llm", "lexicon"], help="Overrides the recorded one")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="The results of another build to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="How much slower than the baseline a metric may be, 0.2 is 20%%")
+    parser.add_argument("--min-difference-ms", type=float, default=1.0,
+                        help="Smaller differences of a time are noise, never a regression")
+    args = parser.parse_args()
+
+    sessions = [session for path in args.traces for session in load_traces(path)]
+    if not sessions:
+        print("No answered turns in the traces")
+        sys.exit(1)
+
+    llm = load_backend(args.real, args.max_new_tokens)
+    if not args.real:
+        # The first generation pays for one-time allocations, as the warm-up of post_init does for the real model
+        replay_session(llm, sessions[0], args.seed, args.mood_detector, max_turns=1)
+
+    turns = []
+    for session in sessions:
+        turns += replay_session(llm, session, args.seed, args.mood_detector, args.max_turns)
+
+    metrics = summarize(turns)
+    for name, value in metrics.items():
+        print(f"{name:<40} {value:>10.3f}")
+
+    workload = {
+        "sessions": len(sessions),
+        "turns": len(turns),
+        "prompt_tokens": sum(turn["prompt_tokens"] or 0 for turn in turns),
+        "new_tokens": sum(turn["new_tokens"] or 0 for turn in turns),
+        "same_responses": sum(turn["same_response"] for turn in turns),
+    }
+    print(f"Replayed {workload['turns']} turns of {workload['sessions']} sessions, "
+          f"{workload['prompt_tokens']} prompt and {workload['new_tokens']} new tokens, "
+          f"{workload['same_responses']} responses as recorded")
+
+    report: Dict[str, Any] = {
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "backend": "real" if args.real else "stub",
+            "inference_mode": llm.inference_mode,
+            "seed": args.seed,
+        },
+        "workload": workload,
+        "metrics": metrics,
+        "turns": turns,
+    }
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["workload"]["turns"] != workload["turns"]:
+            print(f"The baseline replayed {baseline['workload']['turns']} turns, not the same traces")
+        report["comparison"] = compare_with_baseline(
+            metrics, baseline["metrics"], args.tolerance, args.min_difference_ms
+        )
+        regressions = [comparison for comparison in report["comparison"] if comparison["regressed"]]
+        print(f"Compared with {args.baseline}: {len(report['comparison'])} metrics, {len(regressions)} regressed")
+        for comparison in regressions:
+            print(f"  {comparison['metric']}: {comparison['value']:.3f}, "
+                  f"baseline {comparison['baseline']:.3f} ({comparison['ratio']:.2f}x)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""
+Equivalence check and throughput of the sentence splitter against the old substitution chain.
+
+Random texts made of abbreviations, acronyms, numbers, websites, dots,
+quotes and whitespace are split by the old splitter, by the current one
+at once and by the incremental one fed in random pieces, and every result
+must be the same. Then the time to split long texts is reported, for the
+whole text and for a text streamed token by token. Run from the root of
+the repository:
+
+    python -m benchmarks.sentence_split --cases 20000
+
+The exit code is 1 when a result differs from the old splitter.
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import time
+from typing import List, Callable, Dict, Any
+
+from src.text_utils.sentence_split import SentenceSplitter, IncrementalSentenceSplitter
+
+
+class LegacySentenceSplitter:
+    # The splitter before it was compiled, one substitution of the whole text for every rule
+    def __init__(self):
+        self.alphabets = "([A-Za-z])"
+        self.prefixes = "(Mr|St|Mrs|Ms|Dr)[.]"
+        self.suffixes = "(Inc|Ltd|Jr|Sr|Co)"
+        self.starters = (r"(Mr|Mrs|Ms|Dr|Prof|Capt|Cpt|Lt|He\s|She\s|It\s|They\s|Their\s|"
+                         r"Our\s|We\s|But\s|However\s|That\s|This\s|Wherever)")
+        self.acronyms = "([A-Z][.][A-Z][.](?:[A-Z][.])?)"
+        self.websites = "[.](com|net|org|io|gov|edu|me)"
+        self.digits = "([0-9])"
+        self.multiple_dots = r'\.{2,}'
+
+    def __call__(self, text: str) -> List[str]:
+        text = " " + text + "  "
+        text = text.replace("\n", " ")
+        text = re.sub(self.prefixes, "\\1<prd>", text)
+        text = re.sub(self.websites, "<prd>\\1", text)
+        text = re.sub(self.digits + "[.]" + self.digits, "\\1<prd>\\2", text)
+        text = re.sub(self.multiple_dots, lambda match: "<prd>" * len(match.group(0)) + "<stop>", text)
+        if "Ph.D" in text:
+            text = text.replace("Ph.D.", "Ph<prd>D<prd>")
+        text = re.sub(r"\s" + self.alphabets + "[.] ", " \\1<prd> ", text)
+        text = re.sub(self.acronyms + " " + self.starters, "\\1<stop> \\2", text)
+        text = re.sub(self.alphabets + "[.]" + self.alphabets + "[.]" + self.alphabets + "[.]",
+                      "\\1<prd>\\2<prd>\\3<prd>", text)
+        text = re.sub(self.alphabets + "[.]" + self.alphabets + "[.]", "\\1<prd>\\2<prd>", text)
+        text = re.sub(" " + self.suffixes + "[.] " + self.starters, " \\1<stop> \\2", text)
+        text = re.sub(" " + self.suffixes + "[.]", " \\1<prd>", text)
+        text = re.sub(" " + self.alphabets + "[.]", " \\1<prd>", text)
+        if "”" in text:
+            text = text.replace(".”", "”.")
+        if "\"" in text:
+            text = text.replace(".\"", "\".")
+        if "!" in text:
+            text = text.replace("!\"", "\"!")
+        if "?" in text:
+            text = text.replace("?\"", "\"?")
+        text = text.replace(".", ".<stop>")
+        text = text.replace("?", "?<stop>")
+        text = text.replace("!", "!<stop>")
+        text = text.replace("<prd>", ".")
+        sentences = text.split("<stop>")
+        sentences = [s.strip() for s in sentences]
+        if sentences and not sentences[-1]:
+            sentences = sentences[:-1]
+        return sentences
+
+
+TOKENS = [
+    "Mr.", "Dr.", "Mrs.", "Ms.", "St.", "U.S.", "U.S.A.", "B.A.", "e.g.", "i.e.", "Ph.D.", "1.2.3", "3.14",
+    "...", "..", ".", "!", "?", "!!", "?!", "\"", "“", "”", ".\"", "?\"", "!\"", ".”", "...\"",
+    "example.com", "site.io", "Inc.", "Ltd.", "Jr.", "Co.", "a.", "x.", "A.", "I", "a", "5",
+    "He", "She", "It", "They", "We", "Our", "But", "However", "This", "Wherever", "Prof", "Capt",
+    "word", "hello", "poetry", "club",
+]
+SEPARATORS = [" ", " ", " ", "", "\n", "\t"]
+
+# Dialogue as the character writes it, and a text with an abbreviation, number or website in every sentence
+TEXTS = {
+    "dialogue": (
+        "\"Hi, I'm Monika, the president of the Literature Club! You must be Akriel? I am so happy to meet you!\" "
+        "Do you like poetry? I think it's a wonderful way to express what you feel, even when it is hard to say "
+        "out loud. We could read something together after the meeting, if you want. "
+    ),
+    "abbreviations": (
+        "Mr. Smith met Dr. Jones at 3.30 p.m. in the U.S. He said the club.com site was down... "
+        "But it was fine by the evening. They read poems by E. E. Cummings and a Ph.D. thesis from Acme Inc. "
+        "However the rain kept going, so we stayed inside. \"Isn't it lovely?\" she asked. "
+    ),
+}
+
+
+def random_text(rng: random.Random) -> str:
+    return "".join(rng.choice(TOKENS) + rng.choice(SEPARATORS) for _ in range(rng.randint(0, 40)))
+
+
+def split_in_pieces(text: str, rng: random.Random) -> List[str]:
+    pieces = []
+    while text:
+        size = rng.randint(1, 12)
+        pieces.append(text[:size])
+        text = text[size:]
+    return pieces
+
+
+def split_incrementally(pieces: List[str]) -> List[str]:
+    splitter = IncrementalSentenceSplitter()
+    sentences = []
+    for piece in pieces:
+        sentences += splitter.feed(piece)
+    return sentences + splitter.flush()
+
+
+def check_equivalence(cases: int, seed: int) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    legacy, current = LegacySentenceSplitter(), SentenceSplitter()
+    mismatches = []
+    texts = [random_text(rng) for _ in range(cases)]
+    expected = [legacy(text) for text in texts]
+
+    for text, sentences in zip(texts, current.split_batch(texts)):
+        if sentences != legacy(text):
+            mismatches.append({"mode": "batch", "text": text})
+    for text, sentences in zip(texts, expected):
+        if split_incrementally(split_in_pieces(text, rng)) != sentences:
+            mismatches.append({"mode": "incremental", "text": text})
+
+    return {"cases": cases, "mismatches": len(mismatches), "examples": mismatches[:5]}
+
+
+def best_time(function: Callable[[], Any], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def measure_throughput(paragraph: str, paragraphs: int, repeat: int) -> Dict[str, Any]:
+    text = paragraph * paragraphs
+    # A streamed response grows by about 4 characters per token
+    tokens = [text[i:i + 4] for i in range(0, len(text), 4)]
+    legacy, current = LegacySentenceSplitter(), SentenceSplitter()
+    assert legacy(text) == current(text) == split_incrementally(tokens)
+
+    results = {
+        "characters": len(text),
+        "legacy_ms": 1000 * best_time(lambda: legacy(text), repeat),
+        "current_ms": 1000 * best_time(lambda: current(text), repeat),
+        "incremental_ms": 1000 * best_time(lambda: split_incrementally(tokens), repeat),
+    }
+
+    # How ChatBox used to follow a stream: the whole text so far split again on every token
+    stream = text[:4000]
+    stream_tokens = [stream[i:i + 4] for i in range(0, len(stream), 4)]
+    results["stream_characters"] = len(stream)
+    results["legacy_stream_ms"] = 1000 * best_time(
+        lambda: [legacy(stream[:i + 4]) for i in range(0, len(stream), 4)], 1)
+    results["incremental_stream_ms"] = 1000 * best_time(lambda: split_incrementally(stream_tokens), repeat)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", type=int, default=20000, help="Random texts checked against the old splitter")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--paragraphs", type=int, default=200, help="Length of the long text in paragraphs")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {
+        "equivalence": check_equivalence(args.cases, args.seed),
+        "throughput": {
+            name: measure_throughput(paragraph, args.paragraphs, args.repeat) for name, paragraph in TEXTS.items()
+        },
+    }
+
+    equivalence = results["equivalence"]
+    print(f"{equivalence['cases']} random texts, {equivalence['mismatches']} differ from the old splitter")
+    for example in equivalence["examples"]:
+        print(f"  {example['mode']}: {example['text']!r}")
+
+    for name, throughput in results["throughput"].items():
+        print(f"{name}, {throughput['characters']} characters:")
+        print(f"  legacy       {throughput['legacy_ms']:8.2f} ms")
+        print(f"  current      {throughput['current_ms']:8.2f} ms")
+        print(f"  incremental  {throughput['incremental_ms']:8.2f} ms (fed 4 characters at a time)")
+        print(f"  first {throughput['stream_characters']} characters streamed 4 per token:")
+        print(f"    legacy, whole text split on every token  {throughput['legacy_stream_ms']:8.1f} ms")
+        print(f"    incremental                              {throughput['incremental_stream_ms']:8.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    sys.exit(1 if equivalence["mismatches"] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+Profile the startup of the game and check it against a time budget.
+
+Three numbers are measured, each in a fresh interpreter: the import time of
+the game broken down by top-level package, the time until the first frame
+is on screen and, with --model-timeout, the time until the model is ready.
+The game runs headless, so it works in CI. Run from the root of the
+repository:
+
+    python -m benchmarks.startup_profile --max-import-ms 1000 --max-first-frame-ms 3000
+
+The exit code is 1 when a budget is exceeded.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import List, Dict, Any, Optional
+
+
+RESULT_MARKER = "STARTUP_PROFILE "
+
+
+def headless_env() -> Dict[str, str]:
+    env = dict(os.environ)
+    env.setdefault("SDL_VIDEODRIVER", "dummy")
+    env.setdefault("SDL_AUDIODRIVER", "dummy")
+    return env
+
+
+def import_breakdown(module: str = "src.game", top: int = 10) -> List[Dict[str, Any]]:
+    """
+    Import the module with -X importtime and sum the import time of every module by top-level package.
+    """
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=headless_env(),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    packages = defaultdict(float)
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        # The self time excludes the nested imports, so every module is counted once
+        self_us, _, name = line[len("import time:"):].split("|")
+        packages[name.strip().split(".")[0]] += int(self_us) / 1000
+
+    breakdown = sorted(packages.items(), key=lambda item: -item[1])
+    return [{"package": package, "ms": round(ms, 1)} for package, ms in breakdown[:top]]
+
+
+def profile_child(spawn_time: float, model_timeout: float):
+    # Runs in the child interpreter, everything is timed from the moment the parent spawned it
+    def since_spawn() -> float:
+        return round(1000 * (time.time() - spawn_time), 1)
+
+    profile: Dict[str, Optional[float]] = {"interpreter_ms": since_spawn()}
+    import pygame
+    from src.game import Game
+    profile["imports_ms"] = since_spawn()
+
+    game = Game()
+    profile["game_created_ms"] = since_spawn()
+    profile["first_frame_ms"] = None
+    profile["model_ready_ms"] = None
+    profile["model_error"] = None
+
+    render = game.render
+    poll_llm_answers = game.poll_llm_answers
+
+    def timed_render():
+        render()
+        if profile["first_frame_ms"] is None:
+            profile["first_frame_ms"] = since_spawn()
+
+    def timed_poll_llm_answers():
+        poll_llm_answers()
+        if game.load_error is not None and profile["model_error"] is None:
+            profile["model_error"] = game.load_error
+        if game.llm.is_model_loaded and profile["model_ready_ms"] is None:
+            profile["model_ready_ms"] = since_spawn()
+
+        waiting_for_model = (
+            model_timeout > 0
+            and profile["model_ready_ms"] is None
+            and profile["model_error"] is None
+            and since_spawn() < 1000 * model_timeout
+        )
+        if profile["first_frame_ms"] is not None and not waiting_for_model:
+            game.running = False
+
+    game.render = timed_render
+    game.poll_llm_answers = timed_poll_llm_answers
+    if model_timeout <= 0:
+        # The model is not part of this profile, the worker does not even import its backend
+        game.inference_worker.load_model = False
+
+    game.run()
+    pygame.quit()
+    print(RESULT_MARKER + json.dumps(profile), flush=True)
+
+
+def run_game_profile(model_timeout: float) -> Dict[str, Any]:
+    spawn_time = time.time()
+    result = subprocess.run(
+        [
+            sys.executable, "-m", "benchmarks.startup_profile",
+            "--child", str(spawn_time), "--model-timeout", str(model_timeout),
+        ],
+        capture_output=True, text=True, env=headless_env(),
+    )
+    for line in result.stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+
+    raise RuntimeError(f"The game did not report its startup profile:\n{result.stdout}\n{result.stderr}")
+
+
+def check_budgets(results: Dict[str, Any], budgets: Dict[str, Optional[float]]) -> List[str]:
+    failures = []
+    for name, budget in budgets.items():
+        if budget is None:
+            continue
+
+        value = results["game"].get(name)
+        if value is None:
+            failures.append(f"{name} was not measured, budget {budget:.0f} ms")
+        elif value > budget:
+            failures.append(f"{name} is {value:.0f} ms, budget {budget:.0f} ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-timeout", type=float, default=0.0,
+                        help="Seconds to wait for the model to be ready, 0 skips loading it")
+    parser.add_argument("--max-import-ms", type=float, help="Budget for importing the game")
+    parser.add_argument("--max-first-frame-ms", type=float, help="Budget for the first frame")
+    parser.add_argument("--max-model-ready-ms", type=float, help="Budget for the model to be ready")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--child", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        profile_child(args.child, args.model_timeout)
+        return
+
+    results = {"imports": import_breakdown(), "game": run_game_profile(args.model_timeout)}
+
+    print("Import time by package:")
+    for entry in results["imports"]:
+        print(f"  {entry['package']:<24} {entry['ms']:>8.1f} ms")
+
+    game = results["game"]
+    print(f"Interpreter started after {game['interpreter_ms']:.0f} ms")
+    print(f"Game imported after       {game['imports_ms']:.0f} ms")
+    print(f"Game created after        {game['game_created_ms']:.0f} ms")
+    print(f"First frame after         {game['first_frame_ms']:.0f} ms")
+    if game["model_ready_ms"] is not None:
+        print(f"Model ready after         {game['model_ready_ms']:.0f} ms")
+    elif game["model_error"] is not None:
+        print(f"Model failed to load: {game['model_error']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failures = check_budgets(results, {
+        "imports_ms": args.max_import_ms,
+        "first_frame_ms": args.max_first_frame_ms,
+        "model_ready_ms": args.max_model_ready_ms,
+    })
+    for failure in failures:
+        print(f"Over budget: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
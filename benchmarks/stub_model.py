@@ -0,0 +1,82 @@
+"""
+A tiny deterministic stand-in for Gemma 2, to run ChatGemma2 without downloading the real model.
+
+The tokenizer has one token per printable character and the Gemma chat
+template, the model is a two-layer Gemma2ForCausalLM with seeded random
+weights. Its answers are nonsense, but the same for every run, and every
+code path of ChatGemma2 (chat template, KV caches, streaming, mood
+scoring) runs as with the real model, only much faster.
+"""
+import string
+from typing import Tuple
+
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders, Regex
+from transformers import PreTrainedTokenizerFast, Gemma2Config, Gemma2ForCausalLM
+
+from src.llm.chat_gemma2 import ChatGemma2
+
+
+GEMMA_CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}"
+    "{% if (message['role'] == 'user') != (loop.index0 % 2 == 0) %}"
+    "{{ raise_exception('Conversation roles must alternate user/model/user/model/...') }}{% endif %}"
+    "{% set role = message['role'] %}"
+    "{{ '<start_of_turn>' + role + '\n' + message['content'] | trim + '<end_of_turn>\n' }}"
+    "{% endfor %}{% if add_generation_prompt %}{{'<start_of_turn>model\n'}}{% endif %}"
+)
+SPECIAL_TOKENS = ["<pad>", "<eos>", "<bos>", "<unk>", "<start_of_turn>", "<end_of_turn>"]
+
+
+def build_stub_tokenizer() -> PreTrainedTokenizerFast:
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS + list(string.printable))}
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split(Regex("."), behavior="isolated")
+    tokenizer.decoder = decoders.Fuse()
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<bos>",
+        eos_token="<eos>",
+        pad_token="<pad>",
+        unk_token="<unk>",
+        additional_special_tokens=["<start_of_turn>", "<end_of_turn>"],
+        model_input_names=["input_ids", "attention_mask"],
+    )
+    tokenizer.chat_template = GEMMA_CHAT_TEMPLATE
+    return tokenizer
+
+
+def build_stub_model(seed: int = 0) -> Tuple[Gemma2ForCausalLM, PreTrainedTokenizerFast]:
+    tokenizer = build_stub_tokenizer()
+    config = Gemma2Config(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        head_dim=16,
+        max_position_embeddings=4096,
+        sliding_window=4096,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+    )
+    torch.manual_seed(seed)
+    model = Gemma2ForCausalLM(config).eval()
+    return model, tokenizer
+
+
+def load_stub_model(llm: ChatGemma2, seed: int = 0, max_new_tokens: int = 48):
+    """
+    Give the chat the stub model instead of loading Gemma 2, with greedy decoding so its answers are reproducible.
+    """
+
+    llm.device = torch.device("cpu")
+    llm.model, llm.tokenizer = build_stub_model(seed)
+    llm.inference_mode = "stub"
+    llm.generate_response_kwargs = {"max_new_tokens": max_new_tokens, "do_sample": False}
+    if llm.mood_detector.uses_model:
+        llm._build_mood_prefix_cache()
+    llm._model_loaded = True
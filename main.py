@@ -1,8 +1,31 @@
+import os
+import sys
+
 from src.game import Game
+from src.llm.mood_detectors import MOOD_DETECTORS
 
 
 def main():
-    Game().run()
+    # Set to the address of a running src.llm.inference_server to share its model instead of loading one
+    inference_server_url = os.environ.get("INFERENCE_SERVER_URL")
+    # Set to a file to append the per-turn and per-frame performance records to, as JSON lines
+    telemetry_path = os.environ.get("TELEMETRY_PATH")
+    # Set to a file to append the conversation to, for benchmarks/replay.py
+    trace_path = os.environ.get("TRACE_PATH")
+    # Set to a file to answer repeated player messages from a cache kept there between runs
+    response_cache_path = os.environ.get("RESPONSE_CACHE_PATH")
+    # "llm" scores the emotions with the chat model, "lexicon" with a word list and no model call
+    mood_detector = os.environ.get("MOOD_DETECTOR", "llm")
+    if mood_detector not in MOOD_DETECTORS:
+        sys.exit(f"Unknown MOOD_DETECTOR {mood_detector!r}, expected one of {', '.join(MOOD_DETECTORS)}")
+
+    Game(
+        inference_server_url=inference_server_url,
+        telemetry_path=telemetry_path,
+        trace_path=trace_path,
+        mood_detector=mood_detector,
+        response_cache_path=response_cache_path,
+    ).run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+import time
+from typing import List, Dict
+
+import pygame
+
+
+class FrameScheduler:
+    """
+    Decides when the game loop renders and how long it sleeps in between.
+
+    While something on screen is moving, the loop runs at `max_fps`.
+    Otherwise it blocks on `pygame.event.wait` until an event arrives or
+    `idle_timeout_ms` passes, and nothing is rendered unless a redraw was
+    requested. The CPU time of the rendering thread is measured, so the
+    stats show how much the idle periods save.
+    """
+
+    def __init__(self, max_fps: int = 60, idle_timeout_ms: int = 250, stats_window_s: float = 1.0):
+        self.max_fps = max_fps
+        self.idle_timeout_ms = idle_timeout_ms
+        self.stats_window_s = stats_window_s
+        self.clock = pygame.time.Clock()
+
+        self._redraw_requested = True
+        self._render_start_cpu = 0.0
+
+        self._window_start = time.perf_counter()
+        self._window_start_cpu = time.thread_time()
+        self._window_frames = 0
+        self._window_render_cpu = 0.0
+
+        self.total_frames = 0
+        self.total_render_cpu = 0.0
+        self.stats = {"fps": 0.0, "render_cpu_ms": 0.0, "loop_cpu_percent": 0.0}
+
+    def request_redraw(self):
+        self._redraw_requested = True
+
+    def wait_for_events(self, is_animating: bool) -> List[pygame.event.Event]:
+        if is_animating or self._redraw_requested:
+            self.clock.tick(self.max_fps)
+            events = pygame.event.get()
+        else:
+            event = pygame.event.wait(self.idle_timeout_ms)
+            events = [] if event.type == pygame.NOEVENT else [event] + pygame.event.get()
+            self.clock.tick()
+
+        if events:
+            self._redraw_requested = True
+        return events
+
+    def should_render(self) -> bool:
+        return self._redraw_requested
+
+    def begin_render(self):
+        self._render_start_cpu = time.thread_time()
+
+    def end_render(self):
+        render_cpu = time.thread_time() - self._render_start_cpu
+        self._redraw_requested = False
+
+        self.total_frames += 1
+        self.total_render_cpu += render_cpu
+        self._window_frames += 1
+        self._window_render_cpu += render_cpu
+        self._update_stats()
+
+    def _update_stats(self):
+        now = time.perf_counter()
+        elapsed = now - self._window_start
+        if elapsed < self.stats_window_s:
+            return
+
+        now_cpu = time.thread_time()
+        self.stats = {
+            "fps": self._window_frames / elapsed,
+            "render_cpu_ms": 1000 * self._window_render_cpu / max(1, self._window_frames),
+            "loop_cpu_percent": 100 * (now_cpu - self._window_start_cpu) / elapsed,
+        }
+
+        self._window_start = now
+        self._window_start_cpu = now_cpu
+        self._window_frames = 0
+        self._window_render_cpu = 0.0
+
+    def get_stats(self) -> Dict[str, float]:
+        """
+        Return the stats of the last complete window.
+
+        Returns
+        -------
+        dict[str, float]
+            The achieved "fps", the average "render_cpu_ms" per rendered frame
+            and the "loop_cpu_percent", the CPU use of the game loop thread.
+        """
+
+        # The stats are refreshed on render, an idle loop would otherwise keep reporting its last busy second
+        self._update_stats()
+        return dict(self.stats)
+
+    def report(self) -> str:
+        average_render_cpu = 1000 * self.total_render_cpu / max(1, self.total_frames)
+        return f"Rendered {self.total_frames} frames, {average_render_cpu:.2f} ms of CPU per frame"
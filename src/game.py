@@ -1,23 +1,51 @@
-from typing import List
+import time
+from typing import List, Optional, Dict, Any
 
 import pygame
 
-from src.llm.chat_gemma2 import ChatGemma2
+from src.frame_scheduler import FrameScheduler
+from src.llm.conversation_trace import ConversationRecorder
+from src.llm.inference_worker import InferenceWorker
+from src.llm.lazy_chat import LazyChatGemma2
+from src.llm.mood_detectors import MOOD_DETECTORS
+from src.llm.remote_chat import RemoteChatGemma2
+from src.llm.response_cache import ResponseCache
+from src.sprites.asset_manager import AssetManager
 from src.sprites.background import Background
 from src.sprites.character import Character
+from src.sprites.disk_asset_cache import DiskAssetCache
 from src.sprites.chat_box import ChatBox
-from src.sprites.sprite import Sprite
+from src.sprites.debug_overlay import DebugOverlay
+from src.sprites.sprite import Sprite, ScreenSize
+from src.telemetry import Telemetry
+
+
+# Posted by the inference worker to wake up the game loop when a response is ready
+LLM_RESPONSE_EVENT = pygame.event.custom_type()
 
 
 class Game:
-    def __init__(self):
+    def __init__(
+            self,
+            screen_size: Optional[ScreenSize] = None,
+            inference_server_url: Optional[str] = None,
+            telemetry_path: Optional[str] = None,
+            trace_path: Optional[str] = None,
+            mood_detector: str = "llm",
+            response_cache_path: Optional[str] = None,
+    ):
+        if mood_detector not in MOOD_DETECTORS:
+            raise ValueError(f"Unknown mood detector: {mood_detector}")
+
         pygame.init()
 
         self.character_name = "Monika"
         self.player_name = "Akriel"
 
-        screen_info = pygame.display.Info()
-        self.screen_size = (screen_info.current_w, screen_info.current_h)
+        if screen_size is None:
+            screen_info = pygame.display.Info()
+            screen_size = (screen_info.current_w, screen_info.current_h)
+        self.screen_size = screen_size
         self.screen = pygame.display.set_mode(self.screen_size)
         pygame.display.set_caption(f"Just {self.character_name}")
 
@@ -28,14 +56,15 @@ class Game:
         try:
             self.sound = pygame.mixer.Sound(self.sound_path)
             self.sound.play(-1)
-        except pygame.error as e:
+        except (pygame.error, FileNotFoundError) as e:
             print(f"Error loading sound: {e}")
             self.sound = None
 
-        self.clock = pygame.time.Clock()
+        self.frame_scheduler = FrameScheduler(max_fps=60)
         self.running = True
 
-        self.character = Character(self.character_path, self.screen_size)
+        self.assets = AssetManager(disk_cache=DiskAssetCache(".cache/assets"))
+        self.character = Character(self.character_path, self.screen_size, assets=self.assets)
         initial_text = (
             f"\"Hi, I'm {self.character_name}, the president of the Literature Club! "
             f"You must be {self.player_name}? I am so happy to meet you!\""
@@ -44,65 +73,323 @@ class Game:
             self.screen_size,
             initial_text,
             self.character_name,
+            assets=self.assets,
         )
-        self.background = Background(self.background_sprite_path, self.screen_size)
+        self.background = Background(self.background_sprite_path, self.screen_size, self.assets)
+
+        # Toggled with F3, the turns and frames are also written to `telemetry_path` as JSON lines
+        self.telemetry = Telemetry(telemetry_path)
+        self.debug_overlay = DebugOverlay()
 
         self.layers: List[Sprite] = [
             self.background,
             self.character,
-            self.chat_box
+            self.chat_box,
+            self.debug_overlay,
         ]
         self.prompt = ""
-        self.llm = ChatGemma2(self.character_name, self.player_name, self.character.available_emotions)
+        self.mood_detector = mood_detector
+        # Repeated player messages may get a remembered answer, kept in `response_cache_path` between runs
+        self.response_cache: Optional[ResponseCache] = None
+        if inference_server_url is not None:
+            if response_cache_path is not None:
+                print("Ignoring the response cache, the inference server has its own, see its --response-cache")
+            # The model is shared with other games, see src.llm.inference_server
+            self.llm = RemoteChatGemma2(
+                self.character_name, self.player_name, self.character.available_emotions, self.mood_detector,
+                url=inference_server_url,
+            )
+        else:
+            if response_cache_path is not None:
+                self.response_cache = ResponseCache(response_cache_path)
+            # torch and transformers are imported by the worker when it loads the model
+            self.llm = LazyChatGemma2(
+                self.character_name, self.player_name, self.character.available_emotions, self.mood_detector,
+                response_cache=self.response_cache,
+            )
+        # The prompts and answers are appended to `trace_path`, see benchmarks/replay.py to replay them
+        self.recorder: Optional[ConversationRecorder] = None
+        if trace_path is not None:
+            self.recorder = ConversationRecorder(
+                trace_path, self.character_name, self.player_name, self.character.available_emotions,
+                self.mood_detector,
+            )
+        self.inference_worker = InferenceWorker(
+            self.llm, on_response=lambda: pygame.event.post(pygame.event.Event(LLM_RESPONSE_EVENT))
+        )
+        self.pending_request_id: Optional[int] = None
+        self.pending_prompt = ""
+        self.load_error: Optional[str] = None
+        self._view_state = None
+        self._full_redraw = True
+        self._last_flip_ms = 0.0
+        self._turn_start = 0.0
+        self._turn_first_text_ms: Optional[float] = None
 
     def set_dummy_answer(self, _unused_prompt: str):
         self.chat_box.set_text("A very long message " * 20)
         self.chat_box.set_character_name(self.character_name)
         self.character.set_mood(self.character.available_emotions[0])
 
-    def set_llm_answer(self, prompt: str):
-        answer = self.llm.generate_answer(prompt, last_k_messages=15)
+    def set_llm_answer(self, answer: Dict[str, str]):
         emotion = answer["emotion"]
         response = answer["response"]
-        self.chat_box.set_text(response)
+        self.chat_box.stream_text(response, is_final=True)
         self.chat_box.set_character_name(self.character_name)
         self.character.set_mood(emotion)
 
+    def request_llm_answer(self, prompt: str):
+        self.pending_prompt = prompt
+        self._turn_start = time.perf_counter()
+        self._turn_first_text_ms = None
+        if self.recorder is not None:
+            self.recorder.record_prompt(prompt)
+        self.pending_request_id = self.inference_worker.submit(prompt)
+        self.chat_box.set_thinking()
+
+    def cancel_llm_answer(self):
+        if self.pending_request_id is not None:
+            self.inference_worker.cancel(self.pending_request_id)
+
+    def restore_pending_prompt(self):
+        self.prompt = self.pending_prompt
+        self.pending_prompt = ""
+        self.pending_request_id = None
+        self.chat_box.set_prompt(self.prompt)
+
+    def poll_llm_answers(self):
+        # Every partial response holds the whole text so far, only the latest one matters
+        partial_text = None
+        for response in self.inference_worker.poll():
+            if response["status"] == "load_error":
+                print(f"Error loading the model: {response['error']}")
+                self.load_error = response["error"]
+                continue
+
+            if response["request_id"] is None or response["request_id"] != self.pending_request_id:
+                continue
+
+            if response["status"] == "partial":
+                partial_text = response["text"]
+                if self._turn_first_text_ms is None:
+                    self._turn_first_text_ms = 1000 * (time.perf_counter() - self._turn_start)
+                continue
+
+            partial_text = None
+            if response["status"] == "done":
+                self.pending_request_id = None
+                self.pending_prompt = ""
+                self.set_llm_answer(response["answer"])
+                self.record_turn(response.get("stats", {}))
+                if self.recorder is not None:
+                    self.recorder.record_answer(response["answer"], response.get("stats"))
+            else:
+                if response["status"] == "error":
+                    print(f"Error generating answer: {response['error']}")
+                if self.recorder is not None:
+                    self.recorder.record_outcome(response["status"], response.get("error"))
+                self.restore_pending_prompt()
+
+        if partial_text is not None:
+            self.chat_box.stream_text(partial_text)
+
+    def record_turn(self, stats: Dict[str, Any]):
+        # The model measures its own stages, the game adds what the player waited for
+        total_ms = 1000 * (time.perf_counter() - self._turn_start)
+        self.telemetry.record_turn({
+            **stats,
+            "game_first_text_ms": self._turn_first_text_ms if self._turn_first_text_ms is not None else total_ms,
+            "game_total_ms": total_ms,
+        })
+
     def run(self):
-        self.llm.post_init()
-        self._run()
+        # The model is loaded by the worker, the window stays responsive in the meantime
+        self.inference_worker.start()
+        try:
+            self._run()
+        finally:
+            self.inference_worker.stop(timeout=1.0)
+            self.assets.close(timeout=1.0)
+            self.telemetry.close()
+            if self.recorder is not None:
+                self.recorder.close()
+            print(self.frame_scheduler.report())
+            print(f"Text line cache: {self.chat_box.line_cache.get_stats()}")
 
     def _run(self):
         while self.running:
-            self.event_handler()
-            self.render()
-            self.clock.tick(60)
+            events = self.frame_scheduler.wait_for_events(self.is_animating())
+            start = time.perf_counter()
+            self.event_handler(events)
+            self.poll_llm_answers()
+            if self.update():
+                self.frame_scheduler.request_redraw()
+
+            if self.frame_scheduler.should_render():
+                render_start = time.perf_counter()
+                full_redraw = self._full_redraw
+                self.frame_scheduler.begin_render()
+                self.render()
+                self.frame_scheduler.end_render()
+                render_ms = 1000 * (time.perf_counter() - render_start)
+                self.telemetry.record_frame(
+                    event_ms=1000 * (render_start - start),
+                    render_ms=render_ms - self._last_flip_ms,
+                    flip_ms=self._last_flip_ms,
+                    full_redraw=full_redraw,
+                )
+
+    def is_animating(self) -> bool:
+        # The loading progress is not animated, the idle timeout refreshes it often enough
+        return self.chat_box.is_animating
+
+    def prompt_placeholder(self) -> str:
+        if self.load_error is not None:
+            return f"{self.character_name} could not wake up: {self.load_error}"
+        if not self.llm.is_model_loaded:
+            return f"{self.character_name} is getting ready: {self.inference_worker.progress.describe()}"
+        return "Type your answer here..."
+
+    def update(self) -> bool:
+        """
+        Advance the state shown on screen by one frame.
+
+        Returns
+        -------
+        bool
+            Whether anything visible changed since the previous call.
+        """
 
-    def render(self):
         if self.chat_box.is_prompt_mode:
             self.chat_box.set_character_name(self.player_name)
-            display_prompt = self.prompt if len(self.prompt) else "Type your answer here..."
+            display_prompt = self.prompt if len(self.prompt) else self.prompt_placeholder()
             self.chat_box.set_prompt(display_prompt)
             self.chat_box.set_text_color(self.llm.is_model_loaded)
         else:
             self.chat_box.set_character_name(self.character_name)
 
+        self.chat_box.update()
+        if self.debug_overlay.needs_refresh():
+            self.debug_overlay.set_lines(self.debug_overlay_lines())
+
+        view_state = (
+            self.chat_box.character_name,
+            self.chat_box.text,
+            self.chat_box.chat_text_outer_color,
+            self.character.image,
+            self.debug_overlay.image,
+        )
+        changed = view_state != self._view_state
+        self._view_state = view_state
+        return changed
+
+    def debug_overlay_lines(self) -> List[str]:
+        def number(value: Optional[float], precision: int = 0) -> str:
+            return "n/a" if value is None else f"{value:.{precision}f}"
+
+        fps = self.frame_scheduler.get_stats()["fps"]
+        frames = self.telemetry.frame_summary()
+        lines = [f"{fps:.0f} fps, {frames['frames']} frames measured"]
+        if frames["frames"]:
+            lines += [
+                f"Frame {frames['frame_ms_mean']:.2f} ms (p95 {frames['frame_ms_p95']:.2f})",
+                f"Events {frames['event_ms_mean']:.2f}  render {frames['render_ms_mean']:.2f}  "
+                f"flip {frames['flip_ms_mean']:.2f} ms",
+            ]
+
+        turn = self.telemetry.last_turn
+        if turn is None:
+            lines.append("No turn yet")
+        elif turn.get("cached"):
+            lines.append(f"Last turn: cached answer in {number(turn.get('total_ms'))} ms")
+        else:
+            lines += [
+                f"Last turn: {number(turn.get('prompt_tokens'))} prompt tokens "
+                f"({number(turn.get('reused_tokens'))} reused), {number(turn.get('new_tokens'))} new",
+                f"First token {number(turn.get('time_to_first_token_ms'))} ms, "
+                f"{number(turn.get('decode_tokens_per_second'), 1)} tokens/s, mood {number(turn.get('mood_ms'))} ms",
+            ]
+            if "peak_memory_mb" in turn:
+                lines.append(f"Peak memory of the turn {number(turn['peak_memory_mb'])} MB")
+            else:
+                lines.append(f"Peak memory of the process {number(turn.get('process_peak_rss_mb'))} MB")
+        if turn is not None:
+            lines.append(
+                f"On screen: first text {number(turn['game_first_text_ms'])} ms, "
+                f"answer {number(turn['game_total_ms'])} ms"
+            )
+        if self.response_cache is not None:
+            cache = self.response_cache.get_stats()
+            lines.append(
+                f"Response cache: {cache['hits']} hits ({cache['hit_rate']:.0%}), "
+                f"{cache['saved_seconds']:.1f} s saved, {cache['entries']} entries"
+            )
+        return lines
+
+    def request_full_redraw(self):
+        self._full_redraw = True
+        self.frame_scheduler.request_redraw()
+
+    def collect_dirty_rects(self) -> List[pygame.Rect]:
+        screen_rect = self.screen.get_rect()
+        rects = []
         for layer in self.layers:
-            layer.draw(self.screen)
+            for rect in layer.get_dirty_rects():
+                rect = rect.clip(screen_rect)
+                if rect.width > 0 and rect.height > 0:
+                    rects.append(rect)
 
-        pygame.display.flip()
+        # Overlapping rects, e.g. the old and the new text line, are drawn once
+        merged = []
+        for rect in rects:
+            overlapping = rect.collidelistall(merged)
+            while overlapping:
+                rect = rect.unionall([merged[i] for i in overlapping])
+                merged = [other for i, other in enumerate(merged) if i not in overlapping]
+                overlapping = rect.collidelistall(merged)
+            merged.append(rect)
+        return merged
 
-    def event_handler(self):
-        for event in pygame.event.get():
+    def render(self):
+        if self._full_redraw:
+            for layer in self.layers:
+                layer.draw(self.screen)
+            flip_start = time.perf_counter()
+            pygame.display.flip()
+            self._last_flip_ms = 1000 * (time.perf_counter() - flip_start)
+            self._full_redraw = False
+            return
+
+        # Only the areas that changed are drawn again, every layer clipped to them
+        rects = self.collect_dirty_rects()
+        for rect in rects:
+            self.screen.set_clip(rect)
+            for layer in self.layers:
+                layer.draw(self.screen)
+        self.screen.set_clip(None)
+
+        flip_start = time.perf_counter()
+        if rects:
+            pygame.display.update(rects)
+        self._last_flip_ms = 1000 * (time.perf_counter() - flip_start)
+
+    def event_handler(self, events: List[pygame.event.Event]):
+        for event in events:
             if event.type == pygame.QUIT:
                 self.running = False
 
+            if event.type in (pygame.VIDEORESIZE, pygame.WINDOWSIZECHANGED, pygame.WINDOWEXPOSED):
+                self.request_full_redraw()
+
             if event.type == pygame.KEYDOWN:
                 self.handle_key_down(event)
 
     def handle_key_down(self, event: pygame.event.Event):
         self.handle_general_functionalities(event)
 
+        if self.chat_box.is_thinking:
+            return
+
         if self.chat_box.is_prompt_mode:
             self.handle_prompt_mode(event)
         else:
@@ -110,17 +397,25 @@ class Game:
 
     def handle_general_functionalities(self, event: pygame.event.Event):
         if event.key == pygame.K_ESCAPE:
-            self.running = False
+            # While an answer is being generated, escape cancels it instead of quitting
+            if self.pending_request_id is not None:
+                self.cancel_llm_answer()
+            else:
+                self.running = False
 
         if event.key == pygame.K_F2:
             pygame.display.toggle_fullscreen()
+            self.request_full_redraw()
+
+        if event.key == pygame.K_F3:
+            self.debug_overlay.toggle()
 
     def handle_prompt_mode(self, event: pygame.event.Event):
         if event.key == pygame.K_RETURN and self.llm.is_model_loaded:
             if len(self.prompt) == 0:
                 return
 
-            self.set_llm_answer(self.prompt)
+            self.request_llm_answer(self.prompt)
             self.prompt = ""
             return
 
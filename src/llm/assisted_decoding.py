@@ -0,0 +1,188 @@
+import time
+from collections import deque
+from typing import Optional, Dict, Any
+
+from transformers import PreTrainedModel
+
+
+ASSISTED_DECODING_MODES = ("prompt_lookup", "draft")
+
+
+class DecodingMonitor:
+    """
+    Counts the forward passes of the model during one generation.
+
+    Assisted decoding feeds the tokens drafted for a step to the model
+    together with the last accepted token, and keeps the longest prefix the
+    model agrees with plus one token of its own. The tokens fed in every
+    pass are therefore enough to tell how many were drafted and accepted,
+    whatever proposed them.
+    """
+
+    def __init__(self, model: PreTrainedModel, mode: Optional[str]):
+        self.model = model
+        self.mode = mode
+        self.forward_passes = 0
+        self.fed_tokens = 0
+        self._handle = None
+        self._start = 0.0
+
+    def _count_forward(self, module, args, kwargs):
+        input_ids = kwargs.get("input_ids")
+        if input_ids is None and args:
+            input_ids = args[0]
+        self.forward_passes += 1
+        self.fed_tokens += input_ids.shape[1] if input_ids is not None else 1
+
+    def __enter__(self) -> "DecodingMonitor":
+        self._handle = self.model.register_forward_pre_hook(self._count_forward, with_kwargs=True)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self._start
+        self._handle.remove()
+
+    def report(self, new_tokens: int, prefill_tokens: int) -> Dict[str, Any]:
+        """
+        Summarize the generation.
+
+        Arguments
+        ---------
+        new_tokens : int
+            How many tokens were generated.
+        prefill_tokens : int
+            How many prompt tokens were fed to the model, i.e. not already in its cache.
+
+        Returns
+        -------
+        dict[str, Any]
+            The "mode", the "forward_passes", the "drafted_tokens" and the
+            "accepted_tokens" with their "acceptance_rate" (None when nothing
+            was drafted), and the "tokens_per_second" of the generation.
+        """
+
+        # Every pass after the prefill feeds back the token accepted by the previous one
+        decode_passes = max(self.forward_passes - 1, 0)
+        drafted = max(self.fed_tokens - prefill_tokens - decode_passes, 0)
+        accepted = min(max(new_tokens - self.forward_passes, 0), drafted)
+        return {
+            "mode": self.mode or "plain",
+            "new_tokens": new_tokens,
+            "forward_passes": self.forward_passes,
+            "drafted_tokens": drafted,
+            "accepted_tokens": accepted,
+            "acceptance_rate": accepted / drafted if drafted else None,
+            "seconds": self.seconds,
+            "tokens_per_second": new_tokens / self.seconds if self.seconds > 0 else 0.0,
+        }
+
+
+class AssistedDecoding:
+    """
+    Settings and bookkeeping of the assisted decoding of the responses.
+
+    A cheap guess of the next tokens is verified by the model in a single
+    forward pass, so a turn needs fewer passes when the guesses are good.
+    "prompt_lookup" guesses by finding the last generated n-gram in the
+    prompt, i.e. the persona and the conversation history, and copying what
+    followed it. "draft" lets a small model with the same tokenizer write
+    the guesses. The model keeps the last word in both cases, greedy
+    decoding gives the same tokens as without assistance and sampling the
+    same distribution.
+
+    When the guesses are rarely accepted, every pass verifies tokens for
+    nothing, so once the acceptance rate over the last `window_turns` turns
+    falls under `min_acceptance_rate` the responses are decoded without
+    assistance again.
+    """
+
+    def __init__(
+            self,
+            mode: Optional[str] = None,
+            prompt_lookup_num_tokens: int = 10,
+            max_matching_ngram_size: int = 2,
+            num_assistant_tokens: int = 5,
+            min_acceptance_rate: float = 0.2,
+            window_turns: int = 3,
+    ):
+        self.prompt_lookup_num_tokens = prompt_lookup_num_tokens
+        self.max_matching_ngram_size = max_matching_ngram_size
+        self.num_assistant_tokens = num_assistant_tokens
+        self.min_acceptance_rate = min_acceptance_rate
+        self.window_turns = window_turns
+        self.draft_model: Optional[PreTrainedModel] = None
+        self.fallback_reason: Optional[str] = None
+        self.turns = 0
+        self.total_drafted = 0
+        self.total_accepted = 0
+        self._recent = deque(maxlen=window_turns)
+        self.set_mode(mode)
+
+    def set_mode(self, mode: Optional[str]):
+        if mode is not None and mode not in ASSISTED_DECODING_MODES:
+            raise ValueError(f"Unknown assisted decoding mode: {mode}, expected one of {ASSISTED_DECODING_MODES}")
+        self.mode = mode
+        self.fallback_reason = None
+        self._recent.clear()
+
+    def set_draft_model(self, draft_model: PreTrainedModel):
+        # The drafts are rolled back after every verification, which only a dynamic cache supports
+        draft_model.config.cache_implementation = None
+        draft_model.generation_config.cache_implementation = None
+        self.draft_model = draft_model.eval()
+
+    @property
+    def is_active(self) -> bool:
+        if self.mode is None or self.fallback_reason is not None:
+            return False
+        return self.mode != "draft" or self.draft_model is not None
+
+    def generate_kwargs(self) -> Dict[str, Any]:
+        if not self.is_active:
+            return {}
+        if self.mode == "prompt_lookup":
+            return {
+                "prompt_lookup_num_tokens": self.prompt_lookup_num_tokens,
+                "max_matching_ngram_size": self.max_matching_ngram_size,
+            }
+
+        self.draft_model.generation_config.num_assistant_tokens = self.num_assistant_tokens
+        return {"assistant_model": self.draft_model}
+
+    def monitor(self, model: PreTrainedModel) -> DecodingMonitor:
+        return DecodingMonitor(model, self.mode if self.is_active else None)
+
+    def fall_back(self, reason: str):
+        self.fallback_reason = reason
+        print(f"Assisted decoding ({self.mode}) turned off: {reason}")
+
+    def record_turn(self, report: Dict[str, Any]):
+        """
+        Add the report of a turn to the statistics and fall back when too few drafted tokens are accepted.
+        """
+
+        if report["mode"] == "plain":
+            return
+
+        self.turns += 1
+        self.total_drafted += report["drafted_tokens"]
+        self.total_accepted += report["accepted_tokens"]
+        self._recent.append((report["drafted_tokens"], report["accepted_tokens"]))
+
+        drafted = sum(d for d, _ in self._recent)
+        accepted = sum(a for _, a in self._recent)
+        if len(self._recent) == self.window_turns and drafted and accepted / drafted < self.min_acceptance_rate:
+            self.fall_back(
+                f"{accepted / drafted:.0%} of the drafted tokens accepted in the last {self.window_turns} turns, "
+                f"under {self.min_acceptance_rate:.0%}"
+            )
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "active": self.is_active,
+            "fallback_reason": self.fallback_reason,
+            "turns": self.turns,
+            "acceptance_rate": self.total_accepted / self.total_drafted if self.total_drafted else None,
+        }
@@ -0,0 +1,353 @@
+import copy
+import threading
+import traceback
+from collections import deque
+from typing import Optional, List, Dict, Any, Deque
+
+import torch
+from transformers import (
+    DynamicCache, GenerationConfig, LogitsProcessorList, PreTrainedModel, StoppingCriteria,
+    TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper,
+)
+
+from src.llm.session_cache import KVCache, SessionKVCache
+
+
+def _sampling_processors(config: GenerationConfig) -> LogitsProcessorList:
+    # The warpers `model.generate` applies for these settings, in the same order
+    processors = LogitsProcessorList()
+    if not config.do_sample:
+        return processors
+    if config.temperature is not None and config.temperature != 1.0:
+        processors.append(TemperatureLogitsWarper(config.temperature))
+    if config.top_k is not None and config.top_k != 0:
+        processors.append(TopKLogitsWarper(top_k=config.top_k))
+    if config.top_p is not None and config.top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p=config.top_p))
+    return processors
+
+
+def _pad_cache_left(cache: DynamicCache, width: int) -> List[tuple]:
+    length = cache.get_seq_length()
+    padding = (0, 0, width - length, 0)
+    return [
+        (torch.nn.functional.pad(key, padding), torch.nn.functional.pad(value, padding))
+        for key, value in zip(cache.key_cache, cache.value_cache)
+    ]
+
+
+class GenerationRequest:
+    def __init__(
+            self,
+            input_ids: torch.LongTensor,
+            config: GenerationConfig,
+            kv_cache: Optional[KVCache] = None,
+            streamer: Optional[Any] = None,
+            stopping_criteria: Optional[List[StoppingCriteria]] = None,
+    ):
+        self.input_ids = input_ids
+        self.config = config
+        self.kv_cache = kv_cache
+        self.streamer = streamer
+        self.stopping_criteria = stopping_criteria or []
+        self.processors = _sampling_processors(config)
+        self.output_ids: List[int] = input_ids.tolist()
+        self.max_length = len(self.output_ids) + config.max_new_tokens
+        self.done = threading.Event()
+        self.error: Optional[Exception] = None
+
+
+class BatchedGenerator:
+    """
+    Generates the responses of many chat sessions with one model, batching their decode steps.
+
+    Every call to `generate` blocks its own thread until its tokens are
+    generated, and meanwhile a single scheduler thread runs the model:
+    a new request is prefilled on its own as soon as there is room in the
+    batch, then it joins the requests that are already decoding, and one
+    forward pass decodes the next token of all of them. A request leaves
+    the batch as soon as it ends, so short responses never wait for long
+    ones and new requests never wait for the batch to drain (continuous
+    batching).
+
+    The key values of the batch are kept left padded to the longest
+    request, with an attention mask hiding the padding. When a request
+    comes with a KV cache of its session, the cached prefix of its prompt
+    is not prefilled again and the cache holds the whole turn afterwards,
+    as with `model.generate`.
+
+    The model must not be used by other threads while the generator runs,
+    except under `model_lock`, which is held during every forward pass of
+    the scheduler.
+    """
+
+    def __init__(self, model: PreTrainedModel, max_batch_size: int = 8):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.model_lock = threading.RLock()
+        self.eos_token_ids = set()
+        eos_token_id = model.generation_config.eos_token_id
+        if eos_token_id is not None:
+            self.eos_token_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+
+        self._condition = threading.Condition()
+        self._waiting: Deque[GenerationRequest] = deque()
+        self._active: List[GenerationRequest] = []
+        self._cache: Optional[DynamicCache] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="BatchedGenerator", daemon=True)
+
+        self.decode_steps = 0
+        self.decoded_tokens = 0
+        self.completed_requests = 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def generate(
+            self,
+            input_ids: torch.LongTensor,
+            generate_kwargs: Dict[str, Any],
+            kv_cache: Optional[KVCache] = None,
+    ) -> torch.LongTensor:
+        """
+        Generate from a prompt, like `model.generate` for a batch of one.
+
+        Arguments
+        ---------
+        input_ids : torch.LongTensor
+            The prompt of shape (1, sequence_length).
+        generate_kwargs : dict[str, Any]
+            The "streamer" and the "stopping_criteria" are used as by
+            `model.generate`, the other keys update the generation config
+            of the model, of which the sampling settings are supported.
+        kv_cache : Optional[KVCache]
+            The cache of the session, prepared with the prompt and updated with the output.
+
+        Returns
+        -------
+        torch.LongTensor
+            The prompt followed by the generated tokens, of shape (sequence_length,).
+        """
+
+        generate_kwargs = dict(generate_kwargs)
+        streamer = generate_kwargs.pop("streamer", None)
+        stopping_criteria = generate_kwargs.pop("stopping_criteria", None)
+        config = copy.deepcopy(self.model.generation_config)
+        config.update(**generate_kwargs)
+        if config.max_new_tokens is None:
+            config.max_new_tokens = max(config.max_length - input_ids.shape[1], 0)
+
+        request = GenerationRequest(input_ids[0].cpu(), config, kv_cache, streamer, stopping_criteria)
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("The batched generator is stopped.")
+            self._waiting.append(request)
+            self._condition.notify_all()
+
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return torch.tensor(request.output_ids, dtype=torch.long, device=self.model.device)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._condition:
+            waiting = len(self._waiting)
+        return {
+            "max_batch_size": self.max_batch_size,
+            "active": len(self._active),
+            "waiting": waiting,
+            "completed_requests": self.completed_requests,
+            "decode_steps": self.decode_steps,
+            "decoded_tokens": self.decoded_tokens,
+            "mean_batch_size": self.decoded_tokens / self.decode_steps if self.decode_steps else 0.0,
+        }
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and not self._waiting and not self._active:
+                    self._condition.wait()
+                if self._stopped:
+                    break
+                admitted = []
+                while self._waiting and len(self._active) + len(admitted) < self.max_batch_size:
+                    admitted.append(self._waiting.popleft())
+
+            for request in admitted:
+                try:
+                    self._prefill(request)
+                except Exception as e:
+                    traceback.print_exc()
+                    self._fail(request, e)
+
+            if not self._active:
+                continue
+            try:
+                self._decode_step()
+            except Exception as e:
+                traceback.print_exc()
+                for request in self._active:
+                    self._fail(request, e)
+                self._active = []
+                self._cache = None
+                self._attention_mask = None
+
+        error = RuntimeError("The batched generator is stopped.")
+        with self._condition:
+            requests = list(self._waiting) + self._active
+            self._waiting.clear()
+        for request in requests:
+            self._fail(request, error)
+        self._active = []
+
+    @torch.no_grad()
+    def _prefill(self, request: GenerationRequest):
+        device = self.model.device
+        input_ids = request.input_ids.to(device)[None]
+        reused_tokens = 0
+        if request.kv_cache is not None:
+            cache = request.kv_cache.prepare(input_ids)
+            reused_tokens = request.kv_cache.last_reused_tokens
+        else:
+            cache = DynamicCache()
+
+        if request.streamer is not None:
+            request.streamer.put(input_ids.cpu())
+
+        length = input_ids.shape[1]
+        with self.model_lock:
+            logits = self.model(
+                input_ids=input_ids[:, reused_tokens:],
+                attention_mask=torch.ones((1, length), dtype=torch.long, device=device),
+                position_ids=torch.arange(reused_tokens, length, device=device)[None],
+                past_key_values=cache,
+                use_cache=True,
+                logits_to_keep=1,
+            ).logits[:, -1]
+
+        if self._add_token(request, logits[0]):
+            self._finish(request, cache)
+            return
+
+        self._join(request, cache)
+
+    def _join(self, request: GenerationRequest, cache: DynamicCache):
+        length = cache.get_seq_length()
+        mask = torch.ones((1, length), dtype=torch.long, device=self.model.device)
+        if self._cache is None:
+            self._cache = cache
+            self._attention_mask = mask
+        else:
+            width = max(self._attention_mask.shape[1], length)
+            layers = zip(_pad_cache_left(self._cache, width), _pad_cache_left(cache, width))
+            self._cache = DynamicCache.from_legacy_cache(tuple(
+                (torch.cat([batch_key, key]), torch.cat([batch_value, value]))
+                for (batch_key, batch_value), (key, value) in layers
+            ))
+            self._attention_mask = torch.cat([
+                torch.nn.functional.pad(self._attention_mask, (width - self._attention_mask.shape[1], 0)),
+                torch.nn.functional.pad(mask, (width - length, 0)),
+            ])
+        self._active.append(request)
+
+    @torch.no_grad()
+    def _decode_step(self):
+        device = self.model.device
+        # The last token of every request is the only one without key values yet
+        input_ids = torch.tensor([[request.output_ids[-1]] for request in self._active], device=device)
+        position_ids = torch.tensor([[len(request.output_ids) - 1] for request in self._active], device=device)
+        ones = torch.ones((len(self._active), 1), dtype=torch.long, device=device)
+        self._attention_mask = torch.cat([self._attention_mask, ones], dim=1)
+
+        with self.model_lock:
+            logits = self.model(
+                input_ids=input_ids,
+                attention_mask=self._attention_mask,
+                position_ids=position_ids,
+                past_key_values=self._cache,
+                use_cache=True,
+                logits_to_keep=1,
+            ).logits[:, -1]
+        self.decode_steps += 1
+        self.decoded_tokens += len(self._active)
+
+        finished = [index for index, request in enumerate(self._active) if self._add_token(request, logits[index])]
+        if finished:
+            self._leave(finished)
+
+    def _leave(self, finished: List[int]):
+        for index in finished:
+            request = self._active[index]
+            if not isinstance(request.kv_cache, SessionKVCache):
+                self._finish(request, None)
+                continue
+
+            # Copies, a view would keep the key values of the whole batch alive
+            padding = int((self._attention_mask[index] == 0).sum())
+            self._finish(request, DynamicCache.from_legacy_cache(tuple(
+                (key[index:index + 1, :, padding:].clone(), value[index:index + 1, :, padding:].clone())
+                for key, value in zip(self._cache.key_cache, self._cache.value_cache)
+            )))
+
+        keep = [index for index in range(len(self._active)) if index not in finished]
+        self._active = [self._active[index] for index in keep]
+        if not self._active:
+            self._cache = None
+            self._attention_mask = None
+            return
+
+        self._cache.batch_select_indices(torch.tensor(keep, device=self.model.device))
+        self._attention_mask = self._attention_mask[keep]
+        # Drop the padding columns no request needs anymore, e.g. after the longest one left
+        unused = int(self._attention_mask.any(dim=0).long().argmax())
+        if unused > 0:
+            self._attention_mask = self._attention_mask[:, unused:]
+            for layer in range(len(self._cache.key_cache)):
+                self._cache.key_cache[layer] = self._cache.key_cache[layer][:, :, unused:]
+                self._cache.value_cache[layer] = self._cache.value_cache[layer][:, :, unused:]
+
+    def _add_token(self, request: GenerationRequest, logits: torch.Tensor) -> bool:
+        """
+        Pick the next token of a request from its logits and tell whether the request is finished.
+        """
+
+        output_ids = torch.tensor([request.output_ids], device=logits.device)
+        scores = request.processors(output_ids, logits[None].float())
+        if request.config.do_sample:
+            token = int(torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)[0, 0])
+        else:
+            token = int(scores[0].argmax())
+
+        request.output_ids.append(token)
+        if request.streamer is not None:
+            request.streamer.put(torch.tensor([token]))
+
+        if token in self.eos_token_ids or len(request.output_ids) >= request.max_length:
+            return True
+        output_ids = torch.tensor([request.output_ids], device=logits.device)
+        return any(bool(criteria(output_ids, scores).any()) for criteria in request.stopping_criteria)
+
+    def _finish(self, request: GenerationRequest, cache: Optional[DynamicCache]):
+        if isinstance(request.kv_cache, SessionKVCache):
+            # The batch worked on its own copy of the key values, the session keeps them for the next turn
+            request.kv_cache.cache = cache
+            request.kv_cache.update(torch.tensor(request.output_ids))
+        if request.streamer is not None:
+            request.streamer.end()
+        self.completed_requests += 1
+        request.done.set()
+
+    def _fail(self, request: GenerationRequest, error: Exception):
+        if request.kv_cache is not None:
+            request.kv_cache.reset()
+        request.error = error
+        request.done.set()
@@ -1,7 +1,88 @@
-from typing import Optional, List, Dict, Any
+import sys
+import threading
+import time
+from typing import Optional, List, Dict, Any, Callable
 
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers import (
+    AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, StoppingCriteria, TextStreamer, PreTrainedTokenizerBase
+)
+
+from src.llm.assisted_decoding import AssistedDecoding
+from src.llm.batched_generation import BatchedGenerator
+from src.llm.conversation_window import ConversationWindow, TokenCounter, summarize_first_sentences
+from src.llm.cpu_inference import (
+    configure_cpu_threads, default_num_threads, quantize_linear_layers, measure_tokens_per_second, describe_cpu_settings
+)
+from src.llm.errors import GenerationCancelled
+from src.llm.model_loading import LoadingProgress, find_checkpoint_files, prefetch_files
+from src.llm.mood_detectors import MoodDetector, create_mood_detector
+from src.llm.mood_scorer import MoodScorer
+from src.llm.response_cache import ResponseCache, fingerprint
+from src.llm.session_cache import SessionKVCache, PrefixKVCache, KVCache, common_prefix_length
+
+
+class CancelCriteria(StoppingCriteria):
+    def __init__(self, cancel_event: threading.Event):
+        self.cancel_event = cancel_event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        is_cancelled = self.cancel_event.is_set()
+        return torch.full((input_ids.shape[0],), is_cancelled, dtype=torch.bool, device=input_ids.device)
+
+
+class TokenTiming(StoppingCriteria):
+    """
+    Never stops the generation, only records when its tokens were generated.
+
+    Stopping criteria are checked after every step of `model.generate`,
+    the first check comes right after the prefill and the first token.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token: Optional[float] = None
+        self.last_token: Optional[float] = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+        self.last_token = now
+        return torch.zeros((input_ids.shape[0],), dtype=torch.bool, device=input_ids.device)
+
+    def report(self, new_tokens: int) -> Dict[str, Any]:
+        end = time.perf_counter()
+        first_token = self.first_token if self.first_token is not None else end
+        decode_seconds = (self.last_token or end) - first_token
+        return {
+            "new_tokens": new_tokens,
+            "time_to_first_token_ms": 1000 * (first_token - self.start),
+            "generate_ms": 1000 * (end - self.start),
+            # The first token comes with the prefill, the decoding starts after it
+            "decode_tokens_per_second": (new_tokens - 1) / decode_seconds if decode_seconds > 0 else None,
+        }
+
+
+class CallbackStreamer(TextStreamer):
+    """
+    Streams the generated text to a callback as it is decoded.
+
+    The callback always receives the whole text generated so far, so the
+    consumer does not have to keep track of the previous pieces.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, on_text: Callable[[str], None]):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.on_text = on_text
+        self.generated_text = ""
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if not text:
+            return
+
+        self.generated_text += text
+        self.on_text(self.generated_text)
 
 
 class ChatGemma2:
@@ -10,8 +91,11 @@ class ChatGemma2:
             character_name: str,
             player_name: str,
             emotion_list: List[str],
+            mood_detector: str = "llm",
+            response_cache: Optional[ResponseCache] = None,
     ):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model_name = "google/gemma-2-2b-it"
 
         self.chat_messages_complex = []
         self.chat_messages_simple = []
@@ -27,21 +111,226 @@ class ChatGemma2:
         }
 
         self.generate_mood_kwargs = {
-            "max_new_tokens": 10,
             "temperature": 1.0,
-            "do_sample": False,
         }
+        # Only used when CUDA is not available
+        self.cpu_inference_kwargs = {
+            "dtype": torch.float32,
+            "quantize_int8": True,
+            "num_threads": default_num_threads(),
+            "num_interop_threads": 1,
+            "compile": False,
+            "target_tokens_per_second": 5.0,
+        }
+        self.run_self_check = True
+        self.inference_mode = None
+        # Optional: "prompt_lookup", or "draft" with a small model sharing the tokenizer
+        self.assisted_decoding = AssistedDecoding()
+        self.draft_model_name: Optional[str] = None
+        self.last_decoding_report: Dict[str, Any] = {}
+        # Where the time of the last turn went, see `generate_answer`
+        self.last_generation_stats: Dict[str, Any] = {}
+        self.last_turn_stats: Dict[str, Any] = {}
+        self.self_check_report: Dict[str, Any] = {}
+
+        # The prompt is kept under the token budget by folding old turns into a summary
+        self.max_history_messages = 200
+        self.token_counter: Optional[TokenCounter] = None
+        self.conversation_window = ConversationWindow(
+            self._count_message_tokens,
+            token_budget=2048,
+            summary_token_budget=256,
+            summarize=lambda messages: summarize_first_sentences(
+                messages, {"user": self.player_name, "model": self.character_name}
+            ),
+        )
+
+        self.session_cache = SessionKVCache()
+        self.mood_prefix_cache = PrefixKVCache()
+        self.mood_scorer: Optional[MoodScorer] = None
+        self.mood_distribution: Dict[str, float] = {}
+        self.set_mood_detector(mood_detector)
         self._model_loaded = False
 
-    def post_init(self):
+        # Optional: answers repeated player messages without the model
+        self.response_cache = response_cache
+        # Number of the last messages the cached answers depend on, besides the player message
+        self.response_cache_context_messages = 2
+
+        # Set when the model is shared with other sessions, see `new_session`
+        self.batched_generator: Optional[BatchedGenerator] = None
+        self.model_lock = threading.RLock()
+
+    def post_init(self, progress: Optional[LoadingProgress] = None):
+        """
+        Load the model and the tokenizer, then warm them up.
+
+        This takes a while, so the game calls it from the inference worker.
+
+        Arguments
+        ---------
+        progress : Optional[LoadingProgress]
+            Updated with the current stage and the bytes of weights read so far.
+        """
+
+        if progress is None:
+            progress = LoadingProgress()
+
+        progress.set_stage("locating weights")
+        prefetch_files(find_checkpoint_files(self.model_name), progress)
+
+        progress.set_stage("loading model")
+        if self.device.type == "cuda":
+            self._load_cuda_model()
+        else:
+            self._load_cpu_model()
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        if self.assisted_decoding.mode == "draft" and self.draft_model_name is not None:
+            progress.set_stage("loading draft model")
+            self._load_draft_model()
+
+        # The first generation pays for one-time allocations and compilation, do it before the first turn
+        progress.set_stage("warming up")
+        if self.run_self_check:
+            self.self_check()
+        else:
+            self.warm_up()
+
+        if self.mood_detector.uses_model:
+            self._build_mood_prefix_cache()
+
+        progress.set_stage("ready")
+        self._model_loaded = True
+
+    @torch.no_grad()
+    def warm_up(self):
+        messages = [{"role": "user", "content": "Hi!"}]
+        inputs = self.tokenizer.apply_chat_template(
+            messages, return_tensors="pt", return_dict=True, add_generation_prompt=True
+        ).to(self.device)
+        self.model.generate(**inputs, max_new_tokens=2, do_sample=False)
+
+    def _load_cuda_model(self):
         quantization_config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=torch.bfloat16)
         self.model = AutoModelForCausalLM.from_pretrained(
-            "google/gemma-2-2b-it",
+            self.model_name,
             quantization_config=quantization_config,
             low_cpu_mem_usage=True,
+            use_safetensors=True,
         )
-        self.tokenizer = AutoTokenizer.from_pretrained("google/gemma-2-2b-it")
-        self._model_loaded = True
+        self.inference_mode = "cuda (4-bit)"
+
+    def _load_cpu_model(self):
+        settings = self.cpu_inference_kwargs
+        configure_cpu_threads(settings["num_threads"], settings["num_interop_threads"])
+
+        # Dynamic quantization works on float32 linear layers only
+        dtype = torch.float32 if settings["quantize_int8"] else settings["dtype"]
+        self.model = AutoModelForCausalLM.from_pretrained(
+            self.model_name,
+            torch_dtype=dtype,
+            low_cpu_mem_usage=True,
+            use_safetensors=True,
+        )
+        self.model.eval()
+
+        if settings["quantize_int8"]:
+            self.model = quantize_linear_layers(self.model)
+
+        if settings["compile"]:
+            # generate() is not compiled, only the forward pass it calls for every token
+            self.model.forward = torch.compile(self.model.forward, dynamic=True)
+
+        self.inference_mode = describe_cpu_settings(settings)
+
+    def _load_draft_model(self):
+        dtype = torch.float16 if self.device.type == "cuda" else self.cpu_inference_kwargs["dtype"]
+        draft_model = AutoModelForCausalLM.from_pretrained(self.draft_model_name, torch_dtype=dtype)
+        self.assisted_decoding.set_draft_model(draft_model.to(self.device))
+
+    def self_check(self) -> Dict[str, Any]:
+        """
+        Measure the decoding speed of the loaded model and report the selected mode.
+
+        Returns
+        -------
+        dict[str, Any]
+            The "mode", the measured "tokens_per_second", the "target" speed
+            (None on CUDA) and whether the target was "met".
+        """
+
+        tokens_per_second = measure_tokens_per_second(self.model, self.tokenizer)
+        target = None
+        if self.device.type == "cpu":
+            target = self.cpu_inference_kwargs["target_tokens_per_second"]
+
+        self.self_check_report = {
+            "mode": self.inference_mode,
+            "tokens_per_second": tokens_per_second,
+            "target": target,
+            "met": target is None or tokens_per_second >= target,
+        }
+
+        message = f"Inference mode: {self.inference_mode}, {tokens_per_second:.1f} tokens/s"
+        if target is not None:
+            message += f" (target {target:.1f} tokens/s{'' if self.self_check_report['met'] else ', not met'})"
+        print(message)
+
+        return self.self_check_report
+
+    def new_session(
+            self,
+            character_name: str,
+            player_name: str,
+            emotion_list: List[str],
+            mood_detector: str = "llm",
+    ) -> "ChatGemma2":
+        """
+        Start another conversation with the loaded model, e.g. for another player of the inference server.
+
+        The session has its own history, KV cache and settings, only the
+        model, the tokenizer, the response cache and, for the same
+        emotions, the mood prefix cache are shared. When a `batched_generator` is set, the responses
+        of all sessions are generated by it and the mood is scored under
+        its model lock, so the sessions can run on different threads.
+
+        Returns
+        -------
+        ChatGemma2
+            The new session, ready to generate answers.
+        """
+
+        session = ChatGemma2(character_name, player_name, emotion_list, mood_detector)
+        session.device = self.device
+        session.model_name = self.model_name
+        session.model = self.model
+        session.tokenizer = self.tokenizer
+        session.inference_mode = self.inference_mode
+        session.generate_response_kwargs = dict(self.generate_response_kwargs)
+        session.generate_mood_kwargs = dict(self.generate_mood_kwargs)
+        # The cache is thread-safe, and its keys include the names of the characters
+        session.response_cache = self.response_cache
+        session.response_cache_context_messages = self.response_cache_context_messages
+        session.batched_generator = self.batched_generator
+        session.model_lock = self.model_lock
+        if list(emotion_list) == list(self.emotion_list):
+            session.mood_prefix_cache = self.mood_prefix_cache
+            session.mood_scorer = self.mood_scorer
+        session._model_loaded = self._model_loaded
+        return session
+
+    def set_mood_detector(self, name: str):
+        """
+        Select how the mood of the responses is identified.
+
+        Arguments
+        ---------
+        name : str
+            "llm" scores the emotions with the chat model itself, "lexicon"
+            uses a word lexicon that runs in microseconds without the model.
+        """
+
+        self.mood_detector: MoodDetector = create_mood_detector(name, self)
 
     @property
     def is_model_loaded(self):
@@ -56,6 +345,29 @@ class ChatGemma2:
     def reset_messages(self):
         self.chat_messages_complex = []
         self.chat_messages_simple = []
+        self.conversation_window.reset()
+        self.session_cache.reset()
+
+    def _count_message_tokens(self, message: Dict[str, str]) -> int:
+        if self.token_counter is None:
+            self.token_counter = TokenCounter(self.tokenizer)
+        return self.token_counter(message)
+
+    def _trim_history(self):
+        # Drop whole user/model pairs, after making sure they are part of the summary
+        excess = self.len_chat - self.max_history_messages
+        excess += excess % 2
+        if excess <= 0:
+            return
+
+        self.conversation_window.fold_through(self.chat_messages_simple, excess)
+        self.chat_messages_complex = self.chat_messages_complex[excess:]
+        self.chat_messages_simple = self.chat_messages_simple[excess:]
+        self.conversation_window.forget(excess)
+
+    def _remove_last_messages(self, count: int):
+        self.chat_messages_complex = self.chat_messages_complex[:len(self.chat_messages_complex) - count]
+        self.chat_messages_simple = self.chat_messages_simple[:len(self.chat_messages_simple) - count]
 
     def _add_user_message(self, content: str):
         prompt = (
@@ -109,48 +421,294 @@ class ChatGemma2:
             self,
             messages: List[Dict[str, str]],
             generate_kwargs: Dict[str, Any],
+            cancel_event: Optional[threading.Event] = None,
+            on_text: Optional[Callable[[str], None]] = None,
+            kv_cache: Optional[KVCache] = None,
+            assisted: bool = False,
     ) -> str:
+        start = time.perf_counter()
         input_ids = self.tokenizer.apply_chat_template(
             messages, return_tensors="pt", return_dict=True, add_generation_prompt=True
         ).to(self.device)
-        outputs = self.model.generate(**input_ids, **generate_kwargs)[0]
+        tokenize_seconds = time.perf_counter() - start
+
+        stopping_criteria = [CancelCriteria(cancel_event)] if cancel_event is not None else []
+        timings: List[TokenTiming] = []
+
+        def with_streamer(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+            # A retry streams and times the answer again from the start
+            timings.append(TokenTiming())
+            kwargs = {**kwargs, "stopping_criteria": stopping_criteria + [timings[-1]]}
+            if on_text is None:
+                return kwargs
+            return {**kwargs, "streamer": CallbackStreamer(self.tokenizer, on_text)}
+
+        # Assisted decoding counts the forward passes of the model, which a shared model cannot tell apart
+        if not assisted or self.batched_generator is not None:
+            outputs = self._generate_ids(input_ids, with_streamer(generate_kwargs), kv_cache)
+        else:
+            try:
+                outputs = self._generate_assisted(input_ids, with_streamer(generate_kwargs), kv_cache)
+            except Exception as e:
+                if not self.assisted_decoding.is_active or (cancel_event is not None and cancel_event.is_set()):
+                    raise
+                # The text streamed so far is replaced as soon as the plain generation streams its own
+                self.assisted_decoding.fall_back(f"generation failed with {type(e).__name__}: {e}")
+                outputs = self._generate_assisted(input_ids, with_streamer(generate_kwargs), kv_cache)
+
+        if cancel_event is not None and cancel_event.is_set():
+            raise GenerationCancelled()
+
+        prompt_tokens = input_ids["input_ids"].shape[1]
+        self.last_generation_stats = {
+            "tokenize_ms": 1000 * tokenize_seconds,
+            "prompt_tokens": prompt_tokens,
+            "reused_tokens": kv_cache.last_reused_tokens if kv_cache is not None else 0,
+            **timings[-1].report(outputs.shape[0] - prompt_tokens),
+        }
 
         all_text = self.tokenizer.decode(outputs)
         model_response = self._parse_model_answer(all_text)
         return model_response
 
-    def _generate_response(self, last_k_messages: Optional[int] = None) -> str:
-        selected_messages = self.mixed_messages
+    def _generate_ids(
+            self,
+            input_ids: Dict[str, torch.Tensor],
+            generate_kwargs: Dict[str, Any],
+            kv_cache: Optional[KVCache] = None,
+    ) -> torch.LongTensor:
+        if self.batched_generator is not None:
+            return self.batched_generator.generate(input_ids["input_ids"], generate_kwargs, kv_cache)
+
+        if kv_cache is not None:
+            past_key_values = kv_cache.prepare(input_ids["input_ids"])
+            # Gemma2 asks for a hybrid cache by default, which cannot be truncated between turns
+            generate_kwargs = {**generate_kwargs, "past_key_values": past_key_values, "cache_implementation": None}
+
+        try:
+            outputs = self.model.generate(**input_ids, **generate_kwargs)[0]
+        except Exception:
+            if kv_cache is not None:
+                kv_cache.reset()
+            raise
+
+        if kv_cache is not None:
+            kv_cache.update(outputs)
+        return outputs
+
+    def _generate_assisted(
+            self,
+            input_ids: Dict[str, torch.Tensor],
+            generate_kwargs: Dict[str, Any],
+            kv_cache: Optional[KVCache] = None,
+    ) -> torch.LongTensor:
+        # Assisted decoding rolls the cache back after rejected drafts, which a dynamic cache supports
+        if kv_cache is None and self.assisted_decoding.is_active:
+            generate_kwargs = {**generate_kwargs, "cache_implementation": None}
+
+        generate_kwargs = {**generate_kwargs, **self.assisted_decoding.generate_kwargs()}
+        with self.assisted_decoding.monitor(self.model) as monitor:
+            outputs = self._generate_ids(input_ids, generate_kwargs, kv_cache)
+
+        prompt_tokens = input_ids["input_ids"].shape[1]
+        # The prompt lookup may accept a few drafted tokens past the limit, the response keeps to it
+        if "max_new_tokens" in generate_kwargs:
+            outputs = outputs[:prompt_tokens + generate_kwargs["max_new_tokens"]]
+
+        prefill_tokens = prompt_tokens
+        if kv_cache is not None:
+            prefill_tokens = kv_cache.last_prompt_tokens - kv_cache.last_reused_tokens
+        self.last_decoding_report = monitor.report(outputs.shape[0] - prompt_tokens, prefill_tokens)
+        self.assisted_decoding.record_turn(self.last_decoding_report)
+        return outputs
+
+    def _generate_response(
+            self,
+            last_k_messages: Optional[int] = None,
+            cancel_event: Optional[threading.Event] = None,
+            on_response_text: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        selected_messages = self.conversation_window.build(self.mixed_messages)
         if last_k_messages is not None:
-            selected_messages = self.mixed_messages[-last_k_messages:]
+            selected_messages = selected_messages[-last_k_messages:]
 
-        model_answer = self._generate(selected_messages, self.generate_response_kwargs)
+        model_answer = self._generate(
+            selected_messages, self.generate_response_kwargs, cancel_event, on_response_text, self.session_cache,
+            assisted=True,
+        )
         self._add_model_message(model_answer)
         return model_answer
 
-    def _identify_mood(self, text: str) -> str:
+    def _mood_messages(self, text: str) -> List[Dict[str, str]]:
+        # The instruction comes before the text, so every mood prompt starts with the same tokens
         prompt = (
-            f'Analyze this text {text} and select the most appropriate mood from the following list: {self.emotion_list}'
-            f'Answer in one word, e.g. {self.emotion_list[0]}. \n'
+            f'Select the most appropriate mood for the text below from the following list: {self.emotion_list}. '
+            f'Answer in one word, e.g. {self.emotion_list[0]}.\n'
+            f'Text: {text}\n'
         )
-        messages = [
+        return [
             {
                 'role': 'user',
                 'content': prompt,
             }
         ]
-        mood = self._generate(messages, self.generate_mood_kwargs)
-        mood = self.parse_only_letters(mood)
-        return mood
+
+    @property
+    def _mood_prefix_key(self):
+        return tuple(self.emotion_list), tuple(sorted((k, repr(v)) for k, v in self.generate_mood_kwargs.items()))
+
+    def _build_mood_prefix_cache(self):
+        # The shared prefix is whatever the prompts of two unrelated texts have in common
+        prompts = [
+            self.tokenizer.apply_chat_template(
+                self._mood_messages(text), return_tensors="pt", add_generation_prompt=True
+            )[0]
+            for text in ("a", "Z")
+        ]
+        prefix_length = common_prefix_length(*prompts)
+        self.mood_prefix_cache.build(self.model, prompts[0][:prefix_length], self._mood_prefix_key)
+
+        end_of_turn_id = self.tokenizer.convert_tokens_to_ids("<end_of_turn>")
+        self.mood_scorer = MoodScorer(self.tokenizer, self.emotion_list, end_of_turn_id)
+
+    @torch.no_grad()
+    def score_mood(self, text: str, cancel_event: Optional[threading.Event] = None) -> Dict[str, float]:
+        with self.model_lock:
+            return self._score_mood(text, cancel_event)
+
+    def _score_mood(self, text: str, cancel_event: Optional[threading.Event] = None) -> Dict[str, float]:
+        if self.mood_scorer is None or not self.mood_prefix_cache.is_valid(self._mood_prefix_key):
+            self._build_mood_prefix_cache()
+
+        input_ids = self.tokenizer.apply_chat_template(
+            self._mood_messages(text), return_tensors="pt", add_generation_prompt=True
+        ).to(self.device)
+        past_key_values = self.mood_prefix_cache.prepare(input_ids)
+        new_input_ids = input_ids[:, self.mood_prefix_cache.last_reused_tokens:]
+
+        # A single forward pass gives the logits of the first token of every emotion
+        logits = self.model(
+            input_ids=new_input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            use_cache=True,
+            logits_to_keep=1,
+        ).logits[0, -1]
+        if cancel_event is not None and cancel_event.is_set():
+            raise GenerationCancelled()
+
+        return self.mood_scorer.score(self.model, logits, past_key_values, self.generate_mood_kwargs["temperature"])
+
+    def _identify_mood(self, text: str, cancel_event: Optional[threading.Event] = None) -> str:
+        self.mood_distribution = self.mood_detector.detect(text, cancel_event)
+        return max(self.mood_distribution, key=self.mood_distribution.get)
 
     def generate_answer(
             self,
             user_input: str,
-            last_k_messages: Optional[int] = None
+            last_k_messages: Optional[int] = None,
+            cancel_event: Optional[threading.Event] = None,
+            on_response_text: Optional[Callable[[str], None]] = None,
     ) -> Dict[str, str]:
+        """
+        Generate the answer of the character to the user input.
+
+        With a `response_cache`, a message it has answered before in the same
+        context may get a cached answer instead, streamed all at once.
+
+        Arguments
+        ---------
+        user_input : str
+            The message of the player.
+        last_k_messages : Optional[int]
+            Only the last k messages of the conversation are sent to the model.
+            The conversation window already keeps the prompt under its token
+            budget, so this is rarely needed.
+        cancel_event : Optional[threading.Event]
+            When set, the generation stops and `GenerationCancelled` is raised.
+        on_response_text : Optional[Callable[[str], None]]
+            Called with the response generated so far every time new text
+            is decoded, before the mood is identified.
+
+        Returns
+        -------
+        dict[str, str]
+            The "response" of the character and its "emotion". Where the time
+            went is left in `last_turn_stats`: the prompt and reused tokens,
+            the tokenization, the time to the first token, the decode speed,
+            the mood latency, and on CUDA the "peak_memory_mb" of the turn,
+            on CPU only the "process_peak_rss_mb" of the process so far.
+        """
+
+        start = time.perf_counter()
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = self.response_cache.make_key(user_input, self._response_cache_context())
+        if cache_key is not None:
+            cached_answer = self.response_cache.get(cache_key)
+            if cached_answer is not None:
+                self._add_user_message(user_input)
+                self._add_model_message(cached_answer["response"])
+                self._trim_history()
+                self.mood_distribution = {cached_answer["emotion"]: 1.0}
+                if on_response_text is not None:
+                    on_response_text(cached_answer["response"])
+                self.last_turn_stats = {"cached": True, "total_ms": 1000 * (time.perf_counter() - start)}
+                return cached_answer
+
+        len_chat = self.len_chat
         self._add_user_message(user_input)
 
-        model_response = self._generate_response(last_k_messages)
-        mood = self._identify_mood(model_response)
+        try:
+            model_response = self._generate_response(last_k_messages, cancel_event, on_response_text)
+            mood_start = time.perf_counter()
+            mood = self._identify_mood(model_response, cancel_event)
+        except Exception:
+            # Drop the unanswered turn (cancelled or failed) so the history keeps alternating
+            self._remove_last_messages(self.len_chat - len_chat)
+            raise
+
+        # Only a complete turn is trimmed, the rollback above counts on the older messages being there
+        self._trim_history()
+        end = time.perf_counter()
+        self.last_turn_stats = {
+            "cached": False,
+            **self.last_generation_stats,
+            "mood_ms": 1000 * (end - mood_start),
+            "total_ms": 1000 * (end - start),
+            **self._memory_stats(),
+        }
+
+        answer = {'emotion': mood, 'response': model_response}
+        if cache_key is not None:
+            self.response_cache.put(cache_key, answer, end - start)
+        return answer
+
+    def _response_cache_context(self) -> str:
+        # Everything besides the player message that the answer depends on
+        count = self.response_cache_context_messages
+        recent_messages = self.chat_messages_simple[-count:] if count > 0 else []
+        return fingerprint(
+            self.model_name,
+            self.character_name,
+            self.player_name,
+            self.emotion_list,
+            sorted((name, repr(value)) for name, value in self.generate_response_kwargs.items()),
+            [(message["role"], message["content"]) for message in recent_messages],
+        )
 
-        return {'emotion': mood, 'response': model_response}
+    def _memory_stats(self) -> Dict[str, float]:
+        if self.device.type == "cuda":
+            # Reset at the start of every turn
+            return {"peak_memory_mb": torch.cuda.max_memory_allocated(self.device) / 1024 ** 2}
+        try:
+            import resource
+        except ImportError:
+            # Not available on Windows
+            return {}
+        # Only the peak of the whole process so far is known, in KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {"process_peak_rss_mb": peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024}
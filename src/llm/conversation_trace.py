@@ -0,0 +1,105 @@
+import json
+import os
+import time
+from typing import Optional, List, Dict, Any
+
+
+TRACE_VERSION = 1
+
+
+class ConversationRecorder:
+    """
+    Appends the conversation of a game to a trace file, to replay it later.
+
+    The trace is a JSON lines file. Every game run starts with a "session"
+    record holding the names, the emotions and the mood detector, then
+    every turn is a "turn" record with the "prompt" of the player, its
+    "status" ("done", "cancelled" or "error"), the "response", "emotion"
+    and "stats" of the answer when done, and the "submitted" and
+    "finished" wall clock times. A file can hold many sessions.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            character_name: str,
+            player_name: str,
+            emotion_list: List[str],
+            mood_detector: str,
+    ):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        self._turn: Optional[Dict[str, Any]] = None
+        self.turns = 0
+
+        self._write({
+            "type": "session",
+            "version": TRACE_VERSION,
+            "started": time.time(),
+            "character_name": character_name,
+            "player_name": player_name,
+            "emotion_list": list(emotion_list),
+            "mood_detector": mood_detector,
+        })
+
+    def _write(self, record: Dict[str, Any]):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def record_prompt(self, prompt: str):
+        self._turn = {"type": "turn", "index": self.turns, "prompt": prompt, "submitted": time.time()}
+
+    def record_answer(self, answer: Dict[str, str], stats: Optional[Dict[str, Any]] = None):
+        self._finish_turn("done", response=answer["response"], emotion=answer["emotion"], stats=stats or {})
+
+    def record_outcome(self, status: str, error: Optional[str] = None):
+        """
+        Record a turn that got no answer, its status is "cancelled" or "error".
+        """
+
+        self._finish_turn(status, error=error)
+
+    def _finish_turn(self, status: str, **fields):
+        if self._turn is None:
+            return
+
+        self._write({**self._turn, "status": status, "finished": time.time(), **fields})
+        self._turn = None
+        self.turns += 1
+
+    def close(self):
+        self._file.close()
+
+
+def load_traces(path: str) -> List[Dict[str, Any]]:
+    """
+    Read the sessions of a trace file.
+
+    Returns
+    -------
+    list[dict[str, Any]]
+        Every "session" record with its "turns" in order, sessions without turns are skipped.
+    """
+
+    sessions = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A game that crashed mid-write leaves a truncated last line
+                print(f"Ignoring the invalid line {line_number} of {path}")
+                continue
+
+            if record["type"] == "session":
+                if record.get("version") != TRACE_VERSION:
+                    raise ValueError(f"Unsupported trace version {record.get('version')} in {path}")
+                sessions.append({**record, "turns": []})
+            elif record["type"] == "turn" and sessions:
+                sessions[-1]["turns"].append(record)
+    return [session for session in sessions if session["turns"]]
@@ -0,0 +1,185 @@
+from collections import OrderedDict
+from typing import List, Dict, Callable, Optional
+
+from transformers import PreTrainedTokenizerBase
+
+from src.text_utils.sentence_split import SentenceSplitter
+
+
+Message = Dict[str, str]
+
+
+class TokenCounter:
+    """
+    Counts the tokens of chat messages, remembering the count of the recent ones.
+
+    A message is counted once with its chat template markers, so the sum
+    of the counts is the length of the prompt up to a few tokens.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, max_entries: int = 512):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self._counts: "OrderedDict[tuple, int]" = OrderedDict()
+
+    def __call__(self, message: Message) -> int:
+        key = (message["role"], message["content"])
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts.move_to_end(key)
+            return count
+
+        text = f"<start_of_turn>{message['role']}\n{message['content'].strip()}<end_of_turn>\n"
+        count = len(self.tokenizer.encode(text, add_special_tokens=False))
+        self._counts[key] = count
+        if len(self._counts) > self.max_entries:
+            self._counts.popitem(last=False)
+        return count
+
+
+class ConversationWindow:
+    """
+    Keeps the prompt of a conversation under a token budget.
+
+    When the messages do not fit into the budget anymore, the oldest
+    user/model pairs are folded into a running summary, which is placed at
+    the start of the first message that is still sent. Folding goes down
+    to `low_water` of the budget, so the start of the prompt only changes
+    every few turns and the key value cache of the session stays valid in
+    between. The summary itself has a token budget too, its oldest parts
+    are dropped first.
+    """
+
+    def __init__(
+            self,
+            count_tokens: Callable[[Message], int],
+            token_budget: int = 2048,
+            summary_token_budget: int = 256,
+            low_water: float = 0.75,
+            summarize: Optional[Callable[[List[Message]], List[str]]] = None,
+    ):
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+        self.summary_token_budget = summary_token_budget
+        self.low_water = low_water
+        self.summarize = summarize if summarize is not None else summarize_first_sentences
+        self.reset()
+
+    def reset(self):
+        # Number of messages, from the start of the history, that are already in the summary
+        self.folded_messages = 0
+        self.summary_parts: List[str] = []
+
+    @property
+    def summary(self) -> str:
+        return " ".join(self.summary_parts)
+
+    def _summary_message(self) -> Message:
+        return {"role": "user", "content": f"Summary of the earlier conversation: {self.summary}\n\n"}
+
+    def _count(self, messages: List[Message]) -> int:
+        total = sum(self.count_tokens(message) for message in messages)
+        if self.summary_parts:
+            total += self.count_tokens(self._summary_message())
+        return total
+
+    def _fold(self, messages: List[Message]):
+        self.summary_parts.extend(self.summarize(messages))
+        self.folded_messages += len(messages)
+
+        while len(self.summary_parts) > 1 and self.count_tokens(self._summary_message()) > self.summary_token_budget:
+            self.summary_parts.pop(0)
+
+    def build(self, messages: List[Message]) -> List[Message]:
+        """
+        Select the messages to send to the model, folding the oldest ones if needed.
+
+        Arguments
+        ---------
+        messages : list[dict[str, str]]
+            The whole history, alternating user and model messages and
+            ending with the user message to answer.
+
+        Returns
+        -------
+        list[dict[str, str]]
+            The messages that fit into the budget, with the summary in front of the first one.
+        """
+
+        self.folded_messages = min(self.folded_messages, max(0, len(messages) - 1))
+        window = messages[self.folded_messages:]
+
+        if self._count(window) > self.token_budget:
+            target = self.token_budget * self.low_water
+            fold_count = 0
+            # Fold whole user/model pairs and always keep the message to answer
+            while fold_count + 2 < len(window) and self._count(window[fold_count:]) > target:
+                fold_count += 2
+
+            if fold_count > 0:
+                self._fold(window[:fold_count])
+                window = window[fold_count:]
+
+        if not self.summary_parts:
+            return list(window)
+
+        first_message = {**window[0], "content": self._summary_message()["content"] + window[0]["content"]}
+        return [first_message] + window[1:]
+
+    def fold_through(self, messages: List[Message], count: int):
+        """
+        Make sure the first `count` messages of the history are in the summary.
+        """
+
+        if count > self.folded_messages:
+            self._fold(messages[self.folded_messages:count])
+
+    def forget(self, count: int):
+        """
+        Tell the window that the first `count` messages were removed from the history.
+        """
+
+        self.folded_messages = max(0, self.folded_messages - count)
+
+
+_sentence_splitter = SentenceSplitter()
+
+
+def summarize_first_sentences(
+        messages: List[Message],
+        speakers: Optional[Dict[str, str]] = None,
+        max_characters: int = 160,
+) -> List[str]:
+    """
+    Summarize every message by its first sentence, which costs no model call.
+
+    Arguments
+    ---------
+    messages : list[dict[str, str]]
+        The messages to summarize.
+    speakers : Optional[dict[str, str]]
+        The name to use for every role, e.g. {"user": "Akriel", "model": "Monika"}.
+    max_characters : int
+        Longer sentences are cut at a word boundary.
+
+    Returns
+    -------
+    list[str]
+        One part of the summary for every message that has any text.
+    """
+
+    if speakers is None:
+        speakers = {"user": "The player", "model": "You"}
+
+    parts = []
+    for message in messages:
+        sentences = _sentence_splitter(message["content"])
+        if not sentences:
+            continue
+
+        sentence = sentences[0]
+        if len(sentence) > max_characters:
+            sentence = sentence[:max_characters].rsplit(" ", 1)[0] + "..."
+        parts.append(f"{speakers.get(message['role'], message['role'])}: {sentence}")
+
+    return parts
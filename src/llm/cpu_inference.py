@@ -0,0 +1,89 @@
+import os
+import time
+from typing import Optional, Dict, Any
+
+import torch
+from torch import nn
+from transformers import PreTrainedModel, PreTrainedTokenizerBase
+
+
+def configure_cpu_threads(num_threads: Optional[int] = None, num_interop_threads: Optional[int] = None):
+    """
+    Set how many threads torch uses on the CPU, None keeps the current value.
+
+    The number of inter-op threads can only be changed before torch runs its
+    first parallel operation, afterward the request is ignored with a warning.
+    """
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            print(f"Could not set the number of inter-op threads: {e}")
+
+
+def default_num_threads() -> int:
+    # Hyper-threads do not help the matrix multiplications, physical cores are usually the sweet spot
+    cpu_count = os.cpu_count() or 1
+    return max(1, cpu_count // 2)
+
+
+def quantize_linear_layers(model: PreTrainedModel) -> PreTrainedModel:
+    """
+    Replace the linear layers of the model by dynamically quantized int8 ones.
+
+    The weights are stored in int8 and the activations are quantized on the
+    fly, which cuts the memory traffic of the float32 weights, the
+    bottleneck of decoding on a CPU, by four. The model must be in float32.
+    The output head is left as is, its weight is tied to the embeddings and
+    generate() reads its dtype.
+    """
+
+    torch.ao.quantization.quantize_dynamic(model.model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+@torch.no_grad()
+def measure_tokens_per_second(
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizerBase,
+        new_tokens: int = 16,
+) -> float:
+    """
+    Time a short greedy generation and return the decoding speed.
+
+    Arguments
+    ---------
+    model : PreTrainedModel
+        The model to measure.
+    tokenizer : PreTrainedTokenizerBase
+        The tokenizer of the model.
+    new_tokens : int
+        How many tokens are generated.
+
+    Returns
+    -------
+    float
+        The number of generated tokens per second, prefill included.
+    """
+
+    messages = [{"role": "user", "content": "Say hello to the Literature Club."}]
+    inputs = tokenizer.apply_chat_template(
+        messages, return_tensors="pt", return_dict=True, add_generation_prompt=True
+    ).to(model.device)
+
+    start = time.perf_counter()
+    outputs = model.generate(**inputs, max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=False)
+    elapsed = time.perf_counter() - start
+
+    generated_tokens = outputs.shape[1] - inputs["input_ids"].shape[1]
+    return generated_tokens / elapsed
+
+
+def describe_cpu_settings(settings: Dict[str, Any]) -> str:
+    dtype = "int8 dynamic" if settings["quantize_int8"] else str(settings["dtype"]).replace("torch.", "")
+    compiled = ", compiled" if settings["compile"] else ""
+    return f"cpu ({dtype}, {torch.get_num_threads()} threads, {torch.get_num_interop_threads()} inter-op{compiled})"
@@ -0,0 +1,2 @@
+class GenerationCancelled(Exception):
+    pass
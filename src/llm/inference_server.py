@@ -0,0 +1,409 @@
+"""
+Local inference server: one model serving the chat sessions of many games.
+
+Run from the root of the repository, then start the games with the
+INFERENCE_SERVER_URL environment variable set to the printed address:
+
+    python -m src.llm.inference_server --port 8765 --max-batch-size 8
+
+With --response-cache, the sessions share a cache of the answers to
+repeated player messages, kept in that file between runs.
+
+The server speaks JSON over HTTP on localhost:
+
+    GET    /health                   {"loaded", "load_error", "progress"}
+    GET    /stats                    the sessions, the batched generator and the response cache
+    POST   /sessions                 {"character_name", "player_name", "emotion_list", "mood_detector"}
+                                     -> {"session_id"}
+    DELETE /sessions/<id>
+    POST   /sessions/<id>/reset      forget the conversation
+    POST   /sessions/<id>/cancel     cancel the answer being generated
+    POST   /sessions/<id>/answer     {"user_input", "last_k_messages"}
+
+An answer is streamed as one JSON object per line, with the statuses of
+the InferenceWorker responses: "partial" with the "text" generated so
+far, then one of "done" with the "answer" and the "stats" of the turn,
+"cancelled" or "error" with the "error" message.
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+import traceback
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, List, Dict, Any
+
+from src.llm.batched_generation import BatchedGenerator
+from src.llm.chat_gemma2 import ChatGemma2
+from src.llm.errors import GenerationCancelled
+from src.llm.model_loading import LoadingProgress
+from src.llm.response_cache import ResponseCache
+
+
+class ChatSession:
+    def __init__(self, session_id: str, llm: ChatGemma2):
+        self.session_id = session_id
+        self.llm = llm
+        # One answer at a time, the history has to alternate
+        self.lock = threading.Lock()
+        self.cancel_event: Optional[threading.Event] = None
+        self.last_used = time.monotonic()
+        self.answers = 0
+
+
+class InferenceServer:
+    """
+    Holds one model and serves the chat sessions of many clients over localhost HTTP.
+
+    Every session is a `ChatGemma2.new_session` of the loaded model, with
+    its own history and KV cache, and its answers are generated by one
+    `BatchedGenerator`, so the decode steps of all the sessions that are
+    answering at the same time share forward passes. `RemoteChatGemma2`
+    is the client, the game uses it instead of ChatGemma2.
+
+    Sessions unused for `session_timeout` seconds are closed when new ones
+    are created, at most `max_sessions` are open at once.
+    """
+
+    def __init__(
+            self,
+            llm: ChatGemma2,
+            host: str = "127.0.0.1",
+            port: int = 8765,
+            max_batch_size: int = 8,
+            max_sessions: int = 64,
+            session_timeout: float = 3600.0,
+    ):
+        self.llm = llm
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.max_sessions = max_sessions
+        self.session_timeout = session_timeout
+        self.progress = LoadingProgress()
+        self.load_error: Optional[str] = None
+        self.generator: Optional[BatchedGenerator] = None
+
+        self._sessions: Dict[str, ChatSession] = {}
+        self._lock = threading.Lock()
+        self._http_server: Optional[ThreadingHTTPServer] = None
+        self._http_thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.generator is not None
+
+    def start(self):
+        """
+        Start answering requests on a background thread, port 0 picks a free port.
+        """
+
+        self._http_server = ThreadingHTTPServer((self.host, self.port), _RequestHandler)
+        self._http_server.daemon_threads = True
+        self._http_server.inference_server = self
+        self.port = self._http_server.server_address[1]
+        self._http_thread = threading.Thread(
+            target=self._http_server.serve_forever, name="InferenceServer", daemon=True
+        )
+        self._http_thread.start()
+
+    def load(self):
+        """
+        Load the model unless it is already loaded, then start generating.
+
+        Requests for new sessions are refused until then, `/health` reports the progress.
+        """
+
+        try:
+            if not self.llm.is_model_loaded:
+                self.llm.post_init(self.progress)
+        except Exception as e:
+            traceback.print_exc()
+            self.load_error = str(e)
+            return
+
+        generator = BatchedGenerator(self.llm.model, self.max_batch_size)
+        self.llm.batched_generator = generator
+        self.llm.model_lock = generator.model_lock
+        generator.start()
+        self.progress.set_stage("ready")
+        self.generator = generator
+
+    def stop(self):
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            if session.cancel_event is not None:
+                session.cancel_event.set()
+        if self.generator is not None:
+            self.generator.stop(timeout=5.0)
+
+    def create_session(
+            self,
+            character_name: str,
+            player_name: str,
+            emotion_list: List[str],
+            mood_detector: str = "llm",
+    ) -> str:
+        if not self.is_loaded:
+            raise RuntimeError("The model is not loaded yet.")
+
+        with self._lock:
+            now = time.monotonic()
+            for session_id, session in list(self._sessions.items()):
+                if now - session.last_used > self.session_timeout and not session.lock.locked():
+                    del self._sessions[session_id]
+            if len(self._sessions) >= self.max_sessions:
+                raise RuntimeError(f"Too many sessions, at most {self.max_sessions} are served.")
+
+            # Sessions with the same emotions share the prefix cache of the mood prompt
+            template = next(
+                (session.llm for session in self._sessions.values() if session.llm.emotion_list == emotion_list),
+                self.llm,
+            )
+            session_id = uuid.uuid4().hex
+            llm = template.new_session(character_name, player_name, emotion_list, mood_detector)
+            self._sessions[session_id] = ChatSession(session_id, llm)
+        return session_id
+
+    def get_session(self, session_id: str) -> Optional[ChatSession]:
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def close_session(self, session_id: str) -> bool:
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None and session.cancel_event is not None:
+            session.cancel_event.set()
+        return session is not None
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "answering": sum(session.lock.locked() for session in sessions),
+            "answers": sum(session.answers for session in sessions),
+            "generator": self.generator.get_stats() if self.generator is not None else None,
+            "response_cache": self.llm.response_cache.get_stats() if self.llm.response_cache is not None else None,
+        }
+
+    def answer(self, session: ChatSession, user_input: str, last_k_messages: Optional[int]) -> "queue.Queue":
+        """
+        Generate the answer of a session on a new thread, the session lock must be held.
+
+        Returns
+        -------
+        queue.Queue
+            Receives the responses, "partial" ones until the final one, after
+            which the session lock is released.
+        """
+
+        responses: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        cancel_event = threading.Event()
+        session.cancel_event = cancel_event
+
+        def run():
+            try:
+                answer = session.llm.generate_answer(
+                    user_input,
+                    last_k_messages=last_k_messages,
+                    cancel_event=cancel_event,
+                    on_response_text=lambda text: responses.put({"status": "partial", "text": text}),
+                )
+            except GenerationCancelled:
+                response = {"status": "cancelled"}
+            except Exception as e:
+                traceback.print_exc()
+                response = {"status": "error", "error": str(e)}
+            else:
+                session.answers += 1
+                response = {"status": "done", "answer": answer, "stats": session.llm.last_turn_stats}
+
+            session.cancel_event = None
+            session.last_used = time.monotonic()
+            session.lock.release()
+            responses.put(response)
+
+        threading.Thread(target=run, name=f"Session-{session.session_id[:8]}", daemon=True).start()
+        return responses
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server_version = "InferenceServer/1.0"
+
+    @property
+    def inference_server(self) -> InferenceServer:
+        return self.server.inference_server
+
+    def log_message(self, format: str, *args):
+        # Every streamed answer would print a line
+        pass
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        if length == 0:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def _send_json(self, status: int, body: Dict[str, Any]):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _session_route(self) -> Optional[tuple]:
+        parts = self.path.strip("/").split("/")
+        if len(parts) < 2 or parts[0] != "sessions":
+            return None
+        return parts[1], "/".join(parts[2:])
+
+    def do_GET(self):
+        server = self.inference_server
+        if self.path == "/health":
+            self._send_json(200, {
+                "loaded": server.is_loaded,
+                "load_error": server.load_error,
+                "progress": server.progress.snapshot(),
+            })
+        elif self.path == "/stats":
+            self._send_json(200, server.get_stats())
+        else:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_DELETE(self):
+        route = self._session_route()
+        if route is None or route[1]:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+        elif self.inference_server.close_session(route[0]):
+            self._send_json(200, {})
+        else:
+            self._send_json(404, {"error": "Unknown session."})
+
+    def do_POST(self):
+        server = self.inference_server
+        try:
+            body = self._read_json()
+        except ValueError as e:
+            self._send_json(400, {"error": f"Invalid JSON: {e}"})
+            return
+
+        if self.path == "/sessions":
+            try:
+                session_id = server.create_session(
+                    body["character_name"], body["player_name"], body["emotion_list"], body.get("mood_detector", "llm")
+                )
+            except KeyError as e:
+                self._send_json(400, {"error": f"Missing field: {e}"})
+            except (RuntimeError, ValueError) as e:
+                self._send_json(503, {"error": str(e)})
+            else:
+                self._send_json(200, {"session_id": session_id})
+            return
+
+        route = self._session_route()
+        session = server.get_session(route[0]) if route is not None else None
+        if session is None:
+            self._send_json(404, {"error": "Unknown session."})
+            return
+
+        action = route[1]
+        if action == "cancel":
+            cancel_event = session.cancel_event
+            if cancel_event is not None:
+                cancel_event.set()
+            self._send_json(200, {})
+        elif action == "reset":
+            with session.lock:
+                session.llm.reset_messages()
+            self._send_json(200, {})
+        elif action == "answer":
+            if "user_input" not in body:
+                self._send_json(400, {"error": "Missing field: 'user_input'"})
+            elif not session.lock.acquire(blocking=False):
+                self._send_json(409, {"error": "The session is already answering."})
+            else:
+                responses = server.answer(session, body["user_input"], body.get("last_k_messages"))
+                self._stream(session, responses)
+        else:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def _stream(self, session: ChatSession, responses: "queue.Queue"):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        # Without a length the end of the stream is the end of the connection
+        self.close_connection = True
+
+        connected = True
+        while True:
+            batch = [responses.get()]
+            while True:
+                try:
+                    batch.append(responses.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Every partial response holds the whole text so far, only the latest one is worth sending
+            lines = [
+                json.dumps(response) + "\n" for index, response in enumerate(batch)
+                if response["status"] != "partial" or index == len(batch) - 1
+                or batch[index + 1]["status"] != "partial"
+            ]
+            if connected:
+                try:
+                    self.wfile.write("".join(lines).encode("utf-8"))
+                    self.wfile.flush()
+                except OSError:
+                    # The client is gone, nobody is waiting for the rest of the answer
+                    connected = False
+                    if session.cancel_event is not None:
+                        session.cancel_event.set()
+
+            if batch[-1]["status"] != "partial":
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-sessions", type=int, default=64)
+    parser.add_argument("--response-cache", help="Answer repeated player messages from this cache file")
+    args = parser.parse_args()
+
+    response_cache = ResponseCache(args.response_cache) if args.response_cache is not None else None
+    # The sessions bring their own names and emotions, these only set up the shared model
+    llm = ChatGemma2("Monika", "Player", ["happy"], mood_detector="lexicon", response_cache=response_cache)
+    server = InferenceServer(llm, args.host, args.port, args.max_batch_size, args.max_sessions)
+    server.start()
+    print(f"Inference server listening on {server.url}, loading the model")
+    server.load()
+    if server.load_error is not None:
+        server.stop()
+        raise SystemExit(1)
+
+    print(f"Model loaded ({llm.inference_mode}), serving up to {args.max_batch_size} sessions per batch")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import queue
+import threading
+import traceback
+from typing import Optional, List, Dict, Any, Callable, TYPE_CHECKING
+
+from src.llm.errors import GenerationCancelled
+from src.llm.model_loading import LoadingProgress
+
+if TYPE_CHECKING:
+    from src.llm.chat_gemma2 import ChatGemma2
+
+
+class InferenceRequest:
+    def __init__(self, request_id: int, prompt: str):
+        self.request_id = request_id
+        self.prompt = prompt
+        self.cancel_event = threading.Event()
+
+    @property
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+
+class InferenceWorker:
+    """
+    Runs the LLM on a background thread so the game loop never blocks on it.
+
+    Requests are submitted with `submit` and their results are collected with
+    `poll`, which never blocks and is meant to be called once per frame.
+    Every response is a dictionary with the keys "request_id" and "status",
+    where status is one of "partial", "done", "cancelled" or "error". Partial
+    responses carry the "text" streamed so far, done responses carry the
+    "answer" returned by `ChatGemma2.generate_answer` with the "stats" of the
+    turn and error responses carry an "error" message.
+
+    When `load_model` is set, the thread first loads the model, reporting its
+    progress in `progress`, and then sends a response with the status
+    "loaded" or "load_error" and no request id. Requests submitted in the
+    meantime wait in the queue.
+    """
+
+    def __init__(
+            self,
+            llm: "ChatGemma2",
+            last_k_messages: Optional[int] = None,
+            load_model: bool = True,
+            on_response: Optional[Callable[[], None]] = None,
+    ):
+        self.llm = llm
+        self.last_k_messages = last_k_messages
+        self.load_model = load_model
+        # Called from the worker thread every time a response is queued, e.g. to wake up the game loop
+        self.on_response = on_response
+        self.progress = LoadingProgress()
+
+        self._requests: "queue.Queue[Optional[InferenceRequest]]" = queue.Queue()
+        self._responses: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="InferenceWorker", daemon=True)
+
+        self._next_request_id = 0
+        self._pending: Dict[int, InferenceRequest] = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self.cancel_all()
+        self._requests.put(None)
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    @property
+    def is_busy(self):
+        with self._lock:
+            return len(self._pending) > 0
+
+    def submit(self, prompt: str) -> int:
+        with self._lock:
+            request = InferenceRequest(self._next_request_id, prompt)
+            self._next_request_id += 1
+            self._pending[request.request_id] = request
+
+        self._requests.put(request)
+        return request.request_id
+
+    def cancel(self, request_id: int):
+        with self._lock:
+            request = self._pending.get(request_id)
+
+        if request is not None:
+            request.cancel_event.set()
+
+    def cancel_all(self):
+        with self._lock:
+            requests = list(self._pending.values())
+
+        for request in requests:
+            request.cancel_event.set()
+
+    def poll(self) -> List[Dict[str, Any]]:
+        responses = []
+        while True:
+            try:
+                responses.append(self._responses.get_nowait())
+            except queue.Empty:
+                return responses
+
+    def _respond(self, response: Dict[str, Any]):
+        self._responses.put(response)
+        if self.on_response is not None:
+            self.on_response()
+
+    def _stream(self, request: InferenceRequest, text: str):
+        if not request.is_cancelled:
+            self._respond({"request_id": request.request_id, "status": "partial", "text": text})
+
+    def _finish(self, request: InferenceRequest, status: str, **kwargs):
+        with self._lock:
+            self._pending.pop(request.request_id, None)
+
+        self._respond({"request_id": request.request_id, "status": status, **kwargs})
+
+    def _load(self):
+        try:
+            # A lazily created model imports its backend on first use, which takes a while on its own
+            self.progress.set_stage("importing libraries")
+            self.llm.post_init(self.progress)
+        except Exception as e:
+            traceback.print_exc()
+            self._respond({"request_id": None, "status": "load_error", "error": str(e)})
+        else:
+            self._respond({"request_id": None, "status": "loaded"})
+
+    def _run(self):
+        if self.load_model:
+            self._load()
+
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+
+            if request.is_cancelled:
+                self._finish(request, "cancelled")
+                continue
+
+            try:
+                answer = self.llm.generate_answer(
+                    request.prompt,
+                    last_k_messages=self.last_k_messages,
+                    cancel_event=request.cancel_event,
+                    on_response_text=lambda text: self._stream(request, text),
+                )
+            except GenerationCancelled:
+                self._finish(request, "cancelled")
+            except Exception as e:
+                traceback.print_exc()
+                self._finish(request, "error", error=str(e))
+            else:
+                self._finish(request, "done", answer=answer, stats=dict(self.llm.last_turn_stats))
@@ -0,0 +1,69 @@
+import threading
+from typing import Optional, Dict, Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from src.llm.chat_gemma2 import ChatGemma2
+
+
+class LazyChatGemma2:
+    """
+    Stands in for a ChatGemma2 that is only created on first use.
+
+    Importing torch and transformers takes seconds, so the game creates this
+    proxy instead and the window opens right away. The first attribute
+    access, normally `post_init` on the inference worker thread, imports the
+    backend and creates the model. `is_model_loaded` is answered without
+    importing anything.
+
+    Attributes set on the proxy are set on the model, e.g.
+    `max_history_messages` or `response_cache`. Before it is created they
+    are kept and set right after its creation, so they import nothing
+    either.
+    """
+
+    _own_attributes = ("_args", "_kwargs", "_settings", "_llm", "_lock")
+
+    def __init__(self, *args, **kwargs):
+        self._args = args
+        self._kwargs = kwargs
+        self._settings: Dict[str, Any] = {}
+        self._llm: Optional["ChatGemma2"] = None
+        self._lock = threading.Lock()
+
+    @property
+    def llm(self) -> "ChatGemma2":
+        with self._lock:
+            if self._llm is None:
+                from src.llm.chat_gemma2 import ChatGemma2
+                llm = ChatGemma2(*self._args, **self._kwargs)
+                for name, value in self._settings.items():
+                    setattr(llm, name, value)
+                self._settings.clear()
+                self._llm = llm
+            return self._llm
+
+    @property
+    def is_created(self):
+        return self._llm is not None
+
+    @property
+    def is_model_loaded(self):
+        return self._llm is not None and self._llm.is_model_loaded
+
+    def __getattr__(self, name: str):
+        # Only called for the attributes the proxy does not have itself
+        settings = self.__dict__.get("_settings")
+        if settings is not None and name in settings:
+            return settings[name]
+        return getattr(self.llm, name)
+
+    def __setattr__(self, name: str, value: Any):
+        if name in self._own_attributes:
+            super().__setattr__(name, value)
+            return
+
+        with self._lock:
+            if self._llm is None:
+                self._settings[name] = value
+                return
+        setattr(self._llm, name, value)
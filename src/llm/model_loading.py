@@ -0,0 +1,82 @@
+import glob
+import os
+import threading
+from typing import List, Dict, Any
+
+
+class LoadingProgress:
+    """
+    Thread-safe progress of the model loading, written by the loader and read by the UI.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage = "waiting"
+        self.loaded_bytes = 0
+        self.total_bytes = 0
+
+    def set_stage(self, stage: str, total_bytes: int = 0):
+        with self._lock:
+            self.stage = stage
+            self.loaded_bytes = 0
+            self.total_bytes = total_bytes
+
+    def advance(self, num_bytes: int):
+        with self._lock:
+            self.loaded_bytes += num_bytes
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            fraction = None
+            if self.total_bytes > 0:
+                fraction = min(1.0, self.loaded_bytes / self.total_bytes)
+
+            return {
+                "stage": self.stage,
+                "loaded_bytes": self.loaded_bytes,
+                "total_bytes": self.total_bytes,
+                "fraction": fraction,
+            }
+
+    def describe(self) -> str:
+        snapshot = self.snapshot()
+        if snapshot["fraction"] is None:
+            return f"{snapshot['stage']}..."
+        return f"{snapshot['stage']} {snapshot['fraction']:.0%}"
+
+
+def find_checkpoint_files(model_name: str) -> List[str]:
+    """
+    Return the safetensors shards of the model, downloading them only if they are not cached yet.
+    """
+
+    from huggingface_hub import snapshot_download
+
+    allow_patterns = ["*.json", "*.safetensors", "tokenizer*"]
+    try:
+        model_dir = snapshot_download(model_name, allow_patterns=allow_patterns, local_files_only=True)
+    except Exception:
+        model_dir = snapshot_download(model_name, allow_patterns=allow_patterns)
+
+    return sorted(glob.glob(os.path.join(model_dir, "*.safetensors")))
+
+
+def prefetch_files(files: List[str], progress: LoadingProgress, chunk_size: int = 16 * 1024 * 1024):
+    """
+    Read the files once so they sit in the page cache before they are memory-mapped.
+
+    Loading safetensors maps the shards into memory and copies the tensors
+    out of them, so the slow part is reading the pages from disk. Reading
+    them up front through a single reused buffer reports real byte
+    progress, and it does not grow the resident memory of the process.
+    """
+
+    progress.set_stage("reading weights", sum(os.path.getsize(file) for file in files))
+    buffer = bytearray(chunk_size)
+    for file in files:
+        with open(file, "rb", buffering=0) as f:
+            while True:
+                num_bytes = f.readinto(buffer)
+                if not num_bytes:
+                    break
+                progress.advance(num_bytes)
@@ -0,0 +1,170 @@
+import math
+import re
+import threading
+from abc import ABC, abstractmethod
+from typing import List, Dict, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from src.llm.chat_gemma2 import ChatGemma2
+
+
+class MoodDetector(ABC):
+    """
+    Finds the emotion of the character in one of its responses.
+
+    Subclasses implement `detect`, which returns a probability for every
+    emotion of the list. The emotion with the highest probability is the
+    one shown on screen.
+    """
+
+    # Whether the detector needs the language model to be loaded
+    uses_model = False
+
+    @abstractmethod
+    def detect(self, text: str, cancel_event: Optional[threading.Event] = None) -> Dict[str, float]:
+        pass
+
+
+class LLMMoodDetector(MoodDetector):
+    """
+    Scores the emotions with the logits of the chat model itself, see `ChatGemma2.score_mood`.
+    """
+
+    uses_model = True
+
+    def __init__(self, llm: "ChatGemma2"):
+        self.llm = llm
+
+    def detect(self, text: str, cancel_event: Optional[threading.Event] = None) -> Dict[str, float]:
+        return self.llm.score_mood(text, cancel_event)
+
+
+class LexiconMoodDetector(MoodDetector):
+    """
+    Scores the emotions by counting cue words, without any model.
+
+    Every emotion has a small lexicon of weighted words. Words that follow a
+    negation do not count for their emotion, and punctuation adds a few
+    extra cues. The scores are turned into probabilities with a softmax.
+    Emotions that have no lexicon are only matched by their own name.
+    It takes a few microseconds per response on a CPU.
+    """
+
+    lexicon: Dict[str, Dict[str, float]] = {
+        "angry": {
+            "angry": 2.0, "mad": 1.5, "furious": 2.0, "annoyed": 1.5, "annoying": 1.5, "hate": 1.5, "stop": 0.5,
+            "enough": 0.5, "rude": 1.0, "unfair": 1.0, "ugh": 1.0, "irritating": 1.5, "frustrated": 1.5,
+            "frustrating": 1.5, "how dare": 2.0,
+        },
+        "concerned": {
+            "worried": 2.0, "worry": 1.5, "concerned": 2.0, "careful": 1.0, "okay": 0.3, "alright": 0.3,
+            "hope": 0.5, "afraid": 1.0, "scared": 1.0, "safe": 0.5, "hurt": 1.0, "sick": 1.0, "tired": 0.5,
+            "are you okay": 2.0, "take care": 1.5,
+        },
+        "confused": {
+            "confused": 2.0, "confusing": 1.5, "what": 0.5, "huh": 1.5, "hmm": 1.0, "strange": 1.0, "weird": 1.0,
+            "understand": 0.5, "mean": 0.5, "sure": 0.3, "wonder": 0.7, "why": 0.5, "not sure": 1.5,
+        },
+        "embarrassed": {
+            "embarrassed": 2.0, "embarrassing": 2.0, "blush": 2.0, "blushing": 2.0, "shy": 1.5, "awkward": 1.5,
+            "silly": 1.0, "flattered": 1.5, "sweet": 0.7, "cute": 1.0, "oops": 1.0, "hehe": 1.0, "ahaha": 1.0,
+        },
+        "glitched": {
+            "glitch": 2.0, "glitched": 2.0, "error": 1.5, "delete": 1.5, "deleted": 1.5, "code": 1.0,
+            "file": 1.0, "files": 1.0, "script": 1.0, "game": 0.3, "reality": 1.0, "real": 0.3, "void": 1.5,
+        },
+        "happy": {
+            "happy": 2.0, "glad": 1.5, "love": 1.5, "great": 1.0, "wonderful": 1.5, "amazing": 1.5, "fun": 1.0,
+            "excited": 1.5, "yay": 1.5, "nice": 0.7, "good": 0.5, "thanks": 0.7, "thank": 0.7, "smile": 1.0,
+            "enjoy": 1.0, "awesome": 1.5, "fantastic": 1.5, "cheerful": 1.5, "haha": 1.0, "welcome": 0.7,
+            "so happy": 1.0,
+        },
+        "neutral": {
+            "well": 0.3, "so": 0.2, "anyway": 0.7, "think": 0.3, "maybe": 0.5, "usually": 0.5, "okay": 0.3,
+        },
+        "sad": {
+            "sad": 2.0, "sorry": 1.0, "miss": 1.5, "lonely": 2.0, "alone": 1.5, "cry": 1.5, "crying": 1.5,
+            "tears": 1.5, "unfortunately": 1.0, "wish": 0.7, "depressed": 2.0, "unhappy": 2.0, "hurts": 1.0,
+            "goodbye": 1.0, "lost": 0.7,
+        },
+        "serious": {
+            "serious": 2.0, "seriously": 1.5, "important": 1.5, "listen": 1.0, "must": 0.7, "should": 0.5,
+            "need": 0.5, "honestly": 1.0, "truth": 1.0, "responsibility": 1.0, "promise": 0.7,
+        },
+        "shocked": {
+            "shocked": 2.0, "shocking": 2.0, "omg": 1.5, "terrible": 1.0, "horrible": 1.5, "no way": 1.5,
+            "unbelievable": 1.5, "gasp": 1.5, "what?!": 1.5,
+        },
+        "surprised": {
+            "surprised": 2.0, "surprise": 1.5, "wow": 1.5, "oh": 0.7, "really": 0.7, "whoa": 1.5,
+            "unexpected": 1.5, "didn't expect": 1.5, "amazing": 0.5,
+        },
+    }
+
+    negations = {"not", "no", "never", "don't", "dont", "didn't", "isn't", "wasn't", "aren't", "can't", "cannot"}
+    neutral_prior = 0.5
+
+    def __init__(self, emotion_list: List[str], sharpness: float = 2.0):
+        self.emotion_list = list(emotion_list)
+        self.sharpness = sharpness
+        self.word_pattern = re.compile(r"[a-z']+[?!]*")
+
+        self.word_weights: Dict[str, Dict[str, float]] = {}
+        self.phrase_weights: Dict[str, Dict[str, float]] = {}
+        for emotion in self.emotion_list:
+            entries = {**self.lexicon.get(emotion, {}), emotion: 2.0}
+            for cue, weight in entries.items():
+                table = self.phrase_weights if " " in cue else self.word_weights
+                table.setdefault(cue, {})[emotion] = weight
+
+    def scores(self, text: str) -> Dict[str, float]:
+        lowered = text.lower()
+        scores = {emotion: 0.0 for emotion in self.emotion_list}
+        if "neutral" in scores:
+            scores["neutral"] = self.neutral_prior
+
+        words = self.word_pattern.findall(lowered)
+        for i, word in enumerate(words):
+            if i > 0 and words[i - 1] in self.negations:
+                continue
+
+            bare_word = word.rstrip("?!")
+            for emotion, weight in self.word_weights.get(word, self.word_weights.get(bare_word, {})).items():
+                scores[emotion] += weight
+
+        for phrase, weights in self.phrase_weights.items():
+            if phrase in lowered:
+                for emotion, weight in weights.items():
+                    scores[emotion] += weight
+
+        punctuation_cues = (
+            ("surprised", lowered.count("!") * 0.3),
+            ("confused", lowered.count("?") * 0.3),
+            ("concerned", lowered.count("...") * 0.5),
+        )
+        for emotion, weight in punctuation_cues:
+            if emotion in scores:
+                scores[emotion] += weight
+
+        return scores
+
+    def detect(self, text: str, cancel_event: Optional[threading.Event] = None) -> Dict[str, float]:
+        scores = self.scores(text)
+        max_score = max(scores.values())
+        exponentials = {emotion: math.exp(self.sharpness * (score - max_score)) for emotion, score in scores.items()}
+        total = sum(exponentials.values())
+        return {emotion: value / total for emotion, value in exponentials.items()}
+
+
+# The names accepted by `create_mood_detector`
+MOOD_DETECTORS = ["llm", "lexicon"]
+
+
+def create_mood_detector(name: str, llm: "ChatGemma2") -> MoodDetector:
+    if name == "llm":
+        return LLMMoodDetector(llm)
+
+    if name == "lexicon":
+        return LexiconMoodDetector(llm.emotion_list)
+
+    raise ValueError(f"Unknown mood detector: {name}")
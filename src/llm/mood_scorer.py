@@ -0,0 +1,129 @@
+from typing import List, Dict, Optional
+
+import torch
+from transformers import DynamicCache, PreTrainedModel, PreTrainedTokenizerBase
+
+
+class TrieNode:
+    def __init__(self):
+        self.children: Dict[int, "TrieNode"] = {}
+        self.labels: List[str] = []
+
+
+class MoodScorer:
+    """
+    Scores every emotion label with the logits of the model instead of letting it generate freely.
+
+    The token sequences of the labels are stored in a trie. The probability
+    of a label is the product of the probabilities of its tokens, where at
+    every node the probabilities are renormalized over the children of that
+    node only. Nodes with a single child need no model call, so when all the
+    labels start with different tokens, the logits of the prompt's last
+    position are enough and the whole decision costs one forward pass.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, labels: List[str], end_token_id: Optional[int] = None):
+        self.labels = list(labels)
+        self.end_token_id = end_token_id if end_token_id is not None else tokenizer.eos_token_id
+        self.root = TrieNode()
+
+        for label in self.labels:
+            # The model may capitalize the answer, both spellings count for the same label
+            for variant in {label, label.capitalize()}:
+                token_ids = tokenizer.encode(variant, add_special_tokens=False)
+                self._insert(token_ids, label)
+
+    def _insert(self, token_ids: List[int], label: str):
+        node = self.root
+        for token_id in token_ids:
+            node = node.children.setdefault(token_id, TrieNode())
+        node.labels.append(label)
+
+    @torch.no_grad()
+    def score(
+            self,
+            model: PreTrainedModel,
+            logits: torch.FloatTensor,
+            past_key_values: DynamicCache,
+            temperature: float = 1.0,
+    ) -> Dict[str, float]:
+        """
+        Compute the probability of every label.
+
+        Arguments
+        ---------
+        model : PreTrainedModel
+            Used only for the nodes of the trie that are shared by several labels.
+        logits : torch.FloatTensor
+            The logits of the next token after the prompt, of shape (vocab_size,).
+        past_key_values : DynamicCache
+            The cache of the prompt, it is copied before being extended.
+        temperature : float
+            Divides the logits before they are normalized.
+
+        Returns
+        -------
+        dict[str, float]
+            The probability of every label, they sum up to 1.
+        """
+
+        probabilities = {label: 0.0 for label in self.labels}
+        self._score_node(self.root, model, logits, past_key_values, [], temperature, 1.0, probabilities)
+        return probabilities
+
+    def _score_node(
+            self,
+            node: TrieNode,
+            model: PreTrainedModel,
+            logits: torch.FloatTensor,
+            past_key_values: DynamicCache,
+            pending_ids: List[int],
+            temperature: float,
+            probability: float,
+            probabilities: Dict[str, float],
+    ):
+        options = list(node.children.items())
+        if node.labels and options:
+            # A label that is the prefix of another one competes with ending the answer here
+            options.append((self.end_token_id, None))
+
+        if not options:
+            for label in node.labels:
+                probabilities[label] += probability / len(node.labels)
+            return
+
+        token_ids = torch.tensor([token_id for token_id, _ in options], device=logits.device)
+        option_probabilities = torch.softmax(logits[token_ids].float() / temperature, dim=-1).tolist()
+
+        for (token_id, child), option_probability in zip(options, option_probabilities):
+            if child is None:
+                for label in node.labels:
+                    probabilities[label] += probability * option_probability / len(node.labels)
+                continue
+
+            # Tokens are only fed to the model once a node that needs their logits is reached
+            child_logits = logits
+            child_cache = past_key_values
+            child_pending_ids = pending_ids + [token_id]
+            if self._is_branching(child):
+                child_cache = DynamicCache.from_legacy_cache(past_key_values.to_legacy_cache())
+                input_ids = torch.tensor([child_pending_ids], device=logits.device)
+                # Gemma2 sizes its causal mask from the attention mask when the cache is dynamic
+                attention_mask = torch.ones(
+                    (1, child_cache.get_seq_length() + input_ids.shape[1]), dtype=torch.long, device=logits.device
+                )
+                child_logits = model(
+                    input_ids=input_ids, attention_mask=attention_mask, past_key_values=child_cache, use_cache=True
+                ).logits[0, -1]
+                child_pending_ids = []
+
+            self._score_node(
+                child, model, child_logits, child_cache, child_pending_ids, temperature,
+                probability * option_probability, probabilities
+            )
+
+    @staticmethod
+    def _is_branching(node: TrieNode) -> bool:
+        # Only nodes that still have to choose between several tokens need the logits after them
+        children = len(node.children) + (1 if node.labels and node.children else 0)
+        return children > 1
@@ -0,0 +1,187 @@
+import http.client
+import json
+import threading
+import time
+from typing import Optional, List, Dict, Any, Callable
+from urllib.parse import urlsplit
+
+from src.llm.errors import GenerationCancelled
+from src.llm.model_loading import LoadingProgress
+
+
+class RemoteChatGemma2:
+    """
+    Stands in for ChatGemma2, with the answers generated by an inference server.
+
+    It has the interface the game and the InferenceWorker use: `post_init`
+    waits for the server to load its model and opens a session there, then
+    `generate_answer` streams the answers of the session. The history is
+    kept by the server. Only the standard library is used, so a game that
+    talks to a server never imports torch.
+
+    See `src.llm.inference_server` for the server.
+    """
+
+    def __init__(
+            self,
+            character_name: str,
+            player_name: str,
+            emotion_list: List[str],
+            mood_detector: str = "llm",
+            url: str = "http://127.0.0.1:8765",
+            timeout: float = 600.0,
+    ):
+        self.character_name = character_name
+        self.player_name = player_name
+        self.emotion_list = emotion_list
+        self.mood_detector = mood_detector
+        self.url = url
+        # Longest wait for the next line of an answer, or for the model to load
+        self.timeout = timeout
+        self.poll_interval = 0.5
+
+        split_url = urlsplit(url)
+        self._host = split_url.hostname or "127.0.0.1"
+        self._port = split_url.port or 80
+        self.session_id: Optional[str] = None
+        self.inference_mode = f"remote ({url})"
+        # As measured by the server
+        self.last_turn_stats: Dict[str, Any] = {}
+
+    @property
+    def is_model_loaded(self):
+        return self.session_id is not None
+
+    def _connect(self) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection(self._host, self._port, timeout=self.timeout)
+
+    def _request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        connection = self._connect()
+        try:
+            data = json.dumps(body).encode("utf-8") if body is not None else None
+            connection.request(method, path, body=data, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            result = json.loads(response.read() or b"{}")
+        finally:
+            connection.close()
+
+        if response.status != 200:
+            raise RuntimeError(f"Inference server error {response.status}: {result.get('error')}")
+        return result
+
+    def post_init(self, progress: Optional[LoadingProgress] = None):
+        """
+        Wait until the server has loaded its model, then open a session.
+
+        Arguments
+        ---------
+        progress : Optional[LoadingProgress]
+            Updated with the loading stage of the server.
+        """
+
+        if progress is None:
+            progress = LoadingProgress()
+
+        progress.set_stage("connecting to the inference server")
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                health = self._request("GET", "/health")
+            except OSError:
+                # The server may still be starting
+                health = None
+
+            if health is not None:
+                if health["load_error"] is not None:
+                    raise RuntimeError(f"The inference server could not load the model: {health['load_error']}")
+                if health["loaded"]:
+                    break
+                server_progress = health["progress"]
+                progress.set_stage(f"server {server_progress['stage']}", server_progress["total_bytes"])
+                progress.advance(server_progress["loaded_bytes"])
+
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"The inference server at {self.url} is not ready.")
+            time.sleep(self.poll_interval)
+
+        progress.set_stage("opening session")
+        self.session_id = self._request("POST", "/sessions", {
+            "character_name": self.character_name,
+            "player_name": self.player_name,
+            "emotion_list": list(self.emotion_list),
+            "mood_detector": self.mood_detector,
+        })["session_id"]
+        progress.set_stage("ready")
+
+    def reset_messages(self):
+        self._request("POST", f"/sessions/{self.session_id}/reset")
+
+    def close(self):
+        if self.session_id is not None:
+            self._request("DELETE", f"/sessions/{self.session_id}")
+            self.session_id = None
+
+    def _watch_cancel(self, cancel_event: threading.Event, finished: threading.Event):
+        # The answer stream blocks until the next line, a cancellation is sent to the server as it happens,
+        # and again until the answer ends, in case it reached the server before the answer request
+        while not cancel_event.wait(0.05):
+            if finished.is_set():
+                return
+
+        while not finished.is_set():
+            try:
+                self._request("POST", f"/sessions/{self.session_id}/cancel")
+            except (OSError, RuntimeError):
+                pass
+            finished.wait(0.2)
+
+    def generate_answer(
+            self,
+            user_input: str,
+            last_k_messages: Optional[int] = None,
+            cancel_event: Optional[threading.Event] = None,
+            on_response_text: Optional[Callable[[str], None]] = None,
+    ) -> Dict[str, str]:
+        """
+        Generate the answer of the character to the user input, see `ChatGemma2.generate_answer`.
+        """
+
+        if self.session_id is None:
+            raise RuntimeError("No session, post_init was not called.")
+
+        finished = threading.Event()
+        if cancel_event is not None:
+            threading.Thread(target=self._watch_cancel, args=(cancel_event, finished), daemon=True).start()
+
+        connection = self._connect()
+        try:
+            body = json.dumps({"user_input": user_input, "last_k_messages": last_k_messages}).encode("utf-8")
+            connection.request(
+                "POST", f"/sessions/{self.session_id}/answer", body=body,
+                headers={"Content-Type": "application/json"},
+            )
+            response = connection.getresponse()
+            if response.status != 200:
+                error = json.loads(response.read() or b"{}").get("error")
+                raise RuntimeError(f"Inference server error {response.status}: {error}")
+
+            while True:
+                line = response.readline()
+                if not line:
+                    raise ConnectionError("The inference server closed the answer stream.")
+
+                message = json.loads(line)
+                status = message["status"]
+                if status == "partial":
+                    if on_response_text is not None and not (cancel_event is not None and cancel_event.is_set()):
+                        on_response_text(message["text"])
+                elif status == "done":
+                    self.last_turn_stats = message.get("stats", {})
+                    return message["answer"]
+                elif status == "cancelled":
+                    raise GenerationCancelled()
+                else:
+                    raise RuntimeError(message.get("error", f"Unknown status: {status}"))
+        finally:
+            finished.set()
+            connection.close()
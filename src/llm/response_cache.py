@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any
+
+
+_NOT_WORD = re.compile(r"[^\w\s']+")
+_REPEATED_LETTER = re.compile(r"(\w)\1{2,}")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_user_input(text: str) -> str:
+    """
+    Reduce a player message to what matters for the answer, so near-duplicates get the same key.
+
+    "Hi!!", "hi" and "Hiii " all become "hi": the case, the punctuation,
+    the repeated whitespace and letters repeated for emphasis are dropped.
+    """
+
+    text = unicodedata.normalize("NFKC", text).lower().replace("’", "'")
+    text = _NOT_WORD.sub(" ", text)
+    text = _REPEATED_LETTER.sub(r"\1", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def fingerprint(*parts: Any) -> str:
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode(), digest_size=10).hexdigest()
+
+
+class ResponseCache:
+    """
+    Remembers the answers to player messages, to answer repeated ones without the model.
+
+    An entry is keyed on the normalized message and a fingerprint of what
+    else the answer depends on, e.g. the last messages of the conversation
+    and the generation settings, and holds up to `max_variants` answers,
+    each a response with its emotion. So the character does not sound
+    canned, a lookup misses on purpose with probability `1 -
+    reuse_probability` while the entry has room for another variant, and
+    the variant served last is not served again right away when there are
+    others. A variant is dropped after `max_uses` uses or `ttl_seconds`.
+
+    At most `max_entries` keys are kept, the least recently used go first.
+    With a `path`, the entries are loaded from that JSON file and written
+    back after every change.
+    """
+
+    version = 2
+
+    def __init__(
+            self,
+            path: Optional[str] = None,
+            max_entries: int = 512,
+            ttl_seconds: Optional[float] = 7 * 24 * 3600,
+            max_variants: int = 3,
+            reuse_probability: float = 0.7,
+            max_uses: Optional[int] = 20,
+            seed: Optional[int] = None,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_variants = max_variants
+        self.reuse_probability = reuse_probability
+        self.max_uses = max_uses
+        self._random = random.Random(seed)
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.variations = 0
+        self.saved_seconds = 0.0
+
+        if path is not None:
+            self.load()
+
+    @staticmethod
+    def make_key(user_input: str, context: str) -> Optional[str]:
+        """
+        Return the key of a player message in a context, None when nothing is left of it to match.
+        """
+
+        normalized = normalize_user_input(user_input)
+        if not normalized:
+            return None
+        return f"{context}:{normalized}"
+
+    def _is_expired(self, variant: Dict[str, Any], now: float) -> bool:
+        if self.ttl_seconds is not None and now - variant["created"] > self.ttl_seconds:
+            return True
+        return self.max_uses is not None and variant["uses"] >= self.max_uses
+
+    def _live_variants(self, key: str, now: float) -> List[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return []
+        entry["variants"] = [variant for variant in entry["variants"] if not self._is_expired(variant, now)]
+        if not entry["variants"]:
+            del self._entries[key]
+        return entry["variants"]
+
+    def get(self, key: str) -> Optional[Dict[str, str]]:
+        """
+        Return a cached answer for the key, None when it has to be generated.
+
+        Returns
+        -------
+        Optional[dict[str, str]]
+            The "response" and its "emotion", as returned by `ChatGemma2.generate_answer`.
+        """
+
+        with self._lock:
+            now = time.time()
+            variants = self._live_variants(key, now)
+            if not variants:
+                self.misses += 1
+                return None
+
+            if len(variants) < self.max_variants and self._random.random() >= self.reuse_probability:
+                self.variations += 1
+                self.misses += 1
+                return None
+
+            entry = self._entries[key]
+            self._entries.move_to_end(key)
+            # The response rather than an index, which expired variants would shift
+            candidates = [variant for variant in variants if variant["response"] != entry["last_served"]]
+            variant = self._random.choice(candidates or variants)
+            entry["last_served"] = variant["response"]
+            variant["uses"] += 1
+            self.hits += 1
+            self.saved_seconds += variant["generation_seconds"]
+
+        self._save()
+        return {"emotion": variant["emotion"], "response": variant["response"]}
+
+    def put(self, key: str, answer: Dict[str, str], generation_seconds: float):
+        """
+        Add a generated answer as a variant of the key.
+
+        Arguments
+        ---------
+        key : str
+            The key of the player message, see `make_key`.
+        answer : dict[str, str]
+            The "response" and its "emotion".
+        generation_seconds : float
+            How long the answer took, i.e. how much time a hit saves.
+        """
+
+        if not answer["response"].strip():
+            return
+
+        with self._lock:
+            now = time.time()
+            self._live_variants(key, now)
+            entry = self._entries.setdefault(key, {"variants": [], "last_served": None})
+            self._entries.move_to_end(key)
+            variants = entry["variants"]
+            if any(variant["response"] == answer["response"] for variant in variants):
+                return
+            if len(variants) >= self.max_variants:
+                variants.pop(0)
+
+            variants.append({
+                "response": answer["response"],
+                "emotion": answer["emotion"],
+                "generation_seconds": generation_seconds,
+                "created": now,
+                "uses": 0,
+            })
+            # The new variant was just served by the generation
+            entry["last_served"] = answer["response"]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        self._save()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self._save()
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Ignoring the response cache {self.path}: {e}")
+            return
+
+        if data.get("version") != self.version:
+            return
+
+        with self._lock:
+            now = time.time()
+            self._entries = OrderedDict(data["entries"])
+            for key in list(self._entries):
+                self._live_variants(key, now)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        with self._lock:
+            data = json.dumps({"version": self.version, "entries": list(self._entries.items())}, ensure_ascii=False)
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The whole cache is rewritten on every change, a crash halfway must leave the previous version intact
+        temporary_file = f"{self.path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_file, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(temporary_file, self.path)
+        except OSError as e:
+            print(f"Could not write the response cache {self.path}: {e}")
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "variants": sum(len(entry["variants"]) for entry in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "variations": self.variations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_seconds": self.saved_seconds,
+                "mean_saved_ms": 1000 * self.saved_seconds / self.hits if self.hits else 0.0,
+            }
@@ -0,0 +1,171 @@
+from typing import Optional, Hashable, Union
+
+import torch
+from transformers import DynamicCache, PreTrainedModel
+
+
+def common_prefix_length(a: torch.LongTensor, b: torch.LongTensor) -> int:
+    length = min(a.shape[0], b.shape[0])
+    mismatches = (a[:length] != b[:length]).nonzero()
+    if len(mismatches) == 0:
+        return length
+    return int(mismatches[0, 0])
+
+
+class SessionKVCache:
+    """
+    Keeps the past key values of a conversation between turns.
+
+    Every turn re-renders the whole conversation with the chat template, but
+    most of it was already processed by the model during the previous turn.
+    The cache remembers which token ids its key values belong to, and before
+    each generation it is truncated back to the first token where the new
+    prompt diverges from them. Only the tokens after that point are
+    prefilled again, e.g. the latest user turn, or the previous user turn
+    when its verbose prompt is swapped for the short one.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.cache: Optional[DynamicCache] = None
+        self.token_ids: Optional[torch.LongTensor] = None
+        self.last_prompt_tokens = 0
+        self.last_reused_tokens = 0
+
+    @property
+    def num_cached_tokens(self):
+        if self.token_ids is None:
+            return 0
+        return self.token_ids.shape[0]
+
+    def prepare(self, input_ids: torch.LongTensor) -> DynamicCache:
+        """
+        Truncate the cache to the longest prefix it shares with the prompt.
+
+        Arguments
+        ---------
+        input_ids : torch.LongTensor
+            The prompt of shape (1, sequence_length) that is about to be generated from.
+
+        Returns
+        -------
+        DynamicCache
+            The cache to pass as `past_key_values` to `model.generate`.
+        """
+
+        prompt_ids = input_ids[0]
+        reused_tokens = 0
+        if self.cache is not None:
+            reused_tokens = common_prefix_length(self.token_ids.to(prompt_ids.device), prompt_ids)
+            # The last prompt token has to be fed to the model to get the logits of the next one
+            reused_tokens = min(reused_tokens, prompt_ids.shape[0] - 1)
+
+        if reused_tokens == 0:
+            self.cache = DynamicCache()
+        else:
+            self.cache.crop(reused_tokens)
+
+        self.token_ids = prompt_ids[:reused_tokens]
+        self.last_prompt_tokens = prompt_ids.shape[0]
+        self.last_reused_tokens = reused_tokens
+        return self.cache
+
+    def update(self, output_ids: torch.LongTensor):
+        """
+        Remember the token ids whose key values are now stored in the cache.
+
+        Arguments
+        ---------
+        output_ids : torch.LongTensor
+            The prompt followed by the generated tokens, of shape (sequence_length,).
+        """
+
+        # The last generated token is never fed back to the model, so it has no key values yet
+        self.token_ids = output_ids[:self.cache.get_seq_length()]
+
+
+class PrefixKVCache:
+    """
+    Holds the precomputed key values of a prompt prefix shared by many queries.
+
+    Each query gets its own shallow copy of the prefix cache. This is safe
+    because `DynamicCache` never modifies its tensors in place, so the
+    precomputed prefix is never touched by the generations that extend it.
+    The cache is tagged with a key describing everything it depends on and
+    is rebuilt whenever that key changes.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.cache: Optional[DynamicCache] = None
+        self.token_ids: Optional[torch.LongTensor] = None
+        self.key: Optional[Hashable] = None
+        self.last_prompt_tokens = 0
+        self.last_reused_tokens = 0
+
+    def is_valid(self, key: Hashable) -> bool:
+        return self.cache is not None and self.key == key
+
+    @torch.no_grad()
+    def build(self, model: PreTrainedModel, token_ids: torch.LongTensor, key: Hashable):
+        """
+        Prefill the prefix once and store its key values.
+
+        Arguments
+        ---------
+        model : PreTrainedModel
+            The model whose key values are cached.
+        token_ids : torch.LongTensor
+            The token ids of the prefix, of shape (sequence_length,).
+        key : Hashable
+            Identifies the settings the prefix was built from.
+        """
+
+        token_ids = token_ids.to(model.device)
+        cache = DynamicCache()
+        model(input_ids=token_ids[None], past_key_values=cache, use_cache=True)
+
+        self.cache = cache
+        self.token_ids = token_ids
+        self.key = key
+
+    def prepare(self, input_ids: torch.LongTensor) -> DynamicCache:
+        """
+        Copy the prefix cache for a prompt, truncated to the part the prompt shares.
+
+        Arguments
+        ---------
+        input_ids : torch.LongTensor
+            The prompt of shape (1, sequence_length) that is about to be generated from.
+
+        Returns
+        -------
+        DynamicCache
+            The cache to pass as `past_key_values` to `model.generate`.
+        """
+
+        prompt_ids = input_ids[0]
+        reused_tokens = 0
+        if self.cache is not None:
+            reused_tokens = common_prefix_length(self.token_ids.to(prompt_ids.device), prompt_ids)
+            reused_tokens = min(reused_tokens, prompt_ids.shape[0] - 1)
+
+        self.last_prompt_tokens = prompt_ids.shape[0]
+        self.last_reused_tokens = reused_tokens
+        if reused_tokens == 0:
+            return DynamicCache()
+
+        cache = DynamicCache.from_legacy_cache(self.cache.to_legacy_cache())
+        cache.crop(reused_tokens)
+        return cache
+
+    def update(self, output_ids: torch.LongTensor):
+        # The generations work on copies, the prefix itself never changes
+        pass
+
+
+KVCache = Union[SessionKVCache, PrefixKVCache]
@@ -0,0 +1,160 @@
+import threading
+from collections import OrderedDict
+from typing import Tuple, List, Dict, Iterable, Optional
+
+import pygame
+from pygame import Surface
+
+from src.sprites.disk_asset_cache import DiskAssetCache
+from src.sprites.sprite import ScreenSize
+
+
+AssetKey = Tuple[str, ScreenSize, bool]
+
+
+class AssetManager:
+    """
+    Loads images scaled to their on-screen size and converted to the display format, once.
+
+    The surfaces are kept in a least recently used cache capped by their
+    size in bytes, so a mood switch is a dictionary lookup. `prefetch`
+    decodes a list of images on a background thread while the game runs,
+    it stops when the cache is full instead of evicting what it loaded.
+    With a `disk_cache`, the scaled pixels are also kept across runs.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, disk_cache: Optional[DiskAssetCache] = None):
+        self.max_bytes = max_bytes
+        self.disk_cache = disk_cache
+        self._surfaces: "OrderedDict[AssetKey, Surface]" = OrderedDict()
+        self._source_sizes: Dict[str, ScreenSize] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._prefetch_thread: Optional[threading.Thread] = None
+
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _surface_bytes(surface: Surface) -> int:
+        return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+    def _decode(self, path: str, size: ScreenSize, alpha: bool) -> Surface:
+        cached = self.disk_cache.load(path, size, alpha) if self.disk_cache is not None else None
+        if cached is not None:
+            image, source_size = cached
+        else:
+            image = pygame.image.load(path)
+            source_size = image.get_size()
+            image = pygame.transform.smoothscale(image, size)
+            if self.disk_cache is not None:
+                try:
+                    self.disk_cache.store(path, image, alpha, source_size)
+                except OSError as e:
+                    print(f"Error caching {path} on disk: {e}")
+
+        with self._lock:
+            self._source_sizes[path] = source_size
+
+        # Blits between surfaces of the display format skip the per-pixel conversion
+        if pygame.display.get_surface() is not None:
+            image = image.convert_alpha() if alpha else image.convert()
+        return image
+
+    def _store(self, key: AssetKey, surface: Surface, evict: bool = True) -> bool:
+        with self._lock:
+            if key in self._surfaces:
+                return True
+
+            surface_bytes = self._surface_bytes(surface)
+            if not evict and self.used_bytes + surface_bytes > self.max_bytes:
+                return False
+
+            self._surfaces[key] = surface
+            self.used_bytes += surface_bytes
+            # The surface just stored stays, even if it is larger than the cap on its own
+            while self.used_bytes > self.max_bytes and len(self._surfaces) > 1:
+                _, evicted = self._surfaces.popitem(last=False)
+                self.used_bytes -= self._surface_bytes(evicted)
+            return True
+
+    def load(self, path: str, size: ScreenSize, alpha: bool = True) -> Surface:
+        """
+        Return the image scaled to the size, decoding it only if it is not cached.
+
+        Arguments
+        ---------
+        path : str
+            The path of the image.
+        size : tuple[int, int]
+            The size of the image on screen.
+        alpha : bool
+            Whether the image has transparent pixels. Without, it is converted to an opaque surface.
+
+        Returns
+        -------
+        Surface
+            The scaled image, shared with the other users of the cache.
+        """
+
+        key = (path, (int(size[0]), int(size[1])), alpha)
+        with self._lock:
+            surface = self._surfaces.get(key)
+            if surface is not None:
+                self._surfaces.move_to_end(key)
+                self.hits += 1
+                return surface
+            self.misses += 1
+
+        surface = self._decode(path, key[1], alpha)
+        self._store(key, surface)
+        return surface
+
+    def source_size(self, path: str) -> ScreenSize:
+        with self._lock:
+            size = self._source_sizes.get(path)
+        if size is None:
+            size = pygame.image.load(path).get_size()
+        return size
+
+    def prefetch(self, assets: Iterable[Tuple[str, ScreenSize]], alpha: bool = True):
+        """
+        Decode the images on a background thread, in order, until the cache is full.
+        """
+
+        keys = [(path, (int(size[0]), int(size[1])), alpha) for path, size in assets]
+        self._prefetch_thread = threading.Thread(target=self._prefetch, args=(keys,), daemon=True)
+        self._prefetch_thread.start()
+
+    def _prefetch(self, keys: List[AssetKey]):
+        for key in keys:
+            if self._stop_event.is_set():
+                return
+
+            with self._lock:
+                if key in self._surfaces:
+                    continue
+
+            try:
+                surface = self._decode(*key)
+            except (pygame.error, FileNotFoundError) as e:
+                print(f"Error prefetching {key[0]}: {e}")
+                continue
+
+            if not self._store(key, surface, evict=False):
+                return
+
+    def close(self, timeout: Optional[float] = None):
+        self._stop_event.set()
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join(timeout)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "entries": len(self._surfaces),
+                "used_mb": self.used_bytes / 1024 ** 2,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -1,14 +1,16 @@
-import pygame
+from typing import Optional
 
+from src.sprites.asset_manager import AssetManager
 from src.sprites.sprite import Sprite, ScreenSize
 
 
 class Background(Sprite):
-    def __init__(self, image_path: str, screen_size: ScreenSize):
+    def __init__(self, image_path: str, screen_size: ScreenSize, assets: Optional[AssetManager] = None):
         self.screen_size = screen_size
+        self.assets = assets if assets is not None else AssetManager()
         self.load_image(image_path)
         super().__init__(self.image)
 
     def load_image(self, image_path: str):
-        self.image = pygame.image.load(image_path)
-        self.image = pygame.transform.smoothscale(self.image, self.screen_size)
\ No newline at end of file
+        # Opaque, so a redraw replaces what was on screen instead of blending with it
+        self.image = self.assets.load(image_path, self.screen_size, alpha=False)
\ No newline at end of file
@@ -1,21 +1,35 @@
 import os
 import random
+from typing import Optional
 
-import pygame
-
+from src.sprites.asset_manager import AssetManager
 from src.sprites.sprite import Sprite, ScreenSize
 
 
 class Character(Sprite):
-    def __init__(self, character_path: str, screen_size: ScreenSize, mood: str = "happy"):
+    def __init__(
+            self,
+            character_path: str,
+            screen_size: ScreenSize,
+            mood: str = "happy",
+            assets: Optional[AssetManager] = None
+    ):
         self.screen_size = screen_size
         self.character_path = character_path
+        self.assets = assets if assets is not None else AssetManager()
         self.emotions = self.read_emotions()
         self.set_mood(mood)
 
         x = (screen_size[0] - self.image.get_width()) // 2
         super().__init__(self.image, (x, 0))
 
+        # The other variants are decoded while the game runs, switching the mood later is a lookup
+        self.assets.prefetch([
+            (image_path, self.image_size)
+            for emotion in self.available_emotions
+            for image_path in self.emotions[emotion]
+        ])
+
     def set_mood(self, mood):
         if mood not in self.emotions:
             mood = 'glitched'
@@ -28,7 +42,7 @@ class Character(Sprite):
         emotions = {}
         for emotion_dir in emotion_dirs:
             emotion_path = os.path.join(self.character_path, emotion_dir)
-            emotions[emotion_dir] = [os.path.join(emotion_path, f) for f in os.listdir(emotion_path)]
+            emotions[emotion_dir] = sorted(os.path.join(emotion_path, f) for f in os.listdir(emotion_path))
 
         return emotions
 
@@ -36,9 +50,12 @@ class Character(Sprite):
         random_index = random.randint(0, len(self.emotions[self.mood]) - 1)
         self.load_image(self.emotions[self.mood][random_index])
 
+    @property
+    def image_size(self):
+        return int(self.screen_size[1]), int(self.screen_size[1])
+
     def load_image(self, image_path: str):
-        self.image = pygame.image.load(image_path)
-        self.image = pygame.transform.smoothscale(self.image, (int(self.screen_size[1]), self.screen_size[1]))
+        self.image = self.assets.load(image_path, self.image_size)
 
     @property
     def available_emotions(self):
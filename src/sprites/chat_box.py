@@ -1,10 +1,19 @@
-from typing import Tuple, Optional
+from typing import Tuple, List, Dict, Iterator, NamedTuple, Optional
 
 import pygame
 from pygame import Surface
 
+from src.sprites.asset_manager import AssetManager
+from src.sprites.outlined_text import render_outlined_text, OutlinedTextCache
 from src.sprites.sprite import ScreenSize, Sprite, Coordinates
-from src.text_utils.sentence_split import SentenceSplitter
+from src.text_utils.sentence_split import SentenceSplitter, IncrementalSentenceSplitter
+
+
+class LaidOutLine(NamedTuple):
+    text: str
+    # Index of the first character of the line in the laid out text
+    offset: int
+    pos: Coordinates
 
 
 class ChatBox(Sprite):
@@ -13,16 +22,33 @@ class ChatBox(Sprite):
             screen_size: ScreenSize,
             text: str,
             character_name: str,
-            text_speed: float = 4.0
+            text_speed: float = 240.0,
+            assets: Optional[AssetManager] = None,
+            max_catch_up_ms: int = 500
     ):
 
         image_path = "resources/images/chat/chat.webp"
         self.screen_size = screen_size
+        self.assets = assets if assets is not None else AssetManager()
         self.load_image(image_path)
         super().__init__(self.image)
 
         self.sentence_splitter = SentenceSplitter()
         self.next_slide_token = "<next_slide>"
+        self._streaming = False
+        self._streamed_text = None
+        # A growing response is split once as it arrives, not again on every token
+        self.stream_splitter = IncrementalSentenceSplitter(self.sentence_splitter)
+        self._stream_input = ""
+        self._stream_sentences: List[str] = []
+        self.line_cache = OutlinedTextCache(max_entries=64)
+        self._layouts: Dict[tuple, List[LaidOutLine]] = {}
+        self.max_layouts = 32
+        self._drawn_text_state = None
+        self._drawn_text_rects: List[pygame.Rect] = []
+        # Ticks of the last typewriter step, None while nothing is being typed
+        self._typing_ticks: Optional[int] = None
+        self.max_catch_up_ms = max_catch_up_ms
 
         self.prepare_text_info()
         self.set_text(text)
@@ -30,11 +56,17 @@ class ChatBox(Sprite):
         self.set_text_speed(text_speed)
 
         self._prompt_mode = False
+        self._thinking = False
+        self._thinking_start_ticks = 0
 
     @property
     def is_prompt_mode(self):
         return self._prompt_mode
 
+    @property
+    def is_thinking(self):
+        return self._thinking
+
     def _set_text_wait_color(self):
         self.chat_text_outer_color = (255, 0, 0)
 
@@ -120,16 +152,85 @@ class ChatBox(Sprite):
 
     def set_text(self, text: str):
         self._prompt_mode = False
+        self._thinking = False
+        self._streaming = False
+        self._evict_chat_lines()
+        self._layout_text(text)
+
+        self.reset_text_index()
+        self.set_chunk_index(0)
+
+    def stream_text(self, text: str, is_final: bool = False):
+        """
+        Show a response that is still being generated.
+
+        Only completed sentences are laid out, because the last sentence of
+        a growing text may still change. Only the new part of the text is fed
+        to the incremental splitter, the sentences before it are not split
+        again. The typewriter keeps its position, so the first slide can be
+        read while later tokens are decoded.
+
+        Arguments
+        ---------
+        text : str
+            The whole response generated so far.
+        is_final : bool
+            Whether the generation has finished and the text is complete.
+        """
+
+        if not text.startswith(self._stream_input):
+            self._reset_stream_splitter()
+        self._stream_sentences += self.stream_splitter.feed(text[len(self._stream_input):])
+        self._stream_input = text
+        if is_final:
+            self._stream_sentences += self.stream_splitter.flush()
+            sentences = self._stream_sentences
+            self._reset_stream_splitter()
+        else:
+            sentences = self._stream_sentences
+
+        ready_text = " ".join(sentences)
+        if not is_final and (not ready_text or ready_text == self._streamed_text):
+            return
+
+        self._streamed_text = ready_text
+        self._streaming = not is_final
+
+        if self._thinking or self._prompt_mode:
+            self._prompt_mode = False
+            self._thinking = False
+            self._layout_text(ready_text)
+            self.reset_text_index()
+            self.set_chunk_index(0)
+            return
+
+        chunk_index = self._chunk_index
+        text_index_float = self.text_index_float
+        self._layout_text(ready_text)
+        self.set_chunk_index(min(chunk_index, len(self.text_chunks) - 1))
+        self.text_index_float = min(text_index_float, len(self._text))
+        self.text_index = int(self.text_index_float)
+
+    @property
+    def is_streaming(self):
+        return self._streaming
+
+    def _reset_stream_splitter(self):
+        self.stream_splitter.reset()
+        self._stream_input = ""
+        self._stream_sentences = []
+
+    def _layout_text(self, text: str):
         self._whole_text = f"{text}".strip()
         self._whole_text = self.add_next_slides_tokens(self._whole_text)
 
         text_remained = self._whole_text
         text_chunks = []
         while True:
-            text_displayed, is_all_text_displayed = self._print_text_inside_box(
-                None, self.chat_bounding_box, self.chat_font, text_remained, self.text_outline_size,
-                self.chat_text_inner_color, self.chat_text_outer_color, simulate=True
+            lines, is_all_text_displayed = self._fit_lines_inside_box(
+                self.chat_bounding_box, self.chat_font, text_remained
             )
+            text_displayed = "".join(lines)
             text_chunks.append(text_displayed)
             text_remained = text_remained[len(text_displayed):]
 
@@ -140,16 +241,44 @@ class ChatBox(Sprite):
 
         text_chunks = [chunk.replace(self.next_slide_token, "") for chunk in text_chunks]
         self.text_chunks = text_chunks
-
-        self.reset_text_index()
-        self.set_chunk_index(0)
+        for chunk in text_chunks:
+            self._get_layout(self.chat_bounding_box, self.chat_font, chunk)
 
     def set_prompt(self, prompt: str):
+        # Called on every frame in prompt mode, only a changed prompt needs a new layout
+        if self._prompt_mode and prompt == self._whole_text:
+            return
+
+        self._prompt_mode = True
+        self._thinking = False
+        self._streaming = False
         self._whole_text = f"{prompt}"
         self.text_chunks = [self._whole_text]
         self.finish_index()
         self.set_chunk_index(0)
 
+    def set_thinking(self):
+        self._prompt_mode = False
+        self._thinking = True
+        self._thinking_start_ticks = pygame.time.get_ticks()
+        self._streaming = False
+        self._streamed_text = None
+        self._reset_stream_splitter()
+        self._evict_chat_lines()
+        self.text_chunks = [""]
+        self.set_chunk_index(0)
+        self.reset_text_index()
+
+    def _update_thinking_text(self):
+        # Animate "." -> ".." -> "..." while the answer is being generated
+        elapsed = pygame.time.get_ticks() - self._thinking_start_ticks
+        self._text = "." * (1 + (elapsed // 400) % 3)
+        self.finish_index()
+
+    def _evict_chat_lines(self):
+        # The lines of the previous chunk will not be drawn again, the character name stays cached
+        self.line_cache.evict_font(self.chat_font)
+
     def set_chunk_index(self, chunk_index: int):
         self._chunk_index = chunk_index
         self._text = self.text_chunks[chunk_index]
@@ -159,11 +288,13 @@ class ChatBox(Sprite):
         return self._text[:self.text_index]
 
     def set_text_speed(self, text_speed: float):
+        # In characters per second, the typewriter follows the time and not the frame rate
         self.text_speed = text_speed
 
     def reset_text_index(self):
         self.text_index = 0
         self.text_index_float = 0.0
+        self._typing_ticks = None
 
     def finish_index(self):
         self.text_index = len(self._text)
@@ -176,9 +307,14 @@ class ChatBox(Sprite):
 
         if self.ready_for_next_chunk:
             if self._chunk_index >= len(self.text_chunks) - 1:
+                # Wait for the rest of a streamed answer before asking for a new prompt
+                if self._streaming:
+                    return
+
                 self._prompt_mode = True
                 return
 
+            self._evict_chat_lines()
             self.set_chunk_index(self._chunk_index + 1)
             self.reset_text_index()
 
@@ -186,153 +322,263 @@ class ChatBox(Sprite):
         self.character_name = character_name
 
     def load_image(self, image_path: str):
-        self.image = pygame.image.load(image_path)
-        self.original_size = self.image.get_size()
-        self.image = pygame.transform.smoothscale(self.image, self.screen_size)
+        self.image = self.assets.load(image_path, self.screen_size)
+        self.original_size = self.assets.source_size(image_path)
 
     def draw(self, screen: Surface):
         super().draw(screen)
         self.print_character_name(screen)
         self.print_text(screen)
-        self.update()
+        self._drawn_text_state = self._text_state()
+        self._drawn_text_rects = self._text_rects()
+
+    def _text_state(self):
+        return (
+            self._text, self._visible_characters(), self.character_name,
+            self.chat_text_inner_color, self.chat_text_outer_color,
+        )
+
+    def _text_rects(self) -> List[pygame.Rect]:
+        rects = []
+        blocks = [
+            (self.character_font, self.character_outline_size, self._character_name_lines(), None),
+            (self.chat_font, self.text_outline_size, self._chat_lines(), self._visible_characters()),
+        ]
+        for font, outline_size, lines, visible_characters in blocks:
+            for line, text in self._visible_lines(lines, visible_characters):
+                width, height = font.size(text)
+                # A pixel of margin, in case the rendered size is rounded differently from the measured one
+                rect = pygame.Rect(line.pos, (width + 2 * outline_size, height + 2 * outline_size))
+                rects.append(rect.inflate(2, 2))
+        return rects
+
+    def get_dirty_rects(self) -> List[pygame.Rect]:
+        rects = super().get_dirty_rects()
+        if self._text_state() != self._drawn_text_state:
+            # The old text is erased and the new one is drawn
+            rects += self._drawn_text_rects + self._text_rects()
+        return rects
+
+    def _chat_lines(self) -> List[LaidOutLine]:
+        return self._get_layout(self.chat_bounding_box, self.chat_font, self._text)
+
+    def _character_name_lines(self) -> List[LaidOutLine]:
+        return self._get_layout(self.character_bounding_box, self.character_font, self.character_name, centered=True)
+
+    def _visible_characters(self) -> Optional[int]:
+        return None if self.is_chunk_finished() else self.text_index
 
     def print_text(self, screen: Surface):
-        text_displayed, is_all_text_displayed = self._print_text_inside_box(
-            screen, self.chat_bounding_box, self.chat_font, self.text, self.text_outline_size,
-            self.chat_text_inner_color, self.chat_text_outer_color
+        self._draw_lines(
+            screen, self._chat_lines(), self.chat_font, self.text_outline_size,
+            self.chat_text_inner_color, self.chat_text_outer_color, self._visible_characters()
         )
-        return text_displayed, is_all_text_displayed
 
     def print_character_name(self, screen: Surface):
-        text_displayed, is_all_text_displayed = self._print_text_inside_box(
-            screen, self.character_bounding_box, self.character_font, self.character_name, self.character_outline_size,
-            self.character_inner_color, self.character_outer_color, centered=True
+        self._draw_lines(
+            screen, self._character_name_lines(), self.character_font, self.character_outline_size,
+            self.character_inner_color, self.character_outer_color
         )
-        return text_displayed, is_all_text_displayed
+
+    @property
+    def is_animating(self):
+        return self._thinking or not self.is_chunk_finished()
 
     def is_chunk_finished(self):
         return self.text_index >= len(self._text)
 
-    def update(self):
+    def update(self, ticks: Optional[int] = None):
+        """
+        Advance the typewriter by the time elapsed since the previous update.
+
+        A stall of the game loop is caught up in a single update, up to
+        `max_catch_up_ms` of typing, so a lower or uneven frame rate does not
+        change the reading speed.
+
+        Arguments
+        ---------
+        ticks : Optional[int]
+            The current time in milliseconds, `pygame.time.get_ticks()` by default.
+        """
+
+        if self._thinking:
+            self._update_thinking_text()
+            return
+
         if self.is_chunk_finished():
             self.ready_for_next_chunk = True
+            self._typing_ticks = None
             return
 
-        self.text_index_float += self.text_speed
+        if ticks is None:
+            ticks = pygame.time.get_ticks()
+        # Typing starts now, the time spent waiting before, e.g. for a streamed sentence, does not count
+        if self._typing_ticks is None:
+            self._typing_ticks = ticks
+
+        elapsed_ms = min(ticks - self._typing_ticks, self.max_catch_up_ms)
+        self._typing_ticks = ticks
+        self.text_index_float = min(self.text_index_float + self.text_speed * elapsed_ms / 1000, len(self._text))
         self.text_index = int(self.text_index_float)
 
-    def _wrap_text(
+    def _iter_wrapped_lines(
             self,
             max_width: int,
             font: pygame.font.Font,
             text: str
-    ):
+    ) -> Iterator[str]:
+        # Lines are produced lazily, so laying out a chunk only measures the words of that chunk
         words = text.split(' ')
-        lines = []
         current_line = words[0]
 
         for i in range(1, len(words)):
             word = words[i]
             if word == self.next_slide_token:
-                lines.append(f"{current_line} {word}")
+                yield f"{current_line} {word} "
                 current_line = ""
                 continue
 
+            # The whole line is measured, kerning makes the sum of the word widths drift by up to a space
             test_line = f"{current_line} {word}"
             if font.size(test_line)[0] <= max_width:
                 current_line = test_line
             else:
-                lines.append(current_line)
+                yield f"{current_line} "
                 current_line = word
 
-        lines.append(current_line)
+        yield f"{current_line} "
 
-        lines = [f"{line} " for line in lines]
-        return lines
-
-    @staticmethod
-    def _draw_text_with_outline(
-            text: str,
-            pos: Coordinates,
-            screen: Surface,
+    def _wrap_text(
+            self,
+            max_width: int,
             font: pygame.font.Font,
-            outline_size,
-            inner_color: Tuple[int, int, int],
-            outer_color: Tuple[int, int, int],
+            text: str
     ):
-        # Create the main text surface
-        text_surface = font.render(text, True, inner_color)
-        outline_size = outline_size
-
-        # Create the outline by rendering the text multiple times in the outline color
-        outline_surface = pygame.Surface(
-            (text_surface.get_width() + outline_size * 2, text_surface.get_height() + outline_size * 2), pygame.SRCALPHA)
-
-        # Draw the outline by shifting the text surface in different directions
-        for dx in range(-outline_size, outline_size + 1):
-            for dy in range(-outline_size, outline_size + 1):
-                outline_surface.blit(
-                    font.render(
-                        text, True, outer_color
-                    ),
-                    (dx + outline_size, dy + outline_size)
-                )
-
-        # Blit the main text onto the outline
-        outline_surface.blit(text_surface, (outline_size, outline_size))
+        return list(self._iter_wrapped_lines(max_width, font, text))
 
-        # Blit the text with the outline onto the screen
-        screen.blit(outline_surface, pos)
+    def _fit_lines_inside_box(
+            self,
+            bounding_box: pygame.Rect,
+            font: pygame.font.Font,
+            text: str
+    ) -> Tuple[List[str], bool]:
+        lines = []
+        y_offset = bounding_box.y
+        for line in self._iter_wrapped_lines(bounding_box.width, font, text):
+            lines.append(line)
+            y_offset += font.get_linesize()
 
-        return outline_surface
+            # The line that crosses the bottom of the box is still shown, the next ones go to the next chunk
+            if y_offset > bounding_box.y + bounding_box.height or self.next_slide_token in line:
+                return lines, False
+
+        return lines, True
 
-    def _print_text_inside_box(
+    def _get_layout(
             self,
-            screen: Optional[Surface],
             bounding_box: pygame.Rect,
             font: pygame.font.Font,
             text: str,
-            outline_size: int = 2,
-            inner_color: Tuple[int, int, int] = (255, 255, 255),
-            outer_color: Tuple[int, int, int] = (0, 0, 0),
-            centered: bool = False,
-            simulate: bool = False
-    ):
-        if screen is None:
-            assert simulate, "Screen must be provided if not simulating"
-
-        width = bounding_box.width
-        text_lines = self._wrap_text(width, font, text)
-
+            centered: bool = False
+    ) -> List[LaidOutLine]:
+        """
+        Return the lines of the text as they are drawn inside the box, laying them out only once.
+
+        Arguments
+        ---------
+        bounding_box : pygame.Rect
+            The box the text is drawn into.
+        font : pygame.font.Font
+            The font of the text.
+        text : str
+            The text to lay out.
+        centered : bool
+            Whether the lines are centered horizontally.
+
+        Returns
+        -------
+        list[LaidOutLine]
+            The lines that fit into the box, with their offset in the text and their position.
+        """
+
+        key = (text, font, tuple(bounding_box), centered)
+        layout = self._layouts.get(key)
+        if layout is not None:
+            return layout
+
+        layout = []
+        offset = 0
         y_offset = bounding_box.y
-        x_offset = bounding_box.x
-
-        text_displayed = ""
-        is_all_text_displayed = True
-        should_stop = False
-        for line in text_lines:
-            if self.next_slide_token in line:
-                should_stop = True
-
+        for line in self._fit_lines_inside_box(bounding_box, font, text)[0]:
+            x_offset = bounding_box.x
             if centered:
                 x_offset = bounding_box.x + (bounding_box.width - font.size(line)[0]) // 2
 
-            if not simulate:
-                self._draw_text_with_outline(
-                    line,
-                    (x_offset, y_offset),
-                    screen=screen,
-                    font=font,
-                    outline_size=outline_size,
-                    inner_color=inner_color,
-                    outer_color=outer_color,
-                )
+            layout.append(LaidOutLine(line, offset, (x_offset, y_offset)))
+            offset += len(line)
             y_offset += font.get_linesize()
-            text_displayed += line
 
-            # Stop drawing text if we exceed the bounding box height
-            if y_offset > bounding_box.y + bounding_box.height or should_stop:
-                is_all_text_displayed = False
-                break
+        # The prompt gets a new layout on every key, the old ones are not needed anymore
+        if len(self._layouts) >= self.max_layouts:
+            self._layouts.clear()
+        self._layouts[key] = layout
+        return layout
+
+    @staticmethod
+    def _visible_lines(
+            lines: List[LaidOutLine],
+            visible_characters: Optional[int] = None
+    ) -> Iterator[Tuple[LaidOutLine, str]]:
+        # Yield the lines reached by the typewriter with their typed part, all of them when it is done
+        for line in lines:
+            if visible_characters is None:
+                yield line, line.text
+                continue
 
-        return text_displayed, is_all_text_displayed
+            if visible_characters <= line.offset:
+                return
+            yield line, line.text[:visible_characters - line.offset]
+
+    def _draw_lines(
+            self,
+            screen: Surface,
+            lines: List[LaidOutLine],
+            font: pygame.font.Font,
+            outline_size: int,
+            inner_color: Tuple[int, int, int],
+            outer_color: Tuple[int, int, int],
+            visible_characters: Optional[int] = None
+    ):
+        for line, text in self._visible_lines(lines, visible_characters):
+            self._draw_text_with_outline(
+                text,
+                line.pos,
+                screen=screen,
+                font=font,
+                outline_size=outline_size,
+                inner_color=inner_color,
+                outer_color=outer_color,
+                # The line being typed changes every frame, caching it would only evict the others
+                cache=len(text) == len(line.text),
+            )
+
+    def _draw_text_with_outline(
+            self,
+            text: str,
+            pos: Coordinates,
+            screen: Surface,
+            font: pygame.font.Font,
+            outline_size,
+            inner_color: Tuple[int, int, int],
+            outer_color: Tuple[int, int, int],
+            cache: bool = True,
+    ):
+        if cache:
+            outline_surface = self.line_cache.get(text, font, outline_size, inner_color, outer_color)
+        else:
+            outline_surface = render_outlined_text(text, font, outline_size, inner_color, outer_color)
+
+        # Blit the text with the outline onto the screen
+        screen.blit(outline_surface, pos)
+
+        return outline_surface
@@ -0,0 +1,59 @@
+import time
+from typing import List
+
+import pygame
+from pygame import Surface
+
+from src.sprites.sprite import Sprite, Coordinates
+
+
+class DebugOverlay(Sprite):
+    """
+    A panel of performance numbers drawn over the game, hidden until toggled.
+
+    The game sets the lines of text, at most every `refresh_interval_s`
+    so an idle game is not redrawn on every frame just for the overlay.
+    A hidden overlay has an empty image and costs nothing to draw.
+    """
+
+    def __init__(self, pos: Coordinates = (10, 10), font_size: int = 18, refresh_interval_s: float = 0.5):
+        self.font = pygame.font.Font("resources/fonts/Aller_Rg.ttf", font_size)
+        self.text_color = (255, 255, 255)
+        self.background_color = (0, 0, 0, 170)
+        self.padding = 6
+        self.refresh_interval_s = refresh_interval_s
+        self.visible = False
+        self.lines: List[str] = []
+        self._last_refresh = float("-inf")
+        super().__init__(Surface((0, 0), pygame.SRCALPHA), pos)
+
+    def toggle(self):
+        self.visible = not self.visible
+        self._last_refresh = float("-inf")
+        self._render()
+
+    def needs_refresh(self) -> bool:
+        return self.visible and time.perf_counter() - self._last_refresh >= self.refresh_interval_s
+
+    def set_lines(self, lines: List[str]):
+        self._last_refresh = time.perf_counter()
+        if lines != self.lines:
+            self.lines = lines
+            self._render()
+
+    def _render(self):
+        if not self.visible or not self.lines:
+            self.image = Surface((0, 0), pygame.SRCALPHA)
+            return
+
+        surfaces = [self.font.render(line, True, self.text_color) for line in self.lines]
+        width = max(surface.get_width() for surface in surfaces) + 2 * self.padding
+        height = sum(surface.get_height() for surface in surfaces) + 2 * self.padding
+        panel = Surface((width, height), pygame.SRCALPHA)
+        panel.fill(self.background_color)
+
+        y = self.padding
+        for surface in surfaces:
+            panel.blit(surface, (self.padding, y))
+            y += surface.get_height()
+        self.image = panel
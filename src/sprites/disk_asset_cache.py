@@ -0,0 +1,86 @@
+import hashlib
+import os
+import struct
+import threading
+from typing import Tuple, Optional
+
+import pygame
+from pygame import Surface
+
+from src.sprites.sprite import ScreenSize
+
+
+class DiskAssetCache:
+    """
+    Keeps the scaled images on disk as raw pixels, so later startups skip decoding and scaling.
+
+    A file is named after the source path, a hash of the source content,
+    the target size and the pixel format. It holds a small header with the
+    size of the source image, followed by the pixels as written by
+    `pygame.image.tobytes`, which `pygame.image.frombuffer` reads back
+    without a copy. A changed source file gets a new hash, and the files
+    of its previous content are removed when the new one is stored.
+    """
+
+    header = struct.Struct("<4sII")
+    magic = b"JMA1"
+
+    def __init__(self, directory: str = ".cache/assets"):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def _digest(data: bytes) -> str:
+        return hashlib.blake2b(data, digest_size=10).hexdigest()
+
+    def _path_prefix(self, path: str) -> str:
+        return self._digest(os.path.normpath(path).encode())
+
+    def _cache_file(self, path: str, size: ScreenSize, alpha: bool) -> str:
+        with open(path, "rb") as f:
+            content_digest = self._digest(f.read())
+
+        mode = "RGBA" if alpha else "RGB"
+        name = f"{self._path_prefix(path)}-{content_digest}-{size[0]}x{size[1]}-{mode}.raw"
+        return os.path.join(self.directory, name)
+
+    def load(self, path: str, size: ScreenSize, alpha: bool) -> Optional[Tuple[Surface, ScreenSize]]:
+        """
+        Return the cached scaled image and the size of its source, None if it is not cached.
+        """
+
+        cache_file = self._cache_file(path, size, alpha)
+        try:
+            with open(cache_file, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        mode = "RGBA" if alpha else "RGB"
+        # The size is checked first, an empty or truncated file is too short for the header
+        if len(data) != self.header.size + size[0] * size[1] * len(mode) or not data.startswith(self.magic):
+            print(f"Ignoring the corrupted asset cache file {cache_file}")
+            return None
+
+        _, source_width, source_height = self.header.unpack_from(data)
+
+        surface = pygame.image.frombuffer(memoryview(data)[self.header.size:], size, mode)
+        return surface, (source_width, source_height)
+
+    def store(self, path: str, surface: Surface, alpha: bool, source_size: ScreenSize):
+        cache_file = self._cache_file(path, surface.get_size(), alpha)
+        mode = "RGBA" if alpha else "RGB"
+
+        # The previous content of the source file will never be asked for again
+        prefix = f"{self._path_prefix(path)}-"
+        content_prefix = os.path.basename(cache_file).rsplit("-", 2)[0]
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and not name.startswith(content_prefix):
+                os.remove(os.path.join(self.directory, name))
+
+        # Written to a temporary file first, so a crash never leaves a truncated cache file
+        temporary_file = f"{cache_file}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(temporary_file, "wb") as f:
+            f.write(self.header.pack(self.magic, *source_size))
+            f.write(pygame.image.tobytes(surface, mode))
+        os.replace(temporary_file, cache_file)
@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Tuple, List, Optional
 
 import pygame
 from pygame import Surface
@@ -17,8 +17,39 @@ class Sprite:
         self.image = image
         self.x, self.y = pos
 
+        # What was on screen after the last draw, a sprite that was never drawn is dirty as a whole
+        self._drawn_image: Optional[Surface] = None
+        self._drawn_rect: Optional[pygame.Rect] = None
+        self._dirty_rects: List[pygame.Rect] = []
+
+    @property
+    def rect(self) -> pygame.Rect:
+        return self.image.get_rect(topleft=(self.x, self.y))
+
+    def mark_dirty(self, rect: Optional[pygame.Rect] = None):
+        self._dirty_rects.append(pygame.Rect(rect) if rect is not None else self.rect)
+
+    def get_dirty_rects(self) -> List[pygame.Rect]:
+        """
+        Return the areas of the screen that changed since the sprite was last drawn.
+
+        A new image or position makes both the old and the new rect dirty,
+        other changes are reported with `mark_dirty`.
+        """
+
+        rects = list(self._dirty_rects)
+        rect = self.rect
+        if self.image is not self._drawn_image or rect != self._drawn_rect:
+            rects.append(rect)
+            if self._drawn_rect is not None:
+                rects.append(self._drawn_rect)
+        return rects
+
     def draw(self, screen):
         screen.blit(self.image, (self.x, self.y))
+        self._drawn_image = self.image
+        self._drawn_rect = self.rect
+        self._dirty_rects = []
 
     def center_x(self):
         return self.x + self.image.get_width() / 2
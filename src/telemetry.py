@@ -0,0 +1,99 @@
+import json
+import os
+import time
+from collections import deque
+from typing import Optional, List, Dict, Any, Deque
+
+
+class Telemetry:
+    """
+    Collects the performance records of the turns and the frames.
+
+    Every record is a dictionary with a "type", "turn" or "frame", and the
+    wall clock "time". When a `path` is given they are appended to that
+    file as JSON lines, the frames are buffered and written with the next
+    turn or on `flush`. The latest ones are kept in memory for the debug
+    overlay.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_frames: int = 240, max_turns: int = 20):
+        self.path = path
+        self.frames: Deque[Dict[str, Any]] = deque(maxlen=max_frames)
+        self.turns: Deque[Dict[str, Any]] = deque(maxlen=max_turns)
+        self._file = None
+        self._pending_lines: List[str] = []
+        self.flush_every_frames = 600
+
+    @property
+    def last_turn(self) -> Optional[Dict[str, Any]]:
+        return self.turns[-1] if self.turns else None
+
+    def _write(self, record: Dict[str, Any]):
+        if self.path is None:
+            return
+        self._pending_lines.append(json.dumps(record) + "\n")
+
+    def record_frame(self, event_ms: float, render_ms: float, flip_ms: float, full_redraw: bool):
+        record = {
+            "type": "frame",
+            "time": time.time(),
+            "event_ms": event_ms,
+            "render_ms": render_ms,
+            "flip_ms": flip_ms,
+            "full_redraw": full_redraw,
+        }
+        self.frames.append(record)
+        self._write(record)
+        if len(self._pending_lines) >= self.flush_every_frames:
+            self.flush()
+
+    def record_turn(self, stats: Dict[str, Any]):
+        record = {"type": "turn", "time": time.time(), **stats}
+        self.turns.append(record)
+        self._write(record)
+        self.flush()
+
+    def frame_summary(self) -> Dict[str, float]:
+        """
+        Summarize the recent frames.
+
+        Returns
+        -------
+        dict[str, float]
+            The number of "frames", then the mean and the 95th percentile of
+            the "event_ms", "render_ms", "flip_ms" and "frame_ms", their sum,
+            e.g. "render_ms_mean" and "render_ms_p95".
+        """
+
+        summary: Dict[str, float] = {"frames": len(self.frames)}
+        if not self.frames:
+            return summary
+
+        columns = {
+            name: [frame[name] for frame in self.frames] for name in ("event_ms", "render_ms", "flip_ms")
+        }
+        columns["frame_ms"] = [sum(values) for values in zip(*columns.values())]
+        for name, values in columns.items():
+            values = sorted(values)
+            summary[f"{name}_mean"] = sum(values) / len(values)
+            summary[f"{name}_p95"] = values[min(len(values) - 1, int(0.95 * len(values)))]
+        return summary
+
+    def flush(self):
+        if not self._pending_lines:
+            return
+
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write("".join(self._pending_lines))
+        self._file.flush()
+        self._pending_lines = []
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,26 +1,66 @@
 import re
-from typing import List
+from typing import List, Tuple, Iterable, Optional
+
+
+_ALPHABETS = "([A-Za-z])"
+_PREFIXES = "(Mr|St|Mrs|Ms|Dr)[.]"
+_SUFFIXES = "(Inc|Ltd|Jr|Sr|Co)"
+_STARTERS = (r"(Mr|Mrs|Ms|Dr|Prof|Capt|Cpt|Lt|He\s|She\s|It\s|They\s|Their\s|"
+             r"Our\s|We\s|But\s|However\s|That\s|This\s|Wherever)")
+_ACRONYMS = "([A-Z][.][A-Z][.](?:[A-Z][.])?)"
+_WEBSITES = "[.](com|net|org|io|gov|edu|me)"
+_DIGITS = "([0-9])"
+
+
+# Every rule protects some dots from ending a sentence or forces a sentence end after its first group, the
+# suffix rule also drops the dot of the suffix. They are applied in this order, each one scanning the text
+# left to right without overlapping its own matches. Rules that start with a letter are slow to search, so
+# they come with a gate: a pattern that starts with the dot, is quick to search and matches whenever the
+# rule could, a text without a match of the gate skips the rule.
+_PROTECT, _STOP_AFTER_GROUP, _STOP_INSTEAD_OF_DOT = "protect", "stop", "replace"
+_KEPT, _REMOVED = 1, 2
+_RULES = [
+    (re.compile(_PREFIXES), _PROTECT, re.compile(r"\.(?<=(?:Mr|St|rs|Ms|Dr)\.)")),
+    (re.compile(_WEBSITES), _PROTECT, None),
+    (re.compile(_DIGITS + "[.]" + _DIGITS), _PROTECT, re.compile(r"\.(?<=[0-9]\.)[0-9]")),
+    None,  # Runs of dots, see _protect_dot_runs
+    (re.compile(r"Ph\.D\."), _PROTECT, re.compile(r"\.(?<=Ph\.)D\.")),
+    (re.compile(r"\s" + _ALPHABETS + "[.] "), _PROTECT, re.compile(r"\.(?<=\s[A-Za-z]\.) ")),
+    (re.compile(_ACRONYMS + " " + _STARTERS), _STOP_AFTER_GROUP, re.compile(r"\.(?<=[A-Z]\.)[A-Z]\.")),
+    (re.compile(_ALPHABETS + "[.]" + _ALPHABETS + "[.]" + _ALPHABETS + "[.]"), _PROTECT,
+     re.compile(r"\.(?<=[A-Za-z]\.)[A-Za-z]\.[A-Za-z]\.")),
+    (re.compile(_ALPHABETS + "[.]" + _ALPHABETS + "[.]"), _PROTECT, re.compile(r"\.(?<=[A-Za-z]\.)[A-Za-z]\.")),
+    (re.compile(" " + _SUFFIXES + "[.] " + _STARTERS), _STOP_INSTEAD_OF_DOT, None),
+    (re.compile(" " + _SUFFIXES + "[.]"), _PROTECT, None),
+    (re.compile(" " + _ALPHABETS + "[.]"), _PROTECT, None),
+]
+_SINGLE_LETTER_RULE = 5
+
+_DOT_RUN = re.compile(r"\.{2,}")
+_END_CHARACTER = re.compile(r"[.!?]")
+_PUNCTUATION = re.compile(r"[.!?][.!?\"”]*")
+_QUOTE_SWAPS = [(".”", "”."), (".\"", "\"."), ("!\"", "\"!"), ("?\"", "\"?")]
+
+# The farthest a rule looks past a sentence end: an acronym or suffix, a space and the longest starter
+_LOOKAHEAD = 20
 
 
 class SentenceSplitter:
-    def __init__(self):
-        self.alphabets = "([A-Za-z])"
-        self.prefixes = "(Mr|St|Mrs|Ms|Dr)[.]"
-        self.suffixes = "(Inc|Ltd|Jr|Sr|Co)"
-        self.starters = ("(Mr|Mrs|Ms|Dr|Prof|Capt|Cpt|Lt|He\s|She\s|It\s|They\s|Their\s|"
-                         "Our\s|We\s|But\s|However\s|That\s|This\s|Wherever)")
-        self.acronyms = "([A-Z][.][A-Z][.](?:[A-Z][.])?)"
-        self.websites = "[.](com|net|org|io|gov|edu|me)"
-        self.digits = "([0-9])"
-        self.multiple_dots = r'\.{2,}'
+    """
+    Splits a text into sentences, keeping the dots of abbreviations, acronyms, numbers and websites.
+
+    The rules used to be applied as a chain of regex substitutions that
+    marked the protected dots and the sentence ends inside the text. The
+    same rules are now precompiled and only record the positions of those
+    dots and ends, then the sentences are cut out of the text in a single
+    scan over its punctuation. The output is the same as the substitution
+    chain, including how quotes are moved in front of the punctuation.
+    """
 
     def __call__(self, text: str) -> List[str]:
         """
         Split the text into sentences.
 
-        If the text contains substrings "<prd>" or "<stop>", they would lead
-        to incorrect splitting because they are used as markers for splitting.
-
         Arguments
         ---------
         text : str
@@ -32,34 +72,209 @@ class SentenceSplitter:
             The list of sentences.
         """
 
-        text = " " + text + "  "
-        text = text.replace("\n", " ")
-        text = re.sub(self.prefixes, "\\1<prd>", text)
-        text = re.sub(self.websites, "<prd>\\1", text)
-        text = re.sub(self.digits + "[.]" + self.digits, "\\1<prd>\\2", text)
-        text = re.sub(self.multiple_dots, lambda match: "<prd>" * len(match.group(0)) + "<stop>", text)
-        if "Ph.D" in text:
-            text = text.replace("Ph.D.", "Ph<prd>D<prd>")
-        text = re.sub("\s" + self.alphabets + "[.] ", " \\1<prd> ", text)
-        text = re.sub(self.acronyms + " " + self.starters, "\\1<stop> \\2", text)
-        text = re.sub(self.alphabets + "[.]" + self.alphabets + "[.]" + self.alphabets + "[.]", "\\1<prd>\\2<prd>\\3<prd>", text)
-        text = re.sub(self.alphabets + "[.]" + self.alphabets + "[.]", "\\1<prd>\\2<prd>", text)
-        text = re.sub(" " + self.suffixes + "[.] " + self.starters, " \\1<stop> \\2", text)
-        text = re.sub(" " + self.suffixes + "[.]", " \\1<prd>", text)
-        text = re.sub(" " + self.alphabets + "[.]", " \\1<prd>", text)
-        if "”" in text:
-            text = text.replace(".”", "”.")
-        if "\"" in text:
-            text = text.replace(".\"", "\".")
-        if "!" in text:
-            text = text.replace("!\"", "\"!")
-        if "?" in text:
-            text = text.replace("?\"", "\"?")
-        text = text.replace(".", ".<stop>")
-        text = text.replace("?", "?<stop>")
-        text = text.replace("!", "!<stop>")
-        text = text.replace("<prd>", ".")
-        sentences = text.split("<stop>")
-        sentences = [s.strip() for s in sentences]
-        if sentences and not sentences[-1]: sentences = sentences[:-1]
+        return [sentence for sentence, _ in self.split_spans(text)]
+
+    def split_batch(self, texts: Iterable[str]) -> List[List[str]]:
+        return [self(text) for text in texts]
+
+    def split_spans(self, text: str) -> List[Tuple[str, Optional[int]]]:
+        """
+        Split the text into sentences and tell where it is safe to cut the text after each one.
+
+        Returns
+        -------
+        list[tuple[str, Optional[int]]]
+            Every sentence with the index in `text` of the whitespace that follows
+            its end, None when its end is followed by anything else.
+        """
+
+        # One space in front and two after, like the substitution chain, so the rules match at the edges
+        padded = " " + text.replace("\n", " ") + "  "
+        protected = bytearray(len(padded))
+        stops = set()
+        removed = []
+        spaces = []
+
+        for index, rule in enumerate(_RULES):
+            if rule is None:
+                self._protect_dot_runs(padded, protected, stops)
+                continue
+
+            pattern, action, gate = rule
+            if gate is not None and gate.search(padded) is None:
+                continue
+
+            position = 0
+            while position is not None:
+                restart = None
+                for match in pattern.finditer(padded, position):
+                    start, end = match.span()
+                    dots_end = end if action == _PROTECT else match.end(1) + 1
+
+                    # A protected dot is not a dot anymore for the rules that come later
+                    if any(protected[start:dots_end]):
+                        restart = start + 1
+                        break
+
+                    if action == _PROTECT:
+                        dot = padded.find(".", start, end)
+                        while dot != -1:
+                            protected[dot] = _KEPT
+                            dot = padded.find(".", dot + 1, end)
+                    else:
+                        stops.add(match.end(1))
+                        if action == _STOP_INSTEAD_OF_DOT:
+                            protected[match.end(1)] = _REMOVED
+                            removed.append(match.end(1))
+                    if index == _SINGLE_LETTER_RULE and padded[start] != " ":
+                        spaces.append(start)
+                position = restart
+
+        return self._cut_sentences(padded, protected, stops, removed, spaces)
+
+    @staticmethod
+    def _protect_dot_runs(padded: str, protected: bytearray, stops: set):
+        # An ellipsis never ends inside, only after its last dot
+        for match in _DOT_RUN.finditer(padded):
+            start = None
+            for i in range(match.start(), match.end() + 1):
+                if i < match.end() and not protected[i]:
+                    if start is None:
+                        start = i
+                    continue
+
+                if start is not None and i - start >= 2:
+                    for j in range(start, i):
+                        protected[j] = _KEPT
+                    stops.add(i)
+                start = None
+
+    @staticmethod
+    def _cut_sentences(
+            padded: str,
+            protected: bytearray,
+            stops: set,
+            removed: List[int],
+            spaces: List[int]
+    ) -> List[Tuple[str, Optional[int]]]:
+        # Sentence ends as (position in padded, text that replaces padded[start:end] before the end)
+        ends = [(position, position, "") for position in stops]
+        ends += [(i + 1, i, "") for i in removed]
+        for match in _PUNCTUATION.finditer(padded):
+            start, end = match.span()
+            if end - start == 1:
+                # Most punctuation is a single character that either ends a sentence or is protected
+                if not protected[start]:
+                    ends.append((end, start, padded[start]))
+                continue
+
+            # Protected dots and forced ends split the punctuation into independent clusters
+            for i in range(match.start(), match.end() + 1):
+                if i < match.end() and not protected[i] and (i == start or i not in stops):
+                    continue
+
+                cluster = padded[start:i]
+                for old, new in _QUOTE_SWAPS:
+                    if old in cluster:
+                        cluster = cluster.replace(old, new)
+
+                cluster_start = start
+                for j, character in enumerate(cluster):
+                    if character in ".!?":
+                        ends.append((start + j + 1, cluster_start, cluster[cluster_start - start:j + 1]))
+                        cluster_start = start + j + 1
+                # Quotes left after the last end of the cluster belong to the next sentence
+                if cluster_start < i:
+                    ends.append((i, cluster_start, cluster[cluster_start - start:]))
+
+                start = i + 1 if i < match.end() and protected[i] else i
+
+        if spaces:
+            characters = list(padded)
+            for i in spaces:
+                characters[i] = " "
+            padded = "".join(characters)
+
+        sentences = []
+        pieces = []
+        position = 0
+        # Ends at the same position keep the order of the cluster pieces, forced ends come first
+        for end, replaced_start, replacement in sorted(ends):
+            pieces.append(padded[position:replaced_start])
+            pieces.append(replacement)
+            position = end
+            if replaced_start < end and not replacement[-1:] in (".", "!", "?"):
+                # Trailing quotes of a cluster, not an end
+                continue
+
+            sentence = "".join(pieces).strip()
+            pieces = []
+            cut = end - 1 if end < len(padded) - 2 and padded[end].isspace() else None
+            sentences.append((sentence, cut))
+
+        pieces.append(padded[position:])
+        sentences.append(("".join(pieces).strip(), None))
+        if sentences and not sentences[-1][0]:
+            sentences.pop()
+        return sentences
+
+
+class IncrementalSentenceSplitter:
+    """
+    Splits a text that arrives in pieces, e.g. a streamed response, into sentences.
+
+    `feed` returns the sentences that are complete and can no longer change,
+    the rest of the text is kept until more arrives or `flush` is called.
+    Feeding a text in any pieces and flushing gives the same sentences as
+    splitting it at once.
+    """
+
+    def __init__(self, splitter: Optional[SentenceSplitter] = None):
+        self.splitter = splitter if splitter is not None else SentenceSplitter()
+        self._buffer = ""
+        # Length the buffer must exceed before splitting it again can complete a sentence, None until
+        # the buffer holds an end of sentence character
+        self._split_after: Optional[int] = None
+
+    def reset(self):
+        self._buffer = ""
+        self._split_after = None
+
+    def feed(self, text: str) -> List[str]:
+        fed_from = len(self._buffer)
+        self._buffer += text
+        if self._split_after is None:
+            match = _END_CHARACTER.search(self._buffer, fed_from)
+            if match is None:
+                return []
+            self._split_after = match.start() + _LOOKAHEAD
+        if len(self._buffer) <= self._split_after:
+            return []
+
+        spans = self.splitter.split_spans(self._buffer)
+
+        # A sentence is final once its end is followed by whitespace and more text than any rule looks at
+        complete = []
+        cut = 0
+        for index, (sentence, sentence_cut) in enumerate(spans[:-1]):
+            if sentence_cut is not None and sentence_cut + _LOOKAHEAD < len(self._buffer):
+                complete = [sentence for sentence, _ in spans[:index + 1]]
+                cut = sentence_cut
+
+        self._buffer = self._buffer[cut:]
+        # Ends far enough from the end of the buffer cannot change anymore, only the later ones and
+        # the ends that are already known but lack the text after them are worth another split
+        later_cuts = [
+            sentence_cut - cut for _, sentence_cut in spans
+            if sentence_cut is not None and sentence_cut > cut
+        ]
+        unsettled = _END_CHARACTER.search(self._buffer, max(0, len(self._buffer) - _LOOKAHEAD - 2))
+        if unsettled is not None:
+            later_cuts.append(unsettled.start())
+        self._split_after = min(later_cuts) + _LOOKAHEAD if later_cuts else None
+        return complete
+
+    def flush(self) -> List[str]:
+        sentences = self.splitter(self._buffer)
+        self.reset()
         return sentences